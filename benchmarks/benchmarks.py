@@ -0,0 +1,217 @@
+"""
+Benchmarks for ois, run with airspeed velocity (asv).
+
+Usage, from the repository root:
+
+    $ asv run --python=same --quick   # one pass in this environment
+    $ asv continuous master HEAD      # compare HEAD against master
+
+Each ``time_`` benchmark has a ``peakmem_`` twin that records the peak
+resident memory of the same call. AdaptiveBramich parameter combinations
+that would take far too long to build M are skipped.
+"""
+
+import numpy as np
+from scipy import ndimage
+
+import ois
+import varconv
+
+# Skip AdaptiveBramich when building M takes more multiply-adds than this
+MAX_ADAPTIVE_FLOPS = 2e10
+
+
+def make_images(size, masked=False, seed=0):
+    """Return a science image and a reference of ``size`` x ``size`` pixels
+    with the same stars under a wider PSF in the science image, and masks on
+    a few saturated stars if ``masked``."""
+    rng = np.random.RandomState(seed)
+    n_stars = size * size // 1000
+    stars = np.zeros((size, size))
+    rows = rng.randint(0, size, n_stars)
+    cols = rng.randint(0, size, n_stars)
+    stars[rows, cols] = rng.pareto(1.5, n_stars) * 1000.0
+    image = ndimage.gaussian_filter(stars, 2.0) + 100.0
+    refimage = ndimage.gaussian_filter(stars, 1.2) + 100.0
+    image += rng.normal(0.0, 1.0, image.shape)
+    refimage += rng.normal(0.0, 1.0, refimage.shape)
+    if masked:
+        saturated = ndimage.binary_dilation(
+            refimage > np.percentile(refimage, 99.5), iterations=2
+        )
+        image = np.ma.array(image, mask=saturated)
+        refimage = np.ma.array(refimage, mask=saturated)
+    return image, refimage
+
+
+def skip_slow_adaptive(size, kernel_side, poly_degree):
+    "Raise NotImplementedError, so asv skips it, if building M is too slow."
+    dof = (
+        kernel_side * kernel_side * (poly_degree + 1) * (poly_degree + 2) // 2
+    )
+    if dof * dof * size * size / 2 > MAX_ADAPTIVE_FLOPS:
+        raise NotImplementedError("Too slow")
+
+
+def method_kwargs(method):
+    "Return the keyword arguments used to benchmark ``method``."
+    if method == "Alard-Lupton":
+        return {"gausslist": [{"sx": 1.5, "sy": 1.5}]}
+    if method == "AdaptiveBramich":
+        return {"poly_degree": 1, "low_memory": True}
+    return {}
+
+
+class OptimalSystem:
+    "optimal_system for each method, image size and kernel size."
+
+    params = (
+        ["Bramich", "AdaptiveBramich", "Alard-Lupton"],
+        [256, 1024, 4096],
+        [5, 11, 21],
+    )
+    param_names = ["method", "size", "kernel_side"]
+    timeout = 600
+
+    def setup(self, method, size, kernel_side):
+        self.kwargs = method_kwargs(method)
+        if method == "AdaptiveBramich":
+            skip_slow_adaptive(size, kernel_side, 1)
+        self.image, self.refimage = make_images(size)
+        self.kernelshape = (kernel_side, kernel_side)
+
+    def time_optimal_system(self, method, size, kernel_side):
+        ois.optimal_system(
+            self.image,
+            self.refimage,
+            self.kernelshape,
+            method=method,
+            **self.kwargs
+        )
+
+    def peakmem_optimal_system(self, method, size, kernel_side):
+        self.time_optimal_system(method, size, kernel_side)
+
+
+class Options:
+    "optimal_system options: grid, background degree and masks."
+
+    params = (
+        ["Bramich", "AdaptiveBramich", "Alard-Lupton"],
+        [None, (2, 2), (4, 4)],
+        [None, 0, 2],
+        [False, True],
+    )
+    param_names = ["method", "gridshape", "bkgdegree", "masked"]
+    timeout = 600
+
+    def setup(self, method, gridshape, bkgdegree, masked):
+        self.kwargs = method_kwargs(method)
+        # A smaller kernel for AdaptiveBramich, so it runs in seconds
+        self.kernel_side = 5 if method == "AdaptiveBramich" else 11
+        self.image, self.refimage = make_images(1024, masked)
+
+    def time_optimal_system(self, method, gridshape, bkgdegree, masked):
+        ois.optimal_system(
+            self.image,
+            self.refimage,
+            (self.kernel_side, self.kernel_side),
+            bkgdegree,
+            method=method,
+            gridshape=gridshape,
+            **self.kwargs
+        )
+
+    def peakmem_optimal_system(self, method, gridshape, bkgdegree, masked):
+        self.time_optimal_system(method, gridshape, bkgdegree, masked)
+
+
+class ConvolveAdaptive:
+    "varconv.convolve2d_adaptive on its own."
+
+    params = ([256, 1024, 4096], [5, 11, 21], [0, 2])
+    param_names = ["size", "kernel_side", "poly_degree"]
+    timeout = 600
+
+    def setup(self, size, kernel_side, poly_degree):
+        self.image, self.refimage = make_images(size)
+        poly_dof = (poly_degree + 1) * (poly_degree + 2) // 2
+        rng = np.random.RandomState(0)
+        self.kernel = rng.random_sample((kernel_side, kernel_side, poly_dof))
+
+    def time_convolve2d_adaptive(self, size, kernel_side, poly_degree):
+        varconv.convolve2d_adaptive(self.refimage, self.kernel, poly_degree)
+
+    def peakmem_convolve2d_adaptive(self, size, kernel_side, poly_degree):
+        self.time_convolve2d_adaptive(size, kernel_side, poly_degree)
+
+
+class GenMatrixSystem:
+    """varconv.gen_matrix_system on its own, for a number of OpenMP threads
+    (0 for the OpenMP default), to measure thread scaling."""
+
+    params = ([256, 1024], [5, 11], [0, 2], [1, 2, 4, 0])
+    param_names = ["size", "kernel_side", "poly_degree", "n_threads"]
+    timeout = 600
+
+    def setup(self, size, kernel_side, poly_degree, n_threads):
+        skip_slow_adaptive(size, kernel_side, poly_degree)
+        self.image, self.refimage = make_images(size)
+
+    def time_gen_matrix_system(
+        self, size, kernel_side, poly_degree, n_threads
+    ):
+        varconv.gen_matrix_system(
+            self.image,
+            self.refimage,
+            0,
+            None,
+            kernel_side,
+            poly_degree,
+            -1,
+            n_threads,
+        )
+
+    def peakmem_gen_matrix_system(
+        self, size, kernel_side, poly_degree, n_threads
+    ):
+        self.time_gen_matrix_system(size, kernel_side, poly_degree, n_threads)
+
+
+class EvalKernelGrid:
+    "ois.eval_adaptive_kernel_grid against a loop of eval_adpative_kernel."
+
+    params = ([100, 10000], [11, 21], [1, 3])
+    param_names = ["n_positions", "kernel_side", "poly_degree"]
+
+    def setup(self, n_positions, kernel_side, poly_degree):
+        poly_dof = (poly_degree + 1) * (poly_degree + 2) // 2
+        rng = np.random.RandomState(0)
+        self.kernel = rng.random_sample((kernel_side, kernel_side, poly_dof))
+        self.xs = rng.random_sample(n_positions) * 4096
+        self.ys = rng.random_sample(n_positions) * 4096
+
+    def time_eval_adaptive_kernel_grid(
+        self, n_positions, kernel_side, poly_degree
+    ):
+        ois.eval_adaptive_kernel_grid(self.kernel, self.xs, self.ys)
+
+    def time_eval_adpative_kernel_loop(
+        self, n_positions, kernel_side, poly_degree
+    ):
+        for x, y in zip(self.xs, self.ys):
+            ois.eval_adpative_kernel(self.kernel, x, y)
+
+    def peakmem_eval_adaptive_kernel_grid(
+        self, n_positions, kernel_side, poly_degree
+    ):
+        self.time_eval_adaptive_kernel_grid(
+            n_positions, kernel_side, poly_degree
+        )
+
+    def peakmem_eval_adpative_kernel_loop(
+        self, n_positions, kernel_side, poly_degree
+    ):
+        self.time_eval_adpative_kernel_loop(
+            n_positions, kernel_side, poly_degree
+        )
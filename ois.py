@@ -23,15 +23,29 @@
 
 __version__ = "0.2"
 
+import logging
+import threading
+import warnings
+from timeit import default_timer
+
 import numpy as np
 from scipy import signal
 from scipy import ndimage
+from scipy import linalg
 
 __all__ = [
     "EvenSideKernelError",
+    "ProfileReport",
+    "ReferenceContext",
+    "SubtractionCancelled",
+    "aoptimal_system",
     "convolve2d_adaptive",
+    "eval_adaptive_kernel_grid",
     "eval_adpative_kernel",
+    "find_stamps",
+    "iter_optimal_system",
     "optimal_system",
+    "optimal_system_batch",
 ]
 
 
@@ -39,6 +53,12 @@ class EvenSideKernelError(ValueError):
     pass
 
 
+class SubtractionCancelled(Exception):
+    "Raised by an observer to stop a subtraction at a phase boundary."
+
+    pass
+
+
 def _has_mask(image):
     is_masked_array = isinstance(image, np.ma.MaskedArray)
     if is_masked_array and isinstance(image.mask, np.ndarray):
@@ -47,8 +67,41 @@ def _has_mask(image):
 
 
 class SubtractionStrategy(object):
-    def __init__(self, image, refimage, kernelshape, bkgdegree):
+
+    def __init__(
+        self,
+        image,
+        refimage,
+        kernelshape,
+        bkgdegree,
+        conv_method="auto",
+        solver="cholesky",
+        regularization=1e-8,
+        stamps=None,
+        stamp_shape=None,
+        saturation=None,
+        dtype="float64",
+        observer=None,
+        profile=None,
+    ):
         self.k_shape = kernelshape
+        self.observer = observer
+        _check_profile(profile)
+        self.profile = profile
+        self._phase = None
+        self._phase_start = None
+        if conv_method not in _CONV_METHODS:
+            raise ValueError(
+                "No convolution method named {}".format(conv_method)
+            )
+        self.conv_method = conv_method
+        if solver not in _SOLVERS:
+            raise ValueError("No solver named {}".format(solver))
+        self.solver = solver
+        self.regularization = regularization
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError("dtype must be float32 or float64")
 
         # Check here for dimensions
         if image.ndim != 2:
@@ -61,21 +114,62 @@ class SubtractionStrategy(object):
         self.image, self.refimage, self.badpixmask = self.separate_data_mask(
             image, refimage
         )
+        self.stamp_slices, self.fitmask = self.select_stamps(
+            stamps, stamp_shape, saturation
+        )
 
         self.coeffs = None
         self.bkgdegree = bkgdegree
+        # Products that depend only on the reference image and the mask.
+        # A ReferenceContext shares this dict among strategies.
+        self.refcache = {}
         self.optimal_image = None
         self.background = None
         self.kernel = None
         self.difference = None
 
+    def notify(self, phase):
+        """Tell the observer, if any, that ``phase`` is starting, and record
+        the phase that ended in the profile, if any.
+
+        Phases are ``"basis"``, ``"matrix"``, ``"solve"``, ``"convolve"``
+        and ``"done"``. Phases with cached products are not reported.
+        """
+        if self.observer is not None:
+            self.observer(phase)
+        if self.profile is not None:
+            self.profile_phase(phase)
+
+    def profile_phase(self, phase):
+        """Add the record of the phase that just ended to ``self.profile``
+        and start timing ``phase``."""
+        now = default_timer()
+        if self._phase is not None:
+            product = {
+                "basis": self.refcache.get("basis"),
+                "matrix": self.refcache.get("m"),
+                "solve": self.coeffs,
+                "convolve": self.optimal_image,
+            }[self._phase]
+            record = {
+                "phase": self._phase,
+                "seconds": now - self._phase_start,
+                "shape": np.shape(product) if product is not None else None,
+                "nbytes": getattr(product, "nbytes", 0),
+            }
+            if self._phase == "solve":
+                record["condition_number"] = self.get_condition_number()
+            self.profile.add(record)
+        self._phase = None if phase == "done" else phase
+        self._phase_start = now
+
     def separate_data_mask(self, image, refimage):
         def ret_data(image):
             if isinstance(image, np.ma.MaskedArray):
                 image_data = image.data
             else:
                 image_data = image
-            return image_data
+            return np.asarray(image_data, dtype=self.dtype)
 
         badpixmask = None
         if _has_mask(refimage):
@@ -88,43 +182,248 @@ class SubtractionStrategy(object):
             badpixmask = image.mask
         return ret_data(image), ret_data(refimage), badpixmask
 
+    def select_stamps(self, stamps, stamp_shape, saturation):
+        """Return the slices of the fit stamps and the mask of pixels left
+        out of the fit (bad pixels and, with stamps, pixels off the stamps).
+
+        ``stamps`` is ``None`` to fit the whole image, the number of stamps
+        to pick with ``find_stamps`` on the reference image, or a sequence of
+        (row, column) stamp centers. If there are no stamps, as in a grid
+        element without sources, the whole image is fit, with a warning.
+        """
+        if stamps is None:
+            return None, self.badpixmask
+        kh, kw = self.k_shape
+        if stamp_shape is None:
+            stamp_shape = (2 * kh + 1, 2 * kw + 1)
+        if np.ndim(stamps) == 0:
+            refimage = self.refimage
+            if self.badpixmask is not None:
+                refimage = np.ma.array(refimage, mask=self.badpixmask)
+            stamps = find_stamps(refimage, stamps, stamp_shape, saturation)
+        sh, sw = stamp_shape
+        stamp_slices = []
+        onstamps = np.zeros((self.h, self.w), dtype="bool")
+        for row, col in stamps:
+            sly = slice(max(0, row - sh // 2), min(self.h, row + sh // 2 + 1))
+            slx = slice(max(0, col - sw // 2), min(self.w, col + sw // 2 + 1))
+            if sly.start < sly.stop and slx.start < slx.stop:
+                stamp_slices.append((sly, slx))
+                onstamps[sly, slx] = True
+        if not stamp_slices:
+            warnings.warn(
+                "No stamps in the image, fitting the whole image instead.",
+                RuntimeWarning,
+            )
+            return None, self.badpixmask
+        fitmask = ~onstamps
+        if self.badpixmask is not None:
+            fitmask |= self.badpixmask
+        return stamp_slices, fitmask
+
     def coeffstobackground(self, coeffs):
         "Given a list of coefficients, return an array with the polynomial background"
         bkgdeg = int(-1.5 + 0.5 * np.sqrt(9 + 8 * (len(coeffs) - 1)))
-        h, w = self.h, self.w
-        y, x = np.mgrid[:h, :w]
-        allxs = [pow(x, i) for i in range(bkgdeg + 1)]
-        allys = [pow(y, i) for i in range(bkgdeg + 1)]
-        mybkg = np.zeros(self.image.shape)
-        ind = 0
-        for i, anX in enumerate(allxs):
-            for aY in allys[: bkgdeg + 1 - i]:
-                mybkg += coeffs[ind] * anX * aY
-                ind += 1
-        return mybkg
-
-    def get_cmatrices_background(self):
-        h, w = self.refimage.shape
-        y, x = np.mgrid[:h, :w]
-        allxs = [pow(x, i) for i in range(self.bkgdegree + 1)]
-        allys = [pow(y, i) for i in range(self.bkgdegree + 1)]
-        bkg_c = [
-            anX * aY
-            for i, anX in enumerate(allxs)
-            for aY in allys[: self.bkgdegree + 1 - i]
-        ]
-        return bkg_c
+        pow_y, pow_x = _background_powers(bkgdeg)
+        coeffs_xy = np.zeros((bkgdeg + 1, bkgdeg + 1))
+        coeffs_xy[pow_x, pow_y] = coeffs
+        # Horner's scheme along x for each power of y, then the sum over the
+        # powers of y is a single (h, deg + 1) x (deg + 1, w) product.
+        xpolys = np.polynomial.polynomial.polyval(np.arange(self.w), coeffs_xy)
+        return _powers(np.arange(self.h), bkgdeg).dot(xpolys)
+
+    def get_cmatrices(self, refimage=None):
+        """Override this function to return the list of kernel basis images
+        of ``refimage`` (``self.refimage`` by default)"""
+        return []
+
+    def _reference_product(self, key, build):
+        "Return ``refcache[key]``, calling ``build()`` to make it if missing."
+        if key not in self.refcache:
+            self.refcache[key] = build()
+        return self.refcache[key]
+
+    def iter_stamp_pixels(self):
+        """Yield the slices of each stamp and the mask of its pixels used in
+        the fit. Where stamps overlap, pixels go to the first one only."""
+        claimed = np.zeros((self.h, self.w), dtype="bool")
+        for sly, slx in self.stamp_slices:
+            use = ~(self.fitmask[sly, slx] | claimed[sly, slx])
+            claimed[sly, slx] = True
+            yield sly, slx, use
+
+    def get_fit_pixels(self):
+        """Return the rows and columns of the pixels used in the fit, in the
+        order of the columns of the basis matrix."""
+        if self.stamp_slices is not None:
+            rows, cols = [], []
+            for sly, slx, use in self.iter_stamp_pixels():
+                r, c = np.nonzero(use)
+                rows.append(r + sly.start)
+                cols.append(c + slx.start)
+            return np.concatenate(rows), np.concatenate(cols)
+        if self.fitmask is None:
+            return np.indices((self.h, self.w)).reshape(2, -1)
+        return np.nonzero(~self.fitmask)
+
+    def get_good_image(self):
+        "Return the image on the pixels used in the fit as a 1-D array."
+        if self.fitmask is None:
+            return self.image.ravel()
+        if self.stamp_slices is not None:
+            return self.image[self.get_fit_pixels()]
+        return self.image[~self.fitmask]
+
+    def get_stamps_basis_matrix(self):
+        """Return the basis matrix over the stamp pixels.
+
+        The basis images are made only for a cutout around each stamp, with
+        room for the kernel, so they match the full image basis on the stamp.
+        """
+        kh, kw = self.k_shape
+        blocks = []
+        for sly, slx, use in self.iter_stamp_pixels():
+            cut_y = slice(max(0, sly.start - kh // 2), sly.stop + kh // 2)
+            cut_x = slice(max(0, slx.start - kw // 2), slx.stop + kw // 2)
+            cut = self.refimage[cut_y, cut_x]
+            on_cut = (
+                slice(sly.start - cut_y.start, sly.stop - cut_y.start),
+                slice(slx.start - cut_x.start, slx.stop - cut_x.start),
+            )
+            c = self.get_cmatrices(cut)
+            blocks.append(np.array([ci[on_cut][use] for ci in c]))
+        return np.concatenate(blocks, axis=1)
+
+    def get_basis_matrix(self):
+        """Return the kernel basis images stacked as an (n_c, n_good) array.
+
+        Each row holds one kernel basis image restricted to the pixels used
+        in the fit, in the order of ``get_fit_pixels``. The background
+        terms of the system are made from moments, see
+        ``get_background_moments``.
+        """
+        if self.stamp_slices is not None:
+            return self.get_stamps_basis_matrix()
+        c = self.get_cmatrices()
+        if self.fitmask is None:
+            n_good = self.h * self.w
+            good = slice(None)
+        else:
+            goodpixmask = ~self.fitmask
+            n_good = np.count_nonzero(goodpixmask)
+            good = goodpixmask.ravel()
+        cmat = np.empty((len(c), n_good), dtype=self.dtype)
+        for k in range(len(c)):
+            cmat[k] = np.ravel(c[k])[good]
+            c[k] = None  # release full-size image as soon as it's copied
+        return cmat
+
+    def get_background_moments(self, values, degree):
+        """Return the sums over the fit pixels of ``values`` times
+        x^i y^j, for i and j up to ``degree``, in the last two axes as
+        ``[..., j, i]``.
+
+        ``values`` is an image over the fit pixels, as returned by
+        ``get_good_image``, or a stack of them.
+        """
+        if self.stamp_slices is not None:
+            rows, cols = self.get_fit_pixels()
+            ypow, xpow = _powers(rows, degree), _powers(cols, degree)
+            return np.swapaxes(values[..., None] * ypow, -1, -2).dot(xpow)
+        if values.ndim == 2:
+            return np.array(
+                [self.get_background_moments(v, degree) for v in values]
+            )
+        if self.fitmask is None:
+            image = values.reshape((self.h, self.w))
+        else:
+            image = np.zeros((self.h, self.w))
+            image[~self.fitmask] = values
+        ypow = _powers(np.arange(self.h), degree)
+        xpow = _powers(np.arange(self.w), degree)
+        return ypow.T.dot(image).dot(xpow)
+
+    def get_background_block(self):
+        """Return the background-background block of M.
+
+        Each entry is a power sum of the pixel coordinates, which is
+        separable in x and y when all pixels are used.
+        """
+        deg = 2 * self.bkgdegree
+        if self.fitmask is None:
+            sums = np.outer(
+                _powers(np.arange(self.h), deg).sum(axis=0),
+                _powers(np.arange(self.w), deg).sum(axis=0),
+            )
+        else:
+            n_fit = np.count_nonzero(~self.fitmask)
+            sums = self.get_background_moments(np.ones(n_fit), deg)
+        pow_y, pow_x = _background_powers(self.bkgdegree)
+        return sums[pow_y[:, None] + pow_y, pow_x[:, None] + pow_x]
+
+    def get_normal_matrix(self):
+        """Return the normal equations matrix M = C C^T, with C the basis
+        matrix over good pixels. M depends only on the reference image and
+        the mask, so it is kept in ``refcache``.
+        """
+
+        def build():
+            self.notify("basis")
+            cmat = self._reference_product("basis", self.get_basis_matrix)
+            self.notify("matrix")
+            m = _accumulated_dot(cmat)
+            if self.bkgdegree is None:
+                return m
+            pow_y, pow_x = _background_powers(self.bkgdegree)
+            moments = self.get_background_moments(cmat, self.bkgdegree)
+            m_kb = moments[:, pow_y, pow_x]
+            return np.block([[m, m_kb], [m_kb.T, self.get_background_block()]])
+
+        return self._reference_product("m", build)
+
+    def get_normal_vector(self):
+        "Return the normal equations vector b = C I, with I the good pixels."
+        cmat = self._reference_product("basis", self.get_basis_matrix)
+        image = self.get_good_image()
+        b = _accumulated_dot(cmat, image)
+        if self.bkgdegree is None:
+            return b
+        pow_y, pow_x = _background_powers(self.bkgdegree)
+        moments = self.get_background_moments(image, self.bkgdegree)
+        return np.concatenate((b, moments[pow_y, pow_x]))
+
+    def get_matrix_system(self):
+        "Return the normal equations matrix M and vector b."
+        return self.get_normal_matrix(), self.get_normal_vector()
+
+    def get_solver(self):
+        "Return the factorization of M, made once and kept in ``refcache``."
+        return self._reference_product(
+            "solver",
+            lambda: _NormalSolver(
+                self.get_normal_matrix(), self.solver, self.regularization
+            ),
+        )
+
+    def get_condition_number(self):
+        """Return an estimate of the condition number of M (1-norm, or
+        2-norm for ``"lstsq"``)."""
+        return self.get_solver().condition_number
 
     def get_coeffs(self):
-        "Override this function to solve the matrix minimization system"
+        if self.coeffs is not None:
+            return self.coeffs
+        m, b = self.get_matrix_system()
+        self.notify("solve")
+        self.coeffs = self.get_solver().solve(b)
         return self.coeffs
 
     def get_optimal_image(self):
         if self.optimal_image is not None:
             return self.optimal_image
-        opt_image = signal.convolve2d(
-            self.refimage, self.get_kernel(), mode="same"
-        )
+        kernel = self.get_kernel()
+        self.notify("convolve")
+        opt_image = _convolve2d(self.refimage, kernel, self.conv_method)
         if self.bkgdegree is not None:
             opt_image += self.get_background()
         if self.badpixmask is not None:
@@ -162,9 +461,12 @@ class SubtractionStrategy(object):
 
 
 class AlardLuptonStrategy(SubtractionStrategy):
-    def __init__(self, image, refimage, kernelshape, bkgdegree, gausslist):
+
+    def __init__(
+        self, image, refimage, kernelshape, bkgdegree, gausslist, **kwargs
+    ):
         super(AlardLuptonStrategy, self).__init__(
-            image, refimage, kernelshape, bkgdegree
+            image, refimage, kernelshape, bkgdegree, **kwargs
         )
         if gausslist is None:
             self.gausslist = [{}]
@@ -180,6 +482,14 @@ class AlardLuptonStrategy(SubtractionStrategy):
         norm = k.sum()
         return k / norm
 
+    def gauss_factors(self, center, sx, sy):
+        "Return the column and row 1-D factors of the normalized Gaussian."
+        h, w = self.k_shape
+        y0, x0 = center
+        gy = np.exp(-0.5 * (np.arange(h) - y0) ** 2 / sy**2)
+        gx = np.exp(-0.5 * (np.arange(w) - x0) ** 2 / sx**2)
+        return gy / gy.sum(), gx / gx.sum()
+
     def clean_gausslist(self):
         for agauss in self.gausslist:
             if "center" not in agauss:
@@ -192,8 +502,32 @@ class AlardLuptonStrategy(SubtractionStrategy):
             if "sy" not in agauss:
                 agauss["sy"] = 2.0
 
-    def get_cmatrices(self):
+    def get_cmatrices(self, refimage=None):
+        if refimage is None:
+            refimage = self.refimage
         kh, kw = self.k_shape
+        if self.conv_method in ("separable", "auto"):
+            # Every basis kernel is gy(v) v^j * gx(u) u^i, so each is two 1-D
+            # convolutions, and the one along columns is shared for all i.
+            v, u = np.arange(kh), np.arange(kw)
+            c = []
+            for aGauss in self.gausslist:
+                n = aGauss["modPolyDeg"] + 1
+                gy, gx = self.gauss_factors(
+                    center=aGauss["center"], sx=aGauss["sx"], sy=aGauss["sy"]
+                )
+                colconv = [
+                    _convolve1d(refimage, gy * pow(v, j), axis=0)
+                    for j in range(n)
+                ]
+                newc = [
+                    _convolve1d(colconv[j], gx * pow(u, i), axis=1)
+                    for i in range(n)
+                    for j in range(n - i)
+                ]
+                c.extend(newc)
+            return c
+
         v, u = np.mgrid[:kh, :kw]
         c = []
         for aGauss in self.gausslist:
@@ -204,7 +538,7 @@ class AlardLuptonStrategy(SubtractionStrategy):
                 center=aGauss["center"], sx=aGauss["sx"], sy=aGauss["sy"]
             )
             newc = [
-                signal.convolve2d(self.refimage, gaussk * aU * aV, mode="same")
+                _convolve2d(refimage, gaussk * aU * aV, self.conv_method)
                 for i, aU in enumerate(allus)
                 for aV in allvs[: n - i]
             ]
@@ -239,48 +573,18 @@ class AlardLuptonStrategy(SubtractionStrategy):
         self.kernel = kernel
         return self.kernel
 
-    def get_coeffs(self):
-        if self.coeffs is not None:
-            return self.coeffs
-        c = self.get_cmatrices()
-        if self.bkgdegree is not None:
-            c_bkg = self.get_cmatrices_background()
-            c.extend(c_bkg)
-
-        n_c = len(c)
-        m = np.zeros((n_c, n_c))
-        b = np.zeros(n_c)
-        if self.badpixmask is None:
-            for j, cj in enumerate(c):
-                for i in range(j, n_c):
-                    m[j, i] = np.vdot(cj, c[i])
-                    m[i, j] = m[j, i]
-                b[j] = np.vdot(self.image, cj)
-
-            # m = np.array([[(ci * cj).sum() for ci in c] for cj in c])
-            # b = np.array([(self.image * ci).sum() for ci in c])
-        else:
-            for j, cj in enumerate(c):
-                for i in range(j, n_c):
-                    m[j, i] = (c[i] * cj)[~self.badpixmask].sum()
-                    m[i, j] = m[j, i]
-                b[j] = (self.image * cj)[~self.badpixmask].sum()
-
-            # These next two lines take most of the computation time
-            # ~ m = np.array([[(ci * cj)[~self.badpixmask].sum() for ci in c] for cj in c])
-            # ~ b = np.array([(self.image * ci)[~self.badpixmask].sum() for ci in c])
-        self.coeffs = np.linalg.solve(m, b)
-        return self.coeffs
-
 
 class BramichStrategy(SubtractionStrategy):
-    def get_cmatrices(self):
+
+    def get_cmatrices(self, refimage=None):
+        if refimage is None:
+            refimage = self.refimage
         kh, kw = self.k_shape
-        h, w = self.refimage.shape
+        h, w = refimage.shape
         c = []
         for i in range(kh):
             for j in range(kw):
-                cij = np.zeros(self.refimage.shape)
+                cij = np.zeros(refimage.shape, dtype=refimage.dtype)
                 max_r = min(h, h - kh // 2 + i)
                 min_r = max(0, i - kh // 2)
                 max_c = min(w, w - kw // 2 + j)
@@ -289,7 +593,7 @@ class BramichStrategy(SubtractionStrategy):
                 min_r_ref = max(0, kh // 2 - i)
                 max_c_ref = min(w, w - j + kw // 2)
                 min_c_ref = max(0, kw // 2 - j)
-                cij[min_r:max_r, min_c:max_c] = self.refimage[
+                cij[min_r:max_r, min_c:max_c] = refimage[
                     min_r_ref:max_r_ref, min_c_ref:max_c_ref
                 ]
                 c.extend([cij])
@@ -309,48 +613,189 @@ class BramichStrategy(SubtractionStrategy):
         self.kernel = coeffs[: (kh * kw)].reshape(self.k_shape)
         return self.kernel
 
-    def get_coeffs(self):
-        if self.coeffs is not None:
-            return self.coeffs
-        c = self.get_cmatrices()
-        if self.bkgdegree is not None:
-            c_bkg = self.get_cmatrices_background()
-            c.extend(c_bkg)
-
-        n_c = len(c)
-        m = np.zeros((n_c, n_c))
-        b = np.zeros(n_c)
-        if self.badpixmask is None:
-            for j, cj in enumerate(c):
-                cj = np.asarray(cj, order="C")
-                for i in range(j, n_c):
-                    m[j, i] = np.tensordot(cj, np.asarray(c[i], order="C"))
-                    m[i, j] = m[j, i]
-                b[j] = np.vdot(self.image, cj.flatten())
-            # ~ m = np.array([[(ci * cj).sum() for ci in c] for cj in c])
-            # ~ b = np.array([(self.image * ci).sum() for ci in c])
-        else:
-            for j, cj in enumerate(c):
-                for i in range(j, n_c):
-                    m[j, i] = (c[i] * cj)[~self.badpixmask].sum()
-                    m[i, j] = m[j, i]
-                b[j] = (self.image * cj)[~self.badpixmask].sum()
-
-            # These next two lines take most of the computation time
-            # ~ m = np.array([[(ci * cj)[~self.badpixmask].sum() for ci in c] for cj in c])
-            # ~ b = np.array([(self.image * ci)[~self.badpixmask].sum() for ci in c])
-        self.coeffs = np.linalg.solve(m, b)
-        return self.coeffs
+    def get_correlation_system(self):
+        """Build the normal equations from correlations of the images.
+
+        Only small tables per lag are kept in memory, no shifted copies.
+        """
+        return self.get_correlation_matrix(), self.get_correlation_vector()
+
+    def get_correlation_matrix(self):
+        """Return M from correlations of the reference image.
+
+        Each entry of the kernel block of M is the autocorrelation of the
+        reference image at the lag between two kernel pixels, minus the
+        products that fall outside the image for that pair of shifts.
+        """
+        kh, kw = self.k_shape
+        h, w = self.h, self.w
+        hy, hx = kh // 2, kw // 2
+        # No basis images are stored here, so this is always done in float64
+        ref = self.refimage.astype("float64")
+
+        # Shifts of the kernel pixels in the same order as get_cmatrices
+        shift_r, shift_c = np.mgrid[-hy : kh - hy, -hx : kw - hx]
+        shift_r, shift_c = shift_r.ravel(), shift_c.ravel()
+
+        # Sums of ref[y] * ref[y + d] over the full overlap for each lag d
+        total = _correlation_lags(ref, ref, kh - 1, kw - 1)
+
+        # Partial sums over the first/last rows and columns of each overlap,
+        # needed to trim the pixels where a shifted copy would be zero.
+        n_ly, n_lx = 2 * kh - 1, 2 * kw - 1
+        top = np.zeros((n_ly, n_lx, hy + 1))
+        bottom = np.zeros((n_ly, n_lx, hy + 1))
+        left = np.zeros((n_ly, n_lx, hx + 1))
+        right = np.zeros((n_ly, n_lx, hx + 1))
+        corners = np.zeros((4, n_ly, n_lx, hy + 1, hx + 1))
+        for dy in range(-(kh - 1), kh):
+            sly_a, sly_b = _overlap_slices(h, dy)
+            for dx in range(-(kw - 1), kw):
+                slx_a, slx_b = _overlap_slices(w, dx)
+                a = ref[sly_a, slx_a]
+                b = ref[sly_b, slx_b]
+                ly, lx = dy + kh - 1, dx + kw - 1
+                n_r, n_c = a.shape
+                rows_top = np.einsum("ij,ij->i", a[:hy], b[:hy])
+                rows_bot = np.einsum("ij,ij->i", a[n_r - hy :], b[n_r - hy :])
+                cols_lft = np.einsum("ij,ij->j", a[:, :hx], b[:, :hx])
+                cols_rgt = np.einsum(
+                    "ij,ij->j", a[:, n_c - hx :], b[:, n_c - hx :]
+                )
+                top[ly, lx, 1:] = np.cumsum(rows_top)
+                bottom[ly, lx, 1:] = np.cumsum(rows_bot[::-1])
+                left[ly, lx, 1:] = np.cumsum(cols_lft)
+                right[ly, lx, 1:] = np.cumsum(cols_rgt[::-1])
+                for ind, (slr, slc, rr, rc) in enumerate(
+                    (
+                        (slice(None, hy), slice(None, hx), 1, 1),
+                        (slice(None, hy), slice(n_c - hx, None), 1, -1),
+                        (slice(n_r - hy, None), slice(None, hx), -1, 1),
+                        (slice(n_r - hy, None), slice(n_c - hx, None), -1, -1),
+                    )
+                ):
+                    block = (a[slr, slc] * b[slr, slc])[::rr, ::rc]
+                    corners[ind, ly, lx, 1:, 1:] = block.cumsum(0).cumsum(1)
+
+        # For the pair of shifts (s, t) with lag d = s - t, the sum runs
+        # over y with y, y + d and y + s inside the image.
+        sr, tr = shift_r[:, None], shift_r[None, :]
+        sc, tc = shift_c[:, None], shift_c[None, :]
+        dr, dc = sr - tr, sc - tc
+        ly, lx = dr + kh - 1, dc + kw - 1
+        zero = np.zeros_like(dr)
+        t_top = np.maximum(np.maximum(zero, -dr), -sr) - np.maximum(zero, -dr)
+        t_bot = np.minimum(zero, -dr) - np.minimum(np.minimum(zero, -dr), -sr)
+        t_lft = np.maximum(np.maximum(zero, -dc), -sc) - np.maximum(zero, -dc)
+        t_rgt = np.minimum(zero, -dc) - np.minimum(np.minimum(zero, -dc), -sc)
+        m_k = (
+            total[ly, lx]
+            - top[ly, lx, t_top]
+            - bottom[ly, lx, t_bot]
+            - left[ly, lx, t_lft]
+            - right[ly, lx, t_rgt]
+            + corners[0, ly, lx, t_top, t_lft]
+            + corners[1, ly, lx, t_top, t_rgt]
+            + corners[2, ly, lx, t_bot, t_lft]
+            + corners[3, ly, lx, t_bot, t_rgt]
+        )
+        m_k = np.triu(m_k) + np.triu(m_k, 1).T
+
+        if self.bkgdegree is None:
+            return m_k
+
+        # Moments x^i y^j of each shifted reference over its overlap. The
+        # product along x is shared by all the shifts in the same column.
+        pow_y, pow_x = _background_powers(self.bkgdegree)
+        ypow = _powers(np.arange(h), self.bkgdegree)
+        xpow = _powers(np.arange(w), self.bkgdegree)
+        m_kb = np.empty((kh * kw, len(pow_y)))
+        for j in range(kw):
+            slx_a, slx_b = _overlap_slices(w, j - hx)
+            ref_x = ref[:, slx_a].dot(xpow[slx_b])
+            for i in range(kh):
+                sly_a, sly_b = _overlap_slices(h, i - hy)
+                moments = ypow[sly_b].T.dot(ref_x[sly_a])
+                m_kb[i * kw + j] = moments[pow_y, pow_x]
+        return np.block([[m_k, m_kb], [m_kb.T, self.get_background_block()]])
+
+    def get_correlation_vector(self):
+        "Return b, the cross-correlation of reference and science image."
+        kh, kw = self.k_shape
+        ref = self.refimage.astype("float64")
+        image = self.image.astype("float64")
+        b_k = _correlation_lags(ref, image, kh // 2, kw // 2).ravel()
+        if self.bkgdegree is None:
+            return b_k
+        pow_y, pow_x = _background_powers(self.bkgdegree)
+        moments = self.get_background_moments(image.ravel(), self.bkgdegree)
+        return np.concatenate((b_k, moments[pow_y, pow_x]))
+
+    def get_basis_matrix(self):
+        # Shifted copies of refimage, sampled only on the good pixels
+        kh, kw = self.k_shape
+        h, w = self.h, self.w
+        rows, cols = self.get_fit_pixels()
+        cmat = np.zeros((kh * kw, len(rows)), dtype=self.dtype)
+        for i in range(kh):
+            for j in range(kw):
+                r_ref = rows - (i - kh // 2)
+                c_ref = cols - (j - kw // 2)
+                inside = (
+                    (r_ref >= 0) & (r_ref < h) & (c_ref >= 0) & (c_ref < w)
+                )
+                cmat[i * kw + j, inside] = self.refimage[
+                    r_ref[inside], c_ref[inside]
+                ]
+        return cmat
+
+    def use_correlation(self):
+        kh, kw = self.k_shape
+        # The edge corrections assume opposite image borders don't overlap
+        # within a kernel width.
+        fits_corr = self.h >= 2 * (kh - 1) and self.w >= 2 * (kw - 1)
+        return self.fitmask is None and fits_corr
+
+    def get_normal_matrix(self):
+        if self.use_correlation():
+
+            def build():
+                self.notify("matrix")
+                return self.get_correlation_matrix()
+
+            return self._reference_product("m", build)
+        return super(BramichStrategy, self).get_normal_matrix()
+
+    def get_normal_vector(self):
+        if self.use_correlation():
+            return self.get_correlation_vector()
+        return super(BramichStrategy, self).get_normal_vector()
 
 
 class AdaptiveBramichStrategy(SubtractionStrategy):
-    def __init__(self, image, refimage, kernelshape, bkgdegree, poly_degree=2):
+
+    def __init__(
+        self,
+        image,
+        refimage,
+        kernelshape,
+        bkgdegree,
+        poly_degree=2,
+        n_threads=0,
+        low_memory=False,
+        solver="lu",
+        **kwargs
+    ):
         self.poly_deg = poly_degree
+        self.n_threads = n_threads
+        self.low_memory = low_memory
         self.poly_dof = (poly_degree + 1) * (poly_degree + 2) // 2
         self.k_side = kernelshape[0]
 
+        # M is often nearly singular (few sources for many polynomial
+        # terms), where Cholesky fails but LU still gives the fit
         super(AdaptiveBramichStrategy, self).__init__(
-            image, refimage, kernelshape, bkgdegree
+            image, refimage, kernelshape, bkgdegree, solver=solver, **kwargs
         )
 
     def get_optimal_image(self):
@@ -360,8 +805,10 @@ class AdaptiveBramichStrategy(SubtractionStrategy):
             return self.optimal_image
         import varconv
 
+        kernel = self.get_kernel()
+        self.notify("convolve")
         opt_image = varconv.convolve2d_adaptive(
-            self.refimage, self.get_kernel(), self.poly_deg
+            self.refimage, kernel, self.poly_deg
         )
         if self.bkgdegree is not None:
             opt_image += self.get_background()
@@ -381,22 +828,257 @@ class AdaptiveBramichStrategy(SubtractionStrategy):
         self.kernel = coeffs[:k_dof].reshape((ks, ks, self.poly_dof))
         return self.kernel
 
-    def get_coeffs(self):
-        if self.coeffs is not None:
-            return self.coeffs
-        import varconv
-
-        m, b = varconv.gen_matrix_system(
+    def varconv_args(self):
+        "Return the arguments for varconv.gen_matrix_system."
+        block_rows = 0
+        if self.low_memory:
+            # Build only as many rows of the basis images as fit the buffer
+            bkgdof = 0
+            if self.bkgdegree is not None:
+                bkgdof = (self.bkgdegree + 1) * (self.bkgdegree + 2) // 2
+            total_dof = self.k_side * self.k_side * self.poly_dof + bkgdof
+            block_rows = max(1, _LOW_MEMORY_BLOCK_SIZE // (total_dof * self.w))
+        if self.stamp_slices is not None:
+            # One row at a time, so rows off the stamps are skipped
+            block_rows = 1
+        return (
             self.image,
             self.refimage,
-            self.badpixmask is not None,
-            self.badpixmask,
+            self.fitmask is not None,
+            self.fitmask,
             self.k_side,
             self.poly_deg,
-            self.bkgdegree or -1,
+            -1 if self.bkgdegree is None else self.bkgdegree,
+            self.n_threads,
+            block_rows,
+            self.dtype == np.float32,
         )
-        self.coeffs = np.linalg.solve(m, b)
-        return self.coeffs
+
+    def get_matrix_system(self):
+        import varconv
+
+        if "m" in self.refcache:
+            return self.refcache["m"], self.get_normal_vector()
+        self.notify("matrix")
+        m, b = varconv.gen_matrix_system(*self.varconv_args())
+        self.refcache["m"] = m
+        return m, b
+
+    def get_normal_matrix(self):
+        if "m" not in self.refcache:
+            self.get_matrix_system()
+        return self.refcache["m"]
+
+    def get_normal_vector(self):
+        import varconv
+
+        return varconv.gen_vector_b(*self.varconv_args())
+
+
+_CONV_METHODS = ("direct", "separable", "fft", "auto")
+
+_SOLVERS = ("cholesky", "lu", "lstsq", "ridge")
+
+
+# Number of pixels of float32 basis images converted to float64 at a time.
+_DOT_CHUNK = 4096
+
+
+def _accumulated_dot(a, b=None):
+    """Return ``a.dot(b)``, or ``a.dot(a.T)`` if ``b`` is ``None``, in float64.
+
+    Float32 input is converted to float64 in chunks of ``_DOT_CHUNK``
+    along the summed axis, so the products are summed in float64 while the
+    arrays stay in float32.
+    """
+    if a.dtype == np.float64 and (b is None or b.dtype == np.float64):
+        return a.dot(a.T if b is None else b)
+    n = a.shape[-1]
+    result = None
+    for start in range(0, n, _DOT_CHUNK):
+        a_chunk = a[..., start : start + _DOT_CHUNK].astype("float64")
+        if b is None:
+            prod = a_chunk.dot(a_chunk.T)
+        else:
+            prod = a_chunk.dot(b[start : start + _DOT_CHUNK])
+        result = prod if result is None else result + prod
+    return result
+
+
+def _powers(v, degree):
+    "Return the powers 0 to ``degree`` of the 1-D ``v`` as its columns."
+    return np.vander(np.asarray(v, dtype="float"), degree + 1, increasing=True)
+
+
+def _background_powers(degree):
+    """Return the arrays of y and x powers of each background basis term,
+    in the order of the background coefficients."""
+    pow_y = [j for i in range(degree + 1) for j in range(degree + 1 - i)]
+    pow_x = [i for i in range(degree + 1) for j in range(degree + 1 - i)]
+    return np.array(pow_y), np.array(pow_x)
+
+
+class _NormalSolver(object):
+    """Factorization of the normal matrix M, reusable for many vectors b.
+
+    ``solver`` is one of:
+
+        * ``"cholesky"``: Cholesky factorization (M is symmetric positive
+          definite), about half the cost of LU.
+        * ``"lu"``: LU factorization with partial pivoting.
+        * ``"lstsq"``: Minimum norm least squares from the SVD of M, for
+          singular or nearly singular systems.
+        * ``"ridge"``: Cholesky factorization of M + lambda I, with lambda
+          ``regularization`` times the mean of the diagonal of M.
+
+    M is scaled to unit diagonal (Jacobi scaling) before it's factored,
+    since the polynomial terms of large images make its diagonal span many
+    orders of magnitude. ``condition_number`` is that of the scaled M.
+
+    If the Cholesky or LU factorization fails because M is singular, this
+    warns and falls back to ``"lstsq"``.
+    """
+
+    def __init__(self, m, solver="cholesky", regularization=1e-8):
+        if solver not in _SOLVERS:
+            raise ValueError("No solver named {}".format(solver))
+        if solver == "ridge":
+            lam = regularization * np.trace(m) / len(m)
+            m = m + lam * np.identity(len(m))
+        diag = np.diag(m)
+        self.scale = np.ones(len(m))
+        positive = diag > 0
+        self.scale[positive] = 1.0 / np.sqrt(diag[positive])
+        m = self.scale[:, np.newaxis] * m * self.scale
+        anorm = np.abs(m).sum(axis=0).max()
+        self.method = "cholesky" if solver == "ridge" else solver
+        self.factor = None
+        rcond = 0.0
+        try:
+            if self.method == "cholesky":
+                self.factor = linalg.cho_factor(m)
+                rcond, info = linalg.lapack.dpocon(self.factor[0], anorm)
+            elif self.method == "lu":
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", linalg.LinAlgWarning)
+                    self.factor = linalg.lu_factor(m)
+                rcond, info = linalg.lapack.dgecon(self.factor[0], anorm)
+                if rcond == 0.0:
+                    raise linalg.LinAlgError("Singular matrix")
+        except linalg.LinAlgError:
+            warnings.warn(
+                "The {} factorization of the normal matrix failed, "
+                "falling back to lstsq.".format(self.method),
+                linalg.LinAlgWarning,
+            )
+            self.method = "lstsq"
+        if self.method == "lstsq":
+            u, sv, vt = linalg.svd(m)
+            keep = sv > np.finfo(float).eps * len(m) * sv[0]
+            self.factor = (u[:, keep], sv[keep], vt[keep])
+            rcond = sv[-1] / sv[0] if sv[0] > 0 else 0.0
+        self.condition_number = 1.0 / rcond if rcond > 0 else np.inf
+
+    def solve(self, b):
+        "Solve M x = b, where b may be a matrix with one column per system."
+        scale = self.scale.reshape((-1,) + (1,) * (np.ndim(b) - 1))
+        return scale * self._solve_scaled(scale * b)
+
+    def _solve_scaled(self, b):
+        if self.method == "cholesky":
+            return linalg.cho_solve(self.factor, b)
+        if self.method == "lu":
+            return linalg.lu_solve(self.factor, b)
+        u, sv, vt = self.factor
+        ub = u.T.dot(b)
+        return vt.T.dot(ub / sv.reshape((-1,) + (1,) * (ub.ndim - 1)))
+
+
+def _convolve1d(image, weights, axis):
+    "Convolve along ``axis`` with zeros outside, as ``convolve2d`` ``same``."
+    return ndimage.convolve1d(
+        image, weights, axis=axis, output=_float_type(image), mode="constant"
+    )
+
+
+def _float_type(image):
+    "Return float32 for float32 images and float64 for anything else."
+    return np.result_type(image, np.float32)
+
+
+def _separable_factors(kernel, rtol=1e-12):
+    """Return a list of (column, row) 1-D factors whose outer products add up
+    to ``kernel``, dropping singular values below ``rtol`` times the largest.
+    """
+    u, s, vt = np.linalg.svd(kernel)
+    rank = np.count_nonzero(s > rtol * s[0])
+    return [(u[:, i] * s[i], vt[i]) for i in range(rank)]
+
+
+def _convolve2d(image, kernel, method="auto"):
+    """Return the convolution of ``image`` and ``kernel`` with the same shape
+    as ``image`` (like ``signal.convolve2d`` with ``mode="same"``).
+
+    ``method`` is one of:
+
+        * ``"direct"``: direct summation, O(N K).
+        * ``"separable"``: two 1-D convolutions for each separable term of
+          the kernel (from its SVD), O(N r (kh + kw)) for rank r.
+        * ``"fft"``: FFT convolution, O(N log N).
+        * ``"auto"``: separable if the kernel rank makes it cheaper than
+          direct, otherwise direct or FFT as chosen by
+          ``scipy.signal.choose_conv_method`` from image and kernel size.
+    """
+    if method in ("separable", "auto"):
+        kh, kw = kernel.shape
+        factors = _separable_factors(kernel)
+        if method == "separable" or len(factors) * (kh + kw) < kh * kw:
+            conv = np.zeros(image.shape, dtype=_float_type(image))
+            for k_col, k_row in factors:
+                conv += _convolve1d(
+                    _convolve1d(image, k_col, axis=0), k_row, axis=1
+                )
+            return conv
+        method = signal.choose_conv_method(image, kernel, mode="same")
+    # Keep float32 images in float32
+    kernel = np.asarray(kernel, dtype=_float_type(image))
+    if method == "fft":
+        return signal.fftconvolve(image, kernel, mode="same")
+    return signal.convolve2d(image, kernel, mode="same")
+
+
+# Number of doubles in the basis image buffer of AdaptiveBramich low_memory.
+_LOW_MEMORY_BLOCK_SIZE = 2**22
+
+# Above this many lags per log2(image size) the correlation is done with FFTs.
+_FFT_LAGS_PER_LOG2 = 32
+
+
+def _overlap_slices(n, d):
+    "Return slices ``sa``, ``sb`` of a length ``n`` axis with ``sb = sa + d``."
+    return slice(max(0, -d), min(n, n - d)), slice(max(0, d), min(n, n + d))
+
+
+def _correlation_lags(a, b, max_dy, max_dx):
+    """Return the correlation of ``a`` and ``b`` for small lags.
+
+    Element ``[dy + max_dy, dx + max_dx]`` is the sum of
+    ``a[y] * b[y + (dy, dx)]`` over all ``y`` where both are defined.
+    """
+    h, w = a.shape
+    n_lags = (2 * max_dy + 1) * (2 * max_dx + 1)
+    if n_lags > _FFT_LAGS_PER_LOG2 * np.log2(a.size):
+        full = signal.fftconvolve(b, a[::-1, ::-1], mode="full")
+        return full[h - 1 - max_dy : h + max_dy, w - 1 - max_dx : w + max_dx]
+    corr = np.empty((2 * max_dy + 1, 2 * max_dx + 1))
+    for dy in range(-max_dy, max_dy + 1):
+        sly_a, sly_b = _overlap_slices(h, dy)
+        for dx in range(-max_dx, max_dx + 1):
+            slx_a, slx_b = _overlap_slices(w, dx)
+            corr[dy + max_dy, dx + max_dx] = np.einsum(
+                "ij,ij->", a[sly_a, slx_a], b[sly_b, slx_b]
+            )
+    return corr
 
 
 def convolve2d_adaptive(image, kernel, poly_degree):
@@ -417,19 +1099,666 @@ def eval_adpative_kernel(kernel, x, y):
     "Return the adaptive kernel at position (x, y) = (col, row)."
     if kernel.ndim == 2:
         return kernel
+    return eval_adaptive_kernel_grid(kernel, [x], [y])[0]
+
+
+def eval_adaptive_kernel_grid(kernel, xs, ys):
+    """Return the adaptive kernel at the positions (xs[i], ys[i]) =
+    (col, row), as an array of shape (N, kh, kw).
+
+    The monomials of every position are multiplied by the kernel
+    coefficients at once, instead of calling ``eval_adpative_kernel`` for
+    each position. A constant kernel (kh, kw) is repeated N times.
+    """
+    xs = np.asarray(xs, dtype="float").ravel()
+    ys = np.asarray(ys, dtype="float").ravel()
+    if xs.shape != ys.shape:
+        raise ValueError("xs and ys must have the same size")
+    if kernel.ndim == 2:
+        return np.repeat(kernel[np.newaxis], len(xs), axis=0)
 
     kh, kw, dof = kernel.shape
     # The conversion from degrees of freedom (dof) to the polynomial degree
     # The last 0.5 is to round to nearest integer
     deg = int(-1.5 + np.sqrt(1 + 8 * dof) / 2 + 0.5)
-    k_rolled = np.rollaxis(kernel, 2, 0)
-    k_xy = np.zeros((kh, kw))
-    d = 0
-    for powx in range(deg + 1):
-        for powy in range(deg - powx + 1):
-            k_xy += k_rolled[d] * np.power(y, powy) * np.power(x, powx)
-            d += 1
-    return k_xy
+    # x^powx * y^powy at each position, in the kernel coefficient order
+    powx, powy = np.array(
+        [
+            (powx, powy)
+            for powx in range(deg + 1)
+            for powy in range(deg - powx + 1)
+        ]
+    ).T
+    monomials = xs[:, np.newaxis] ** powx * ys[:, np.newaxis] ** powy
+    return monomials.dot(kernel.reshape(kh * kw, dof).T).reshape(
+        len(xs), kh, kw
+    )
+
+
+def find_stamps(refimage, n_stamps, stamp_shape=(21, 21), saturation=None):
+    """Return the (row, column) centers of up to ``n_stamps`` stamps around
+    the brightest sources in ``refimage``, brightest first.
+
+    Stamp centers are local maxima within a window of ``stamp_shape``,
+    above the image median, with the whole stamp inside the image.
+    Sources at or above ``saturation`` and masked pixels are left out.
+    """
+    data = np.ma.filled(np.ma.asarray(refimage, dtype="float"), -np.inf)
+    h, w = data.shape
+    sh, sw = stamp_shape
+    peaks = data == ndimage.maximum_filter(
+        data, size=stamp_shape, mode="constant", cval=-np.inf
+    )
+    peaks &= data > np.median(data[np.isfinite(data)])
+    inside = np.zeros((h, w), dtype="bool")
+    inside[sh // 2 : h - sh // 2, sw // 2 : w - sw // 2] = True
+    peaks &= inside
+    if saturation is not None:
+        peaks &= data < saturation
+    rows, cols = np.nonzero(peaks)
+    brightest = np.argsort(data[rows, cols], kind="stable")[::-1][:n_stamps]
+    return list(zip(rows[brightest], cols[brightest]))
+
+
+def _stamps_in_region(stamps, sly, slx):
+    "Return the stamp centers inside the slices, relative to their start."
+    return [
+        (row - sly.start, col - slx.start)
+        for row, col in stamps
+        if sly.start <= row < sly.stop and slx.start <= col < slx.stop
+    ]
+
+
+def _output_array(out, shape, masked=False):
+    "Return ``out`` after checking its shape, or a new array if it's None."
+    if out is None:
+        return np.ma.empty(shape) if masked else np.empty(shape)
+    if tuple(out.shape) != tuple(shape):
+        raise ValueError(
+            "Output array has shape {}, expected {}".format(out.shape, shape)
+        )
+    return out
+
+
+def _bounded_completed(executor, fn, args_iter, max_pending):
+    """Submit ``fn(*args)`` for each ``args`` in ``args_iter`` to
+    ``executor``, with at most ``max_pending`` running at once, and yield
+    ``(index, result)`` as they finish."""
+    from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+
+    pending = {}
+    try:
+        for ind, args in enumerate(args_iter):
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    yield pending.pop(fut), fut.result()
+            pending[executor.submit(fn, *args)] = ind
+        for fut in as_completed(pending):
+            yield pending.pop(fut), fut.result()
+    finally:
+        # If the consumer stops early, don't start the remaining work
+        for fut in pending:
+            fut.cancel()
+
+
+_ALL_STRATEGIES = {
+    "AdaptiveBramich": AdaptiveBramichStrategy,
+    "Bramich": BramichStrategy,
+    "Alard-Lupton": AlardLuptonStrategy,
+}
+
+
+def _get_strategy(method, kernelshape):
+    "Check the method and kernel shape and return the strategy class."
+    kh, kw = kernelshape
+    if (kw % 2 == 0) or (kh % 2 == 0):
+        raise EvenSideKernelError("Kernel sides must be odd.")
+    try:
+        return _ALL_STRATEGIES[method]
+    except KeyError:
+        raise ValueError("No method named {}".format(method))
+
+
+def _strategy_results(subt_strat):
+    "Return difference, optimal image, kernel and background of a strategy."
+    opt_image = subt_strat.get_optimal_image()
+    kernel = subt_strat.get_kernel()
+    background = subt_strat.get_background()
+    difference = subt_strat.get_difference()
+    subt_strat.notify("done")
+    return difference, opt_image, kernel, background
+
+
+def _subtract_stamp(
+    DiffStrategy, image, refimage, kernelshape, bkgdegree, kwargs
+):
+    """Solve one image (or grid stamp) and return its difference, optimal
+    image, kernel and background.
+
+    This is a module-level function so it can be sent to process pools.
+    """
+    subt_strat = DiffStrategy(
+        image, refimage, kernelshape, bkgdegree, **kwargs
+    )
+    return _strategy_results(subt_strat)
+
+
+def _subtract_stamp_profiled(
+    DiffStrategy, image, refimage, kernelshape, bkgdegree, kwargs
+):
+    """Same as ``_subtract_stamp``, and also return the profile records of
+    the stamp, collected in the ``_StampProfile`` in ``kwargs``."""
+    results = _subtract_stamp(
+        DiffStrategy, image, refimage, kernelshape, bkgdegree, kwargs
+    )
+    return results, kwargs["profile"].records
+
+
+_logger = logging.getLogger(__name__)
+
+
+class ProfileReport(object):
+    """Wall time and memory of each phase of each subtraction.
+
+    Pass it as ``profile`` to ``optimal_system`` (or any function that takes
+    the same arguments). Each phase of each grid element adds a record to
+    ``records``, a dictionary with keys:
+
+        * stamp: the grid element index, or ``None`` without a grid.
+        * phase: ``"basis"``, ``"matrix"``, ``"solve"`` or ``"convolve"``.
+        * seconds: the wall time of the phase.
+        * shape: the shape of what the phase built: the basis matrix, M,
+          the coefficients or the optimal image. ``None`` if it isn't kept,
+          as with the AdaptiveBramich basis images.
+        * nbytes: the memory taken by that product.
+        * condition_number: only in ``"solve"`` records, the estimate of the
+          condition number of M from ``get_condition_number``.
+
+    Phases whose products were cached (e.g. M in a ``ReferenceContext``) are
+    not recorded. Each record is also logged, with the record in the
+    ``ois_profile`` attribute of the log record for metrics handlers.
+
+    Args:
+        logger: The ``logging.Logger`` to log to. Default: the ``ois``
+            logger.
+
+        level: The logging level of the records. Default: ``logging.DEBUG``.
+
+    Example::
+
+        report = ProfileReport()
+        optimal_system(image, refimage, gridshape=(2, 2), profile=report)
+        print(report)
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = _logger if logger is None else logger
+        self.level = level
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record, stamp=None):
+        "Add ``record``, for grid element ``stamp``, and log it."
+        record = dict(record, stamp=stamp)
+        with self._lock:
+            self.records.append(record)
+        self.logger.log(
+            self.level,
+            "stamp %s %s: %.6f s, shape %s, %d bytes",
+            stamp,
+            record["phase"],
+            record["seconds"],
+            record["shape"],
+            record["nbytes"],
+            extra={"ois_profile": record},
+        )
+
+    def totals(self):
+        """Return a dictionary with the total seconds and bytes of each
+        phase over all grid elements."""
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(
+                record["phase"], {"seconds": 0.0, "nbytes": 0}
+            )
+            total["seconds"] += record["seconds"]
+            total["nbytes"] += record["nbytes"]
+        return totals
+
+    def __str__(self):
+        lines = [
+            "{:>6} {:>9} {:>12} {:>14}  shape".format(
+                "stamp", "phase", "seconds", "bytes"
+            )
+        ]
+        for record in self.records:
+            lines.append(
+                "{:>6} {:>9} {:>12.6f} {:>14}  {}".format(
+                    str(record["stamp"]),
+                    record["phase"],
+                    record["seconds"],
+                    record["nbytes"],
+                    record["shape"],
+                )
+            )
+        return "\n".join(lines)
+
+
+def _check_profile(profile):
+    "Raise TypeError if ``profile`` is not None or a ``ProfileReport``."
+    if profile is not None and not callable(getattr(profile, "add", None)):
+        raise TypeError(
+            "profile must be a ProfileReport, not {}".format(
+                type(profile).__name__
+            )
+        )
+
+
+class _StampProfile(object):
+    """Collects the records of one grid element. Unlike ``ProfileReport``
+    it can be sent to process pools."""
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+
+
+def _same_mask(mask_a, mask_b):
+    if mask_a is None or mask_b is None:
+        return mask_a is None and mask_b is None
+    return np.array_equal(mask_a, mask_b)
+
+
+class ReferenceContext(object):
+    """Reference image products shared by many subtractions against it.
+
+    The normal equations matrix M (and the basis images needed for b)
+    depend only on the reference image, its mask, the kernel and the
+    method. They are computed and factorized once here, so each science
+    image only costs the vector b and two triangular solves. The estimated
+    condition number of M is in ``condition_number``.
+
+    Args:
+        refimage, kernelshape, bkgdegree, method, kwargs: Same as for
+            ``optimal_system``.
+
+    Example::
+
+        context = ReferenceContext(refimage, kernelshape=(11, 11))
+        for image in images:
+            diff, opt_image, kernel, bkg = context.subtract(image)
+
+    Science images with a mask of their own change M; those are solved
+    from scratch (correctly, but without reuse).
+    """
+
+    def __init__(
+        self,
+        refimage,
+        kernelshape=(11, 11),
+        bkgdegree=None,
+        method="Bramich",
+        **kwargs
+    ):
+        self.DiffStrategy = _get_strategy(method, kernelshape)
+        self.refimage = refimage
+        self.kernelshape = kernelshape
+        self.bkgdegree = bkgdegree
+        self.kwargs = kwargs
+
+        # M does not depend on the science image, any placeholder will do
+        ref_strat = self.DiffStrategy(
+            np.zeros(np.shape(refimage)),
+            refimage,
+            kernelshape,
+            bkgdegree,
+            **kwargs
+        )
+        self.badpixmask = ref_strat.badpixmask
+        self.refcache = ref_strat.refcache
+        self.condition_number = ref_strat.get_condition_number()
+
+    def strategy(self, image):
+        "Return a subtraction strategy for ``image`` using the cached products."
+        subt_strat = self.DiffStrategy(
+            image,
+            self.refimage,
+            self.kernelshape,
+            self.bkgdegree,
+            **self.kwargs
+        )
+        if _same_mask(subt_strat.badpixmask, self.badpixmask):
+            subt_strat.refcache = self.refcache
+        return subt_strat
+
+    def subtract(self, image):
+        """Subtract the reference from ``image``.
+
+        Returns:
+            difference, optimal_image, kernel, background
+        """
+        return _strategy_results(self.strategy(image))
+
+    def solve(self, b):
+        "Solve M x = b, where b may be a matrix with one column per image."
+        return self.refcache["solver"].solve(b)
+
+    def subtract_batch(self, images):
+        """Subtract the reference from every image in ``images``.
+
+        The vectors b of all images that share the cached M are stacked as
+        the columns of one right-hand side and solved together.
+
+        Returns:
+            differences, optimal_images, kernels, backgrounds, each stacked
+            along a new first axis.
+        """
+        strategies = [self.strategy(image) for image in images]
+        shared = [st for st in strategies if st.refcache is self.refcache]
+        if shared:
+            bmat = np.column_stack([st.get_normal_vector() for st in shared])
+            coeffs = self.solve(bmat)
+            for st, st_coeffs in zip(shared, coeffs.T):
+                st.coeffs = st_coeffs
+        results = [_strategy_results(st) for st in strategies]
+        return tuple(_stack(arrays) for arrays in zip(*results))
+
+
+def _stack(arrays):
+    "Stack arrays along a new first axis, keeping masks if there are any."
+    if any(isinstance(an_array, np.ma.MaskedArray) for an_array in arrays):
+        return np.ma.stack(arrays)
+    return np.stack(arrays)
+
+
+def optimal_system_batch(
+    images,
+    refimage,
+    kernelshape=(11, 11),
+    bkgdegree=None,
+    method="Bramich",
+    **kwargs
+):
+    """Do Optimal Image Subtraction of many images against one reference.
+
+    The normal matrix M is built and factorized once for the reference and
+    all images are solved together with a matrix right-hand side. This is
+    much faster than calling ``optimal_system`` for each image.
+
+    Args:
+        images: A 3-D array with one image per element of its first axis,
+            or any iterable of 2-D images.
+
+        refimage, kernelshape, bkgdegree, method, kwargs: Same as for
+            ``optimal_system``. ``gridshape`` is not supported.
+
+    Returns:
+        differences, optimal_images, kernels, backgrounds, each stacked
+        along a new first axis in the order of ``images``.
+
+    Raises:
+        EvenSideKernelError: If any dimension of ``kernelshape`` is even.
+        ValueError: If a ``gridshape`` other than ``(1, 1)`` is given.
+
+    """
+    gridshape = kwargs.pop("gridshape", None)
+    if gridshape is not None and tuple(gridshape) != (1, 1):
+        raise ValueError("optimal_system_batch does not support gridshape")
+    context = ReferenceContext(
+        refimage, kernelshape, bkgdegree, method, **kwargs
+    )
+    return context.subtract_batch(images)
+
+
+def _grid_slices(shape, gridshape, kernelshape):
+    """Return, for each grid element in row-major order, its slices in the
+    image, its slices with a border of the kernel spill, and the slices to
+    crop that border from the results."""
+    kh, kw = kernelshape
+    ny, nx = gridshape
+    h, w = shape
+
+    # normal slices with no border
+    stamps_y = [slice(h * i // ny, h * (i + 1) // ny, None) for i in range(ny)]
+    stamps_x = [slice(w * i // nx, w * (i + 1) // nx, None) for i in range(nx)]
+
+    # slices with borders where possible
+    # Slices should be in (h * i // ny, h * (i + 1) // ny) but we add and
+    # subtract the kernel spill k_spill and then we clip to keep it inside
+    # image boundaries.
+    k_spill = (kh - 1) // 2
+    slc_wborder_y = [
+        slice(
+            np.clip(h * i // ny - k_spill, 0, h),
+            np.clip(h * (i + 1) // ny + k_spill, 0, h),
+            None,
+        )
+        for i in range(ny)
+    ]
+    slc_wborder_x = [
+        slice(
+            np.clip(w * i // nx - k_spill, 0, w),
+            np.clip(w * (i + 1) // nx + k_spill, 0, w),
+            None,
+        )
+        for i in range(nx)
+    ]
+
+    # After we do the subtraction we need to crop the extra borders in the
+    # stamps.
+    # The recover_slices are the prescription for what to crop on each stamp.
+    recover_slices = []
+    for i in range(ny):
+        start_border_y = slc_wborder_y[i].start
+        stop_border_y = slc_wborder_y[i].stop
+        # Slice should end at h * (i + 1) // ny, any other pixels should
+        # be trimmed. sly_stop is either negative or 0.
+        # In the special case where 0 pixels need to be trimmed
+        # we use None so slice goes to the end.
+        sly_stop = (h * (i + 1) // ny - stop_border_y) or None
+        # Same with initial pixels, but sly_start is positive or 0.
+        # Zero is not a special case now (0 is array initial pixel)
+        sly_start = h * i // ny - start_border_y
+        sly = slice(sly_start, sly_stop, None)
+        for j in range(nx):
+            start_border_x = slc_wborder_x[j].start
+            stop_border_x = slc_wborder_x[j].stop
+            slx_stop = (w * (j + 1) // nx - stop_border_x) or None
+            slx_start = w * j // nx - start_border_x
+            slx = slice(slx_start, slx_stop, None)
+            recover_slices.append((sly, slx))
+
+    stamp_slices = [(sly, slx) for sly in stamps_y for slx in stamps_x]
+    cell_slices = [
+        (sly, slx) for sly in slc_wborder_y for slx in slc_wborder_x
+    ]
+    return stamp_slices, cell_slices, recover_slices
+
+
+def _center_kernels(kernels, stamp_slices, cell_slices):
+    """Return the kernel of each grid element at the center of the element,
+    as an array of shape (n_elements, kh, kw).
+
+    Adaptive kernels are in the coordinates of their cell (the element with
+    its border) and are evaluated there."""
+    center_kernels = []
+    for ki, (sly, slx), (cell_y, cell_x) in zip(
+        kernels, stamp_slices, cell_slices
+    ):
+        yc = (sly.start + sly.stop - 1) / 2.0 - cell_y.start
+        xc = (slx.start + slx.stop - 1) / 2.0 - cell_x.start
+        center_kernels.append(eval_adpative_kernel(ki, xc, yc))
+    return np.array(center_kernels)
+
+
+def _interpolated_convolution(
+    refimage, center_kernels, gridshape, out, conv_method="auto"
+):
+    """Add to ``out`` the convolution of ``refimage`` with the kernel field
+    that interpolates bilinearly between ``center_kernels`` (one per grid
+    element, row-major) and is constant beyond the outermost centers.
+
+    Each pixel is convolved with a kernel that is a weighted sum of (up to)
+    four center kernels, so the result is the same weighted sum of the
+    convolutions with each center kernel. Each of those is only done where
+    its weight is not zero.
+    """
+    ny, nx = gridshape
+    h, w = refimage.shape
+    kh, kw = center_kernels.shape[1:]
+    spill_y, spill_x = (kh - 1) // 2, (kw - 1) // 2
+    centers_y = np.array(
+        [(h * i // ny + h * (i + 1) // ny - 1) / 2.0 for i in range(ny)]
+    )
+    centers_x = np.array(
+        [(w * j // nx + w * (j + 1) // nx - 1) / 2.0 for j in range(nx)]
+    )
+
+    def node_support(centers, i, size):
+        "The pixels where the weight of node ``i`` is not zero."
+        start = int(np.floor(centers[i - 1])) + 1 if i > 0 else 0
+        stop = int(np.ceil(centers[i + 1])) if i < len(centers) - 1 else size
+        return start, stop
+
+    for i in range(ny):
+        y0, y1 = node_support(centers_y, i, h)
+        weight_y = np.interp(np.arange(y0, y1), centers_y, np.eye(ny)[i])
+        by0, by1 = max(y0 - spill_y, 0), min(y1 + spill_y, h)
+        for j in range(nx):
+            x0, x1 = node_support(centers_x, j, w)
+            weight_x = np.interp(np.arange(x0, x1), centers_x, np.eye(nx)[j])
+            bx0, bx1 = max(x0 - spill_x, 0), min(x1 + spill_x, w)
+            # Convolve with a border, so the support matches the whole image
+            conv = _convolve2d(
+                np.ma.getdata(refimage[by0:by1, bx0:bx1]),
+                center_kernels[i * nx + j],
+                conv_method,
+            )
+            out[y0:y1, x0:x1] += (
+                conv[y0 - by0 : y1 - by0, x0 - bx0 : x1 - bx0]
+                * weight_y[:, np.newaxis]
+                * weight_x
+            )
+    return out
+
+
+def iter_optimal_system(
+    image,
+    refimage,
+    kernelshape=(11, 11),
+    bkgdegree=None,
+    method="Bramich",
+    gridshape=None,
+    n_jobs=None,
+    executor=None,
+    **kwargs
+):
+    """Do Optimal Image Subtraction on each element of a grid and yield the
+    results as each one finishes.
+
+    Takes the same arguments as ``optimal_system``. Only the grid elements
+    being solved (a few per worker) are held in memory.
+
+    Yields:
+        stamp_index, slices, difference_tile, optimal_tile, kernel,
+        background_tile
+
+        ``stamp_index`` counts grid elements in row-major order and
+        ``slices`` is the ``(rows, columns)`` tuple of slices of the tiles in
+        the full image. With no grid there is a single tile. Tiles are new
+        arrays, not views of the arrays of the whole grid element.
+
+    Raises:
+        EvenSideKernelError: If any dimension of ``kernelshape`` is even.
+
+    """
+    DiffStrategy = _get_strategy(method, kernelshape)  # noqa
+    if gridshape is None:
+        gridshape = (1, 1)
+    stamp_slices, cell_slices, recover_slices = _grid_slices(
+        image.shape, gridshape, kernelshape
+    )
+
+    import multiprocessing
+
+    n_workers = multiprocessing.cpu_count()
+    own_executor = None
+    if executor is None and n_jobs is not None and n_jobs != 1:
+        from concurrent.futures import ThreadPoolExecutor
+
+        if n_jobs > 0:
+            n_workers = n_jobs
+        executor = own_executor = ThreadPoolExecutor(n_workers)
+    if executor is not None and issubclass(
+        DiffStrategy, AdaptiveBramichStrategy
+    ):
+        # The grid elements already use every worker, don't also start an
+        # OpenMP thread per CPU in each of them
+        kwargs = dict(kwargs)
+        kwargs.setdefault("n_threads", 1)
+
+    stamp_kwargs = [kwargs] * len(cell_slices)
+    stamps = kwargs.get("stamps")
+    if np.ndim(stamps) == 2:
+        # Coordinates of the fit stamps are given for the full image
+        stamp_kwargs = [
+            dict(kwargs, stamps=_stamps_in_region(stamps, sly, slx))
+            for sly, slx in cell_slices
+        ]
+    profile = kwargs.get("profile")
+    _check_profile(profile)
+    subtract = _subtract_stamp
+    if profile is not None:
+        # Each grid element collects its own records, which are added to
+        # the report here, so they aren't lost in process pools.
+        stamp_kwargs = [
+            dict(st_kwargs, profile=_StampProfile())
+            for st_kwargs in stamp_kwargs
+        ]
+        subtract = _subtract_stamp_profiled
+    # A generator, so each grid element is sliced (and, for lazy arrays,
+    # read) only when it is about to be solved.
+    stamp_args = (
+        (
+            DiffStrategy,
+            image[sly, slx],
+            refimage[sly, slx],
+            kernelshape,
+            bkgdegree,
+            st_kwargs,
+        )
+        for (sly, slx), st_kwargs in zip(cell_slices, stamp_kwargs)
+    )
+    try:
+        if executor is None:
+            results = (
+                (ind, subtract(*args)) for ind, args in enumerate(stamp_args)
+            )
+        else:
+            results = _bounded_completed(
+                executor, subtract, stamp_args, 2 * n_workers
+            )
+        for ind, result in results:
+            if profile is not None:
+                result, records = result
+                stamp = ind if len(cell_slices) > 1 else None
+                for record in records:
+                    profile.add(record, stamp)
+            di, opti, ki, bgi = result
+            sly_out, slx_out = recover_slices[ind]
+            # Copies, so the arrays of the whole grid element with its
+            # border can be freed while the tiles are in use
+            di, opti, bgi = (
+                tile[sly_out, slx_out].copy() for tile in (di, opti, bgi)
+            )
+            del result
+            yield ind, stamp_slices[ind], di, opti, ki, bgi
+    finally:
+        if own_executor is not None:
+            own_executor.shutdown()
 
 
 def optimal_system(
@@ -439,6 +1768,12 @@ def optimal_system(
     bkgdegree=None,
     method="Bramich",
     gridshape=None,
+    n_jobs=None,
+    executor=None,
+    out_difference=None,
+    out_optimal=None,
+    out_background=None,
+    interpolate_kernel=False,
     **kwargs
 ):
     """Do Optimal Image Subtraction and return optimal image, kernel
@@ -448,10 +1783,39 @@ def optimal_system(
     They all (optionally) simultaneously fit a background.
 
     Args:
+        image, refimage: The science and reference images. Besides numpy
+            (masked) arrays they can be ``np.memmap`` or any array that
+            supports ``shape`` and 2-D slicing. With a grid, each grid
+            element is only read when it is about to be solved.
+
         gridshape: A tuple containing the number of vertical and horizontal
             divisions of a grid. Subtraction will be performed on each grid
             element. ``None`` is equivalent to a ``(1, 1)`` grid (no grid).
 
+        n_jobs: Number of threads used to solve the grid stamps concurrently.
+            ``-1`` uses one thread per CPU. ``None`` or ``1`` solves the
+            stamps one after the other. Ignored if ``executor`` is given.
+
+        executor: A ``concurrent.futures.Executor`` (thread or process pool)
+            to which the grid stamp solves are submitted. Results are written
+            into the collages as each stamp finishes. Only a few stamps per
+            CPU are submitted at a time, to bound memory use.
+
+        out_difference, out_optimal, out_background: Arrays with the shape
+            of ``image`` (for example ``np.memmap``) where the difference,
+            optimal image and background are written and then returned,
+            instead of new arrays. Masks are only kept if they are masked
+            arrays.
+
+        interpolate_kernel: Only with a grid. If ``True``, the kernel of
+            each grid element is only used at the element center, and the
+            optimal image is the convolution with the kernel field that
+            interpolates bilinearly between the centers. This removes the
+            seams at the grid element borders, as AdaptiveBramich does for
+            the whole image, at the cost of the (parallel) grid fits plus
+            about four convolutions of the reference. The background is
+            still fit on each element.
+
         kernelshape: Shape of the kernel to use. Must be of odd size.
 
         bkgdegree: Degree of the polynomial to fit the background.
@@ -471,6 +1835,63 @@ def optimal_system(
         poly_degree: Needed only for AdaptiveBramich. It is the degree
             of the polynomial for the kernel spatial variation.
 
+        conv_method: Only for Bramich and Alard-Lupton. The convolution
+            engine, one of ``"direct"``, ``"separable"``, ``"fft"`` or
+            ``"auto"`` (default). ``"auto"`` builds the Alard-Lupton basis
+            with 1-D convolutions and picks direct or FFT convolution for the
+            optimal image based on kernel and image size.
+
+        n_threads: Only for AdaptiveBramich. Number of OpenMP threads used
+            to build the matrix system. ``0`` uses the OpenMP default,
+            usually one per CPU. The GIL is released while the system is
+            built and convolved, so grid elements scale with ``n_jobs``
+            threads. Default: ``1`` when the grid elements run in parallel
+            (``n_jobs`` other than ``None`` or ``1``, or an ``executor``), so
+            there aren't ``n_jobs`` times as many threads as CPUs, and ``0``
+            otherwise.
+
+        solver: How to solve the normal equations. One of ``"cholesky"``
+            (default), ``"lu"``, ``"lstsq"`` (SVD, for singular systems) or
+            ``"ridge"`` (Cholesky with Tikhonov regularization). The default
+            for AdaptiveBramich is ``"lu"``, since its M is often nearly
+            singular. If the Cholesky or LU factorization fails, ``"lstsq"``
+            is used instead with a ``LinAlgWarning``, so a single bad grid
+            stamp doesn't stop the whole subtraction.
+
+        stamps: Fit the kernel only on small stamps around sources instead
+            of the whole image, then apply it to the whole image.
+            An integer picks that many of the brightest sources in
+            ``refimage`` with ``find_stamps`` (per grid element if there is
+            a grid). A sequence of (row, column) centers uses those.
+            ``None`` (default) fits on the whole image.
+
+        stamp_shape: Shape of the stamps. Default: twice the kernel shape
+            plus one.
+
+        saturation: Sources at or above this value are not picked as stamps.
+
+        dtype: ``"float64"`` (default) or ``"float32"``. With float32 the
+            images, basis images and convolutions are kept in single
+            precision, halving their memory, while M and b are still summed
+            in float64.
+
+        observer: A callable ``observer(phase)`` called as each phase of
+            each grid element starts (see ``SubtractionStrategy.notify``).
+            It's called from worker threads when ``n_jobs`` or ``executor``
+            are used. Raise ``SubtractionCancelled`` from it to stop.
+
+        profile: A ``ProfileReport`` to record the wall time and memory of
+            each phase of each grid element in. With a grid, the records of
+            each element are added as it finishes, also from process pools.
+            Anything else but ``None`` raises ``TypeError``.
+
+        regularization: Only for ``solver="ridge"``. The Tikhonov factor
+            added to the diagonal of M, relative to the mean of the diagonal.
+
+        low_memory: Only for AdaptiveBramich. If ``True``, the matrix system
+            is accumulated over blocks of image rows, so the basis images
+            are never held in memory for the whole image at once.
+
         gausslist: Needed only for Alard-Lupton. A list of dictionaries with
             info for the modulated multi-Gaussian.
             Dictionary keys are:
@@ -491,133 +1912,173 @@ def optimal_system(
     Returns:
         difference, optimal_image, kernel, background
 
+        With a grid, ``kernel`` is a list with the kernel of each grid
+        element (at its center if ``interpolate_kernel``). Use
+        ``iter_optimal_system`` to get each grid element as soon as it's
+        done instead.
+
     Raises:
         EvenSideKernelError: If any dimension of ``kernelshape`` is even.
 
     """
-
-    kh, kw = kernelshape
-
-    if (kw % 2 == 0) or (kh % 2 == 0):
-        raise EvenSideKernelError("Kernel sides must be odd.")
-
-    DefaultStrategy = BramichStrategy  # noqa
-    all_strategies = {
-        "AdaptiveBramich": AdaptiveBramichStrategy,
-        "Bramich": BramichStrategy,
-        "Alard-Lupton": AlardLuptonStrategy,
-    }
-    try:
-        DiffStrategy = all_strategies[method]  # noqa
-    except KeyError:
-        raise ValueError("No method named {}".format(method))
+    DiffStrategy = _get_strategy(method, kernelshape)  # noqa
 
     if gridshape is None or gridshape == (1, 1):
         # If there's no grid, do without it
-        subt_strat = DiffStrategy(
-            image, refimage, kernelshape, bkgdegree, **kwargs
+        results = list(
+            _subtract_stamp(
+                DiffStrategy, image, refimage, kernelshape, bkgdegree, kwargs
+            )
         )
-        opt_image = subt_strat.get_optimal_image()
-        kernel = subt_strat.get_kernel()
-        background = subt_strat.get_background()
-        difference = subt_strat.get_difference()
-        return difference, opt_image, kernel, background
+        outs = (out_difference, out_optimal, None, out_background)
+        for ind, out in enumerate(outs):
+            if out is not None:
+                _output_array(out, image.shape)[...] = results[ind]
+                results[ind] = out
+        return tuple(results)
 
     else:
         ny, nx = gridshape
-        h, w = image.shape
-
-        # normal slices with no border
-        stamps_y = [
-            slice(h * i // ny, h * (i + 1) // ny, None) for i in range(ny)
-        ]
-        stamps_x = [
-            slice(w * i // nx, w * (i + 1) // nx, None) for i in range(nx)
-        ]
-
-        # slices with borders where possible
-        # Slices should be in (h * i // ny, h * (i + 1) // ny) but we add and
-        # subtract the kernel spill k_spill and then we clip to keep it inside
-        # image boundaries.
-        k_spill = (kh - 1) // 2
-        slc_wborder_y = [
-            slice(
-                np.clip(h * i // ny - k_spill, 0, h),
-                np.clip(h * (i + 1) // ny + k_spill, 0, h),
-                None,
+        masked = _has_mask(image) or _has_mask(refimage)
+        optimal_collage = _output_array(out_optimal, image.shape, masked)
+        subtract_collage = _output_array(out_difference, image.shape, masked)
+        bkg_collage = _output_array(out_background, image.shape)
+        kernel_collage = [None] * (ny * nx)
+        for ind, (sly, slx), di, opti, ki, bgi in iter_optimal_system(
+            image,
+            refimage,
+            kernelshape,
+            bkgdegree,
+            method,
+            gridshape,
+            n_jobs,
+            executor,
+            **kwargs
+        ):
+            optimal_collage[sly, slx] = opti
+            bkg_collage[sly, slx] = bgi
+            subtract_collage[sly, slx] = di
+            kernel_collage[ind] = ki
+
+        if interpolate_kernel:
+            stamp_slices, cell_slices, _ = _grid_slices(
+                image.shape, gridshape, kernelshape
             )
-            for i in range(ny)
-        ]
-        slc_wborder_x = [
-            slice(
-                np.clip(w * i // nx - k_spill, 0, w),
-                np.clip(w * (i + 1) // nx + k_spill, 0, w),
-                None,
+            center_kernels = _center_kernels(
+                kernel_collage, stamp_slices, cell_slices
             )
-            for i in range(nx)
-        ]
+            kernel_collage = list(center_kernels)
+            # Replace the optimal image and difference, keeping their masks
+            optimal_data = np.ma.getdata(optimal_collage)
+            optimal_data[...] = np.ma.getdata(bkg_collage)
+            _interpolated_convolution(
+                refimage,
+                center_kernels,
+                gridshape,
+                optimal_data,
+                kwargs.get("conv_method", "auto"),
+            )
+            subtract_data = np.ma.getdata(subtract_collage)
+            for sly, slx in stamp_slices:
+                subtract_data[sly, slx] = (
+                    np.ma.getdata(image[sly, slx]) - optimal_data[sly, slx]
+                )
 
-        img_stamps = [
-            image[sly, slx] for sly in slc_wborder_y for slx in slc_wborder_x
-        ]
-        ref_stamps = [
-            refimage[sly, slx]
-            for sly in slc_wborder_y
-            for slx in slc_wborder_x
-        ]
+        return subtract_collage, optimal_collage, kernel_collage, bkg_collage
 
-        # After we do the subtraction we need to crop the extra borders in the
-        # stamps.
-        # The recover_slices are the prescription for what to crop on each stamp.
-        recover_slices = []
-        for i in range(ny):
-            start_border_y = slc_wborder_y[i].start
-            stop_border_y = slc_wborder_y[i].stop
-            # Slice should end at h * (i + 1) // ny, any other pixels should
-            # be trimmed. sly_stop is either negative or 0.
-            # In the special case where 0 pixels need to be trimmed
-            # we use None so slice goes to the end.
-            sly_stop = (h * (i + 1) // ny - stop_border_y) or None
-            # Same with initial pixels, but sly_start is positive or 0.
-            # Zero is not a special case now (0 is array initial pixel)
-            sly_start = h * i // ny - start_border_y
-            sly = slice(sly_start, sly_stop, None)
-            for j in range(nx):
-                start_border_x = slc_wborder_x[j].start
-                stop_border_x = slc_wborder_x[j].stop
-                slx_stop = (w * (j + 1) // nx - stop_border_x) or None
-                slx_start = w * j // nx - start_border_x
-                slx = slice(slx_start, slx_stop, None)
-                recover_slices.append([sly, slx])
-
-        # Here do the subtraction on each stamp
-        if _has_mask(image) or _has_mask(refimage):
-            optimal_collage = np.ma.empty(image.shape)
-            subtract_collage = np.ma.empty(image.shape)
-        else:
-            optimal_collage = np.empty(image.shape)
-            subtract_collage = np.empty(image.shape)
-        bkg_collage = np.empty(image.shape)
-        kernel_collage = []
-        stamp_slices = [[asly, aslx] for asly in stamps_y for aslx in stamps_x]
-        for ind, ((sly_out, slx_out), (sly_in, slx_in)) in enumerate(
-            zip(recover_slices, stamp_slices)
-        ):
 
-            subt_strat = DiffStrategy(
-                img_stamps[ind],
-                ref_stamps[ind],
-                kernelshape,
-                bkgdegree,
-                **kwargs
-            )
-            opti = subt_strat.get_optimal_image()
-            ki = subt_strat.get_kernel()
-            bgi = subt_strat.get_background()
-            di = subt_strat.get_difference()
-            optimal_collage[sly_in, slx_in] = opti[sly_out, slx_out]
-            bkg_collage[sly_in, slx_in] = bgi[sly_out, slx_out]
-            subtract_collage[sly_in, slx_in] = di[sly_out, slx_out]
-            kernel_collage.append(ki)
+def aoptimal_system(
+    image,
+    refimage,
+    kernelshape=(11, 11),
+    bkgdegree=None,
+    method="Bramich",
+    gridshape=None,
+    executor=None,
+    progress=None,
+    loop=None,
+    **kwargs
+):
+    """Run ``optimal_system`` in ``executor`` without blocking the event loop.
 
-        return subtract_collage, optimal_collage, kernel_collage, bkg_collage
+    Returns an ``asyncio`` future, so it can be used as
+    ``await aoptimal_system(image, refimage)`` and scheduled many times
+    concurrently. It needs Python 3.7 or later.
+
+    Cancelling the future stops the subtraction at the next phase boundary
+    (between grid elements, or between building the basis, assembling the
+    matrix system, solving and convolving), where it raises
+    ``SubtractionCancelled`` in the worker.
+
+    Args:
+        executor: The ``concurrent.futures.ThreadPoolExecutor`` that runs
+            the subtraction. ``None`` (default) uses the loop's default
+            executor. Cancellation and progress are shared with the worker
+            in memory, so other executors (e.g. a process pool) raise
+            ``TypeError``. To solve the grid elements in parallel pass
+            ``n_jobs``.
+
+        progress: A callable ``progress(phase, n_done, n_total)``, called in
+            the event loop as each phase starts. ``n_done`` counts the grid
+            elements finished out of ``n_total``.
+
+        loop: The event loop. Default: the running loop
+            (``asyncio.get_running_loop()``), so without ``loop`` this must
+            be called from a coroutine or callback of a running loop.
+
+        All other arguments are the same as for ``optimal_system``.
+
+    Returns:
+        A future with difference, optimal_image, kernel, background
+    """
+    import asyncio
+    import functools
+    from concurrent.futures import ThreadPoolExecutor
+
+    if executor is not None and not isinstance(executor, ThreadPoolExecutor):
+        raise TypeError(
+            "executor must be a ThreadPoolExecutor, not {}".format(
+                type(executor).__name__
+            )
+        )
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    lock = threading.Lock()
+    n_done = [0]
+    n_total = 1 if gridshape is None else gridshape[0] * gridshape[1]
+    user_observer = kwargs.pop("observer", None)
+
+    def observer(phase):
+        if cancelled.is_set():
+            raise SubtractionCancelled("Subtraction was cancelled")
+        if user_observer is not None:
+            user_observer(phase)
+        with lock:
+            if phase == "done":
+                n_done[0] += 1
+            done = n_done[0]
+        if progress is not None:
+            loop.call_soon_threadsafe(progress, phase, done, n_total)
+
+    future = loop.run_in_executor(
+        executor,
+        functools.partial(
+            optimal_system,
+            image,
+            refimage,
+            kernelshape,
+            bkgdegree,
+            method,
+            gridshape,
+            observer=observer,
+            **kwargs
+        ),
+    )
+
+    def on_done(fut):
+        if fut.cancelled():
+            cancelled.set()
+
+    future.add_done_callback(on_done)
+    return future
@@ -1,4 +1,8 @@
 from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
+import os
+import shutil
+import tempfile
 import numpy
 
 # Get the version from astroalign file itself (not imported)
@@ -19,6 +23,41 @@ varconv = Extension(
     extra_compile_args=["-std=c99"],
 )
 
+
+def has_openmp(compiler):
+    "Return True if compiler can build and link a program with -fopenmp."
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, "omp_test.c")
+        with open(src, "w") as f:
+            f.write("#include <omp.h>\nint main(void) {")
+            f.write(" return omp_get_max_threads() > 0 ? 0 : 1; }\n")
+        objs = compiler.compile(
+            [src], output_dir=tmpdir, extra_postargs=["-fopenmp"]
+        )
+        compiler.link_executable(
+            objs, os.path.join(tmpdir, "omp_test"), extra_postargs=["-fopenmp"]
+        )
+    except Exception:
+        return False
+    finally:
+        shutil.rmtree(tmpdir)
+    return True
+
+
+class BuildExt(build_ext):
+    "Build varconv with OpenMP when the compiler supports it."
+
+    def build_extensions(self):
+        if os.environ.get("OIS_NO_OPENMP") is None and has_openmp(
+            self.compiler
+        ):
+            for ext in self.extensions:
+                ext.extra_compile_args.append("-fopenmp")
+                ext.extra_link_args.append("-fopenmp")
+        build_ext.build_extensions(self)
+
+
 setup(
     name="ois",
     version=ois_version,
@@ -32,6 +71,7 @@ setup(
         "ois",
     ],
     ext_modules=[varconv],
-    install_requires=["numpy>=1.6", "scipy>=0.16"],
+    cmdclass={"build_ext": BuildExt},
+    install_requires=["numpy>=1.13", "scipy>=1.1"],
     test_suite="tests",
 )
@@ -1,104 +1,288 @@
 #include "fitshelper.h"
+#include <stdlib.h>
 #include <string.h>
 
-image fits_get_data(char *filename) {
+static void print_fits_error(char *message, char *filename, int status) {
+  char err_msg[32];
+  printf("%s %s\n", message, filename);
+  fits_get_errstatus(status, err_msg);
+  printf("ERROR: %s\n", err_msg);
+}
+
+static fitsfile *open_image(char *filename, int *n, int *m) {
+  // Open a 2D image and return its number of rows (NAXIS2) and columns
+  // (NAXIS1), or NULL on error.
   fitsfile *fp;
   int status = 0;
-  char err_msg[32];
-  image badimage = {NULL, 0, 0};
-  int bitpix, naxis;
-  long naxes[2];
+  int naxis;
+  long naxes[2] = {0, 0};
   fits_open_file(&fp, filename, READONLY, &status);
   if (status) {
-    printf("Error opening file %s\n", filename);
-    fits_get_errstatus(status, err_msg);
-    printf("ERROR: %s\n", err_msg);
-    return badimage;
+    print_fits_error("Error opening file", filename, status);
+    return NULL;
   }
-  fits_get_img_param(fp, 2, &bitpix, &naxis, naxes, &status);
+  fits_get_img_dim(fp, &naxis, &status);
+  fits_get_img_size(fp, 2, naxes, &status);
   if (status) {
-    printf("Error getting parameters for file %s\n", filename);
-    fits_get_errstatus(status, err_msg);
-    printf("ERROR: %s\n", err_msg);
-    return badimage;
+    print_fits_error("Error getting parameters for file", filename, status);
+    fits_close_file(fp, &status);
+    return NULL;
+  }
+  if (naxis != 2) {
+    printf("Error: %s is not a 2D image (NAXIS = %d)\n", filename, naxis);
+    fits_close_file(fp, &status);
+    return NULL;
   }
-  int N = (int)(naxes[0] * naxes[1]); // size of the image //
-  long initial_pixel[] = {1, 1};
-  double *data = (double *)calloc(N, sizeof(double));
-  fits_read_pix(fp, TDOUBLE, initial_pixel, N, 0, data, 0, &status);
+  *n = (int)naxes[1];
+  *m = (int)naxes[0];
+  return fp;
+}
+
+static int native_datatype(int bitpix, size_t *size) {
+  // The cfitsio type code and the size of a pixel of type bitpix
+  switch (bitpix) {
+  case BYTE_IMG:
+    *size = sizeof(unsigned char);
+    return TBYTE;
+  case SBYTE_IMG:
+    *size = sizeof(signed char);
+    return TSBYTE;
+  case SHORT_IMG:
+    *size = sizeof(short);
+    return TSHORT;
+  case USHORT_IMG:
+    *size = sizeof(unsigned short);
+    return TUSHORT;
+  case LONG_IMG:
+    *size = sizeof(int);
+    return TINT;
+  case ULONG_IMG:
+    *size = sizeof(unsigned int);
+    return TUINT;
+  case LONGLONG_IMG:
+    *size = sizeof(LONGLONG);
+    return TLONGLONG;
+  case FLOAT_IMG:
+    *size = sizeof(float);
+    return TFLOAT;
+  default:
+    *size = sizeof(double);
+    return TDOUBLE;
+  }
+}
+
+image fits_get_data(char *filename) {
+  /** Read the whole image as double. */
+  image badimage = {NULL, 0, 0};
+  int n, m;
+  fitsfile *fp = open_image(filename, &n, &m);
+  if (fp == NULL)
+    return badimage;
+  int status = 0;
+  LONGLONG npixels = (LONGLONG)n * m;
+  LONGLONG initial_pixel[] = {1, 1};
+  double *data = (double *)malloc((size_t)npixels * sizeof(double));
+  fits_read_pixll(fp, TDOUBLE, initial_pixel, npixels, NULL, data, NULL,
+                  &status);
   if (status) {
-    printf("Error getting pixels from file %s\n", filename);
-    fits_get_errstatus(status, err_msg);
-    printf("ERROR: %s\n", err_msg);
+    print_fits_error("Error getting pixels from file", filename, status);
+    free(data);
+    fits_close_file(fp, &status);
     return badimage;
   }
   fits_close_file(fp, &status);
-  image img = {data, (int)naxes[0], (int)naxes[1]};
+  image img = {data, n, m};
   return img;
 }
 
-int fits_write_to(char *filename, image img, char *file_with_header) {
-  long nax[] = {img.n, img.m};
-  long initial_pixel[] = {1, 1};
+native_image fits_get_native(char *filename) {
+  /** Read the whole image in its own pixel type (after BSCALE and BZERO), so
+   * 8 and 16 bit images take 8 or 4 times less memory than as double. Use
+   * native_to_double to convert parts of it. */
+  native_image badimage = {NULL, 0, 0, 0};
+  int n, m;
+  fitsfile *fp = open_image(filename, &n, &m);
+  if (fp == NULL)
+    return badimage;
   int status = 0;
-  char err_msg[32];
-  fitsfile *fp;
-  char *filename_overwrite =
-      (char *)malloc((strlen(filename) + 2) * sizeof(char));
-  sprintf(filename_overwrite, "%s", filename);
-  fits_create_file(&fp, filename_overwrite, &status);
+  int bitpix;
+  fits_get_img_equivtype(fp, &bitpix, &status);
+  size_t pixel_size;
+  int datatype = native_datatype(bitpix, &pixel_size);
+  LONGLONG npixels = (LONGLONG)n * m;
+  LONGLONG initial_pixel[] = {1, 1};
+  void *data = malloc((size_t)npixels * pixel_size);
+  fits_read_pixll(fp, datatype, initial_pixel, npixels, NULL, data, NULL,
+                  &status);
   if (status) {
-    printf("Error creating  file %s %s\n", filename_overwrite, filename);
-    fits_get_errstatus(status, err_msg);
-    printf("ERROR: %s\n", err_msg);
+    print_fits_error("Error getting pixels from file", filename, status);
+    free(data);
+    fits_close_file(fp, &status);
+    return badimage;
+  }
+  fits_close_file(fp, &status);
+  native_image img = {data, datatype, n, m};
+  return img;
+}
+
+int fits_get_shape(char *filename, int *n, int *m) {
+  /** Set n and m to the number of rows and columns of the image, without
+   * reading its pixels. */
+  int status = 0;
+  fitsfile *fp = open_image(filename, n, m);
+  if (fp == NULL)
     return EXIT_FAILURE;
+  fits_close_file(fp, &status);
+  return EXIT_SUCCESS;
+}
+
+image fits_get_region(char *filename, int row_start, int row_stop,
+                      int col_start, int col_stop) {
+  /** Read rows [row_start, row_stop) and columns [col_start, col_stop) of
+   * the image as double, without reading the rest of it. */
+  image badimage = {NULL, 0, 0};
+  int n, m;
+  fitsfile *fp = open_image(filename, &n, &m);
+  if (fp == NULL)
+    return badimage;
+  int status = 0;
+  if (row_start < 0 || row_stop > n || row_start >= row_stop ||
+      col_start < 0 || col_stop > m || col_start >= col_stop) {
+    printf("Error: region [%d:%d, %d:%d] is outside of %s\n", row_start,
+           row_stop, col_start, col_stop, filename);
+    fits_close_file(fp, &status);
+    return badimage;
   }
-  fits_create_img(fp, DOUBLE_IMG, 2, nax, &status);
+  // cfitsio pixels are 1-based and the last pixel is included
+  long fpixel[] = {col_start + 1, row_start + 1};
+  long lpixel[] = {col_stop, row_stop};
+  long inc[] = {1, 1};
+  int rn = row_stop - row_start;
+  int rm = col_stop - col_start;
+  double *data = (double *)malloc((size_t)rn * rm * sizeof(double));
+  fits_read_subset(fp, TDOUBLE, fpixel, lpixel, inc, NULL, data, NULL,
+                   &status);
   if (status) {
-    printf("Error creating  image array for file %s\n", filename);
-    fits_get_errstatus(status, err_msg);
-    printf("ERROR: %s\n", err_msg);
-    return EXIT_FAILURE;
+    print_fits_error("Error getting pixels from file", filename, status);
+    free(data);
+    fits_close_file(fp, &status);
+    return badimage;
   }
-  double *transpose = (double *)malloc(img.n * img.m * sizeof(double));
-  for (int i = 0; i < img.m; i++) {
-    for (int j = 0; j < img.n; j++) {
-      transpose[j + i * img.n] = img.data[i + j * img.n];
-    }
+  fits_close_file(fp, &status);
+  image img = {data, rn, rm};
+  return img;
+}
+
+#define NATIVE_TO_DOUBLE(type)                                                \
+  for (int row = row_start; row < row_stop; row++) {                          \
+    type *in_row = (type *)img.data + (size_t)row * img.m;                    \
+    for (int col = col_start; col < col_stop; col++) {                        \
+      *out++ = (double)in_row[col];                                           \
+    }                                                                         \
   }
-  fits_write_pix(fp, TDOUBLE, initial_pixel, img.n * img.m, transpose, &status);
-  free(transpose);
-  if (status) {
-    printf("Error writing pixels for file %s\n", filename);
-    fits_get_errstatus(status, err_msg);
-    printf("ERROR: %s\n", err_msg);
-    return EXIT_FAILURE;
+
+void native_to_double(native_image img, int row_start, int row_stop,
+                      int col_start, int col_stop, double *out) {
+  /** Copy rows [row_start, row_stop) and columns [col_start, col_stop) of
+   * img to out as double. */
+  switch (img.datatype) {
+  case TBYTE:
+    NATIVE_TO_DOUBLE(unsigned char);
+    break;
+  case TSBYTE:
+    NATIVE_TO_DOUBLE(signed char);
+    break;
+  case TSHORT:
+    NATIVE_TO_DOUBLE(short);
+    break;
+  case TUSHORT:
+    NATIVE_TO_DOUBLE(unsigned short);
+    break;
+  case TINT:
+    NATIVE_TO_DOUBLE(int);
+    break;
+  case TUINT:
+    NATIVE_TO_DOUBLE(unsigned int);
+    break;
+  case TLONGLONG:
+    NATIVE_TO_DOUBLE(LONGLONG);
+    break;
+  case TFLOAT:
+    NATIVE_TO_DOUBLE(float);
+    break;
+  default:
+    NATIVE_TO_DOUBLE(double);
   }
+}
 
-  // Set the Header on the new image
+static int copy_header(fitsfile *fp, char *file_with_header) {
+  // Copy the user keywords of file_with_header, not the ones that describe
+  // its data (BITPIX, NAXISn, BSCALE, compression, checksums, ...)
   fitsfile *headfp;
-  fits_open_file(&headfp, file_with_header, READWRITE, &status);
+  int status = 0;
+  fits_open_file(&headfp, file_with_header, READONLY, &status);
   if (status) {
-    printf("Error opening file %s\n", file_with_header);
-    fits_get_errstatus(status, err_msg);
-    printf("ERROR: %s\n", err_msg);
-    return EXIT_FAILURE;
+    print_fits_error("Error opening file", file_with_header, status);
+    return status;
   }
   int nkeys;
   fits_get_hdrspace(headfp, &nkeys, NULL, &status);
   if (status) {
-    printf("Error getting header for file %s\n", file_with_header);
-    fits_get_errstatus(status, err_msg);
-    printf("ERROR: %s\n", err_msg);
-    return EXIT_FAILURE;
+    print_fits_error("Error getting header for file", file_with_header,
+                     status);
+    fits_close_file(headfp, &status);
+    return status;
   }
   char card[FLEN_CARD];
-  for (int i = 11; i < nkeys; i++) {
+  for (int i = 1; i <= nkeys && !status; i++) {
     fits_read_record(headfp, i, card, &status);
+    int keyclass = fits_get_keyclass(card);
+    if (keyclass == TYP_STRUC_KEY || keyclass == TYP_CMPRS_KEY ||
+        keyclass == TYP_SCAL_KEY || keyclass == TYP_NULL_KEY ||
+        keyclass == TYP_CKSUM_KEY)
+      continue;
     fits_write_record(fp, card, &status);
   }
-
   fits_close_file(headfp, &status);
+  return status;
+}
+
+int fits_write_image(char *filename, image img, char *file_with_header,
+                     int bitpix, int compress) {
+  /** Write img with the header keywords of file_with_header. bitpix is the
+   * pixel type on disk (FLOAT_IMG or DOUBLE_IMG). If compress is not 0, the
+   * image is Rice tile-compressed; cfitsio quantizes float pixels for this,
+   * by default to a quarter of the noise. No checksums are computed. */
+  long nax[] = {img.m, img.n};
+  LONGLONG initial_pixel[] = {1, 1};
+  int status = 0;
+  fitsfile *fp;
+  fits_create_file(&fp, filename, &status);
+  if (status) {
+    print_fits_error("Error creating file", filename, status);
+    return EXIT_FAILURE;
+  }
+  if (compress)
+    fits_set_compression_type(fp, RICE_1, &status);
+  fits_create_img(fp, bitpix, 2, nax, &status);
+  if (status) {
+    print_fits_error("Error creating image array for file", filename, status);
+    fits_close_file(fp, &status);
+    return EXIT_FAILURE;
+  }
+  fits_write_pixll(fp, TDOUBLE, initial_pixel, (LONGLONG)img.n * img.m,
+                   img.data, &status);
+  if (status) {
+    print_fits_error("Error writing pixels for file", filename, status);
+    fits_close_file(fp, &status);
+    return EXIT_FAILURE;
+  }
+  status = copy_header(fp, file_with_header);
   fits_close_file(fp, &status);
-  return EXIT_SUCCESS;
+  return status ? EXIT_FAILURE : EXIT_SUCCESS;
+}
+
+int fits_write_to(char *filename, image img, char *file_with_header) {
+  /** Write img as an uncompressed double image. */
+  return fits_write_image(filename, img, file_with_header, DOUBLE_IMG, 0);
 }
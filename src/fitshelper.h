@@ -4,13 +4,31 @@
 #include "fitsio.h"
 #include <stdio.h>
 
+// An image of n rows (NAXIS2) and m columns (NAXIS1), stored row by row.
 typedef struct {
   double *data;
   int n;
   int m;
 } image;
 
+// The same, with the pixels in the type of the FITS file. datatype is the
+// cfitsio type code of data (TBYTE, TSHORT, TUSHORT, TINT, TFLOAT, ...).
+typedef struct {
+  void *data;
+  int datatype;
+  int n;
+  int m;
+} native_image;
+
 image fits_get_data(char *filename);
+native_image fits_get_native(char *filename);
+int fits_get_shape(char *filename, int *n, int *m);
+image fits_get_region(char *filename, int row_start, int row_stop,
+                      int col_start, int col_stop);
+void native_to_double(native_image img, int row_start, int row_stop,
+                      int col_start, int col_stop, double *out);
 int fits_write_to(char *filename, image img, char *header_file);
+int fits_write_image(char *filename, image img, char *header_file, int bitpix,
+                     int compress);
 
 #endif
@@ -14,13 +14,39 @@
 #include <string.h>
 #include <time.h>
 
-void perform_subtraction(image sciimg, image refimg, int kernel_height,
-                         int kernel_width, int kernel_polydeg, double *kernel,
-                         double *diff_data);
-void solve_linear_system(int n, double *C, double *D, double *xcs);
+// A grid element: its pixels, the same with a border of half a kernel side
+// (clipped to the image), and its factored matrix M (factor.F is NULL if M is
+// singular).
+typedef struct {
+  int row_start, row_stop, col_start, col_stop;
+  int brow_start, brow_stop, bcol_start, bcol_stop;
+  normal_factor factor;
+} grid_element;
+
+// The products of the reference image shared by every science image. The
+// reference is kept in its FITS pixel type and converted a grid element at a
+// time.
+typedef struct {
+  native_image refimg;
+  int kernel_height, kernel_width, kernel_polydeg;
+  int n_elements;
+  grid_element *elements;
+} reference;
+
+int prepare_reference(reference *ref, native_image refimg, int kernel_height,
+                      int kernel_width, int kernel_polydeg, int grid_ny,
+                      int grid_nx);
+int subtract_reference(reference *ref, char *scifile, double *diff_data);
+int subtract_file(reference *ref, char *scifile, char *outputfile, int bitpix,
+                  int compress);
+void free_reference(reference *ref);
 
 char version_number[] = "1.0";
 
+// Number of basis image pixels built at a time while accumulating the matrix
+// system, as _LOW_MEMORY_BLOCK_SIZE in ois.py.
+#define CONV_BLOCK_SIZE (1 << 22)
+
 void usage(char *exec_name);
 void version(char *exec_name);
 
@@ -36,10 +62,13 @@ int main(int argc, char *argv[]) {
       -1; // Degree of the interpolating polynomial for the variable kernel
   char *reffile = NULL;
   char *scifile = NULL;
-  char refstarsfile_default[] = "./refstars.txt";
-  char *refstarsfile = refstarsfile_default;
+  char *scilistfile = NULL;
   char outputfile_default[] = "diff_img.fits";
-  char *outputfile = outputfile_default;
+  char *outputfile = NULL;
+  int grid_ny = 1; // The grid of image sections fitted independently
+  int grid_nx = 1;
+  int out_bitpix = DOUBLE_IMG; // The pixel type of the difference images
+  int compress = 0;            // Rice compress the difference images
   if (argc < 2) {
     usage(exec_name);
     return EXIT_SUCCESS;
@@ -59,14 +88,30 @@ int main(int argc, char *argv[]) {
         ++argv; // Consume one word
         --argc; // Decrease word counter by 1
         scifile = *argv;
+      } else if (!strcmp(*argv, "-sci-list")) {
+        ++argv; // Consume one word
+        --argc; // Decrease word counter by 1
+        scilistfile = *argv;
       } else if (!strcmp(*argv, "-kd") || !strcmp(*argv, "--kernel-poly-deg")) {
         ++argv; // Consume one word
         --argc; // Decrease word counter by 1
         kdeg = atoi(*argv);
+      } else if (!strcmp(*argv, "-grid")) {
+        ++argv; // Consume one word
+        --argc; // Decrease word counter by 1
+        if (argc == 0 || sscanf(*argv, "%dx%d", &grid_ny, &grid_nx) != 2 ||
+            grid_ny < 1 || grid_nx < 1) {
+          printf("-grid must be of the form NYxNX, e.g. 4x4. Exiting.\n");
+          return EXIT_FAILURE;
+        }
       } else if (!strcmp(*argv, "-o")) {
         ++argv; // Consume one word
         --argc; // Decrease word counter by 1
         outputfile = *argv;
+      } else if (!strcmp(*argv, "-float32")) {
+        out_bitpix = FLOAT_IMG;
+      } else if (!strcmp(*argv, "-rice")) {
+        compress = 1;
       } else if (!strcmp(*argv, "-h") || !strcmp(*argv, "--help")) {
         usage(exec_name);
         return EXIT_SUCCESS;
@@ -97,138 +142,316 @@ int main(int argc, char *argv[]) {
     printf("Kernel side must be an odd number. Exiting.\n");
     return EXIT_FAILURE;
   }
+  if ((scifile == NULL) == (scilistfile == NULL)) {
+    printf("Give either -sci or -sci-list. Exiting.\n");
+    usage(exec_name);
+    return EXIT_FAILURE;
+  }
+  if (scilistfile != NULL && outputfile != NULL) {
+    printf("-o can't be used with -sci-list, give the output files in the "
+           "list instead. Exiting.\n");
+    return EXIT_FAILURE;
+  }
+  if (outputfile == NULL)
+    outputfile = outputfile_default;
 
-  // Open and read fits files
-  image refimg = fits_get_data(reffile);
-  double *Ref = refimg.data;
-  image sciimg = fits_get_data(scifile);
-  double *Sci = sciimg.data;
-
-  // Put a guard in case images are of different shape
-  if (refimg.n != sciimg.n || refimg.m != sciimg.m) {
-    printf("ERROR: Reference and Science images have different dimensions.\n");
+  // Read the reference and factor its matrix system once
+  native_image refimg = fits_get_native(reffile);
+  if (refimg.data == NULL)
+    return EXIT_FAILURE;
+  reference ref;
+  if (prepare_reference(&ref, refimg, kside, kside, kdeg, grid_ny, grid_nx) ==
+      EXIT_FAILURE) {
+    printf("Could not solve for the kernel. Exiting.\n");
+    free_reference(&ref);
     return EXIT_FAILURE;
   }
 
-  // Here do subtraction
-  double *diff_data = (double *)malloc(sizeof(double) * sciimg.n * sciimg.m);
-  int kpoly_dof = (kdeg + 1) * (kdeg + 2) / 2;
-  // The array total length for the kernel
-  int klen = kside * kside * kpoly_dof;
-  double *kernel = (double *)malloc(sizeof(double) * klen);
-  perform_subtraction(sciimg, refimg, kside, kside, kdeg, kernel, diff_data);
-  free(Ref);
-  free(Sci);
+  int status = EXIT_SUCCESS;
+  if (scifile != NULL) {
+    status = subtract_file(&ref, scifile, outputfile, out_bitpix, compress);
+  } else {
+    FILE *listfp = fopen(scilistfile, "r");
+    if (listfp == NULL) {
+      printf("Error opening file %s\n", scilistfile);
+      free_reference(&ref);
+      return EXIT_FAILURE;
+    }
+    // Each line has a science file and optionally its output file.
+    // The default output is diff_<science file name> in this directory.
+    int n_files = 0;
+    int capacity = 16;
+    char(*scifiles)[FILENAME_MAX] = malloc(capacity * sizeof(*scifiles));
+    char(*outputfiles)[FILENAME_MAX] = malloc(capacity * sizeof(*outputfiles));
+    // Read at most FILENAME_MAX - 1 characters per file name
+    char line_format[32];
+    snprintf(line_format, sizeof(line_format), "%%%ds %%%ds",
+             FILENAME_MAX - 1, FILENAME_MAX - 1);
+    char line[2 * FILENAME_MAX];
+    int out_of_memory = scifiles == NULL || outputfiles == NULL;
+    while (!out_of_memory && fgets(line, sizeof(line), listfp) != NULL) {
+      if (n_files == capacity) {
+        capacity *= 2;
+        void *more_scifiles = realloc(scifiles, capacity * sizeof(*scifiles));
+        if (more_scifiles != NULL)
+          scifiles = more_scifiles;
+        void *more_outputfiles =
+            realloc(outputfiles, capacity * sizeof(*outputfiles));
+        if (more_outputfiles != NULL)
+          outputfiles = more_outputfiles;
+        if (more_scifiles == NULL || more_outputfiles == NULL) {
+          out_of_memory = 1;
+          break;
+        }
+      }
+      char *sci = scifiles[n_files];
+      char *out = outputfiles[n_files];
+      int n_words = sscanf(line, line_format, sci, out);
+      if (n_words < 1 || sci[0] == '#')
+        continue;
+      if (n_words == 1) {
+        char *basename = strrchr(sci, '/');
+        basename = basename == NULL ? sci : basename + 1;
+        snprintf(out, FILENAME_MAX, "diff_%s", basename);
+      }
+      n_files++;
+    }
+    fclose(listfp);
+    if (out_of_memory) {
+      printf("ERROR: Out of memory reading %s.\n", scilistfile);
+      free(scifiles);
+      free(outputfiles);
+      free_reference(&ref);
+      return EXIT_FAILURE;
+    }
 
-  image diffimg = {diff_data, sciimg.n, sciimg.m};
-  int success = fits_write_to(outputfile, diffimg, scifile);
-  free(diff_data);
-  if (success == EXIT_FAILURE) {
-    printf("Problem writing diff FITS file.\n");
-    return EXIT_FAILURE;
+    // Each science file on its own thread. A file that fails is reported
+    // and the others are still processed.
+    int failed = 0;
+#pragma omp parallel for schedule(dynamic) reduction(| : failed)
+    for (int i = 0; i < n_files; i++) {
+      if (subtract_file(&ref, scifiles[i], outputfiles[i], out_bitpix,
+                        compress) == EXIT_FAILURE) {
+        printf("ERROR: Could not subtract %s.\n", scifiles[i]);
+        failed = 1;
+      }
+    }
+    status = failed ? EXIT_FAILURE : EXIT_SUCCESS;
+    free(scifiles);
+    free(outputfiles);
   }
-  // Do something with kernel?
-  free(kernel);
+  free_reference(&ref);
 
   clock_t end = clock();
   printf("The difference took %f seconds\n",
          (double)(end - begin) / CLOCKS_PER_SEC);
+  return status;
 }
 
-void perform_subtraction(image sciimg, image refimg, int kernel_height,
-                         int kernel_width, int kernel_polydeg, double *kernel,
-                         double *diff_data) {
+static int conv_block_rows(int total_dof, int m) {
+  // Build the basis images for a few rows at a time, not the whole image
+  int block_rows = CONV_BLOCK_SIZE / ((long)total_dof * m);
+  return block_rows < 1 ? 1 : block_rows;
+}
 
+static image crop(native_image img, grid_element *el) {
+  // A double copy of the grid element with its border
+  int sn = el->brow_stop - el->brow_start;
+  int sm = el->bcol_stop - el->bcol_start;
+  image cropped = {malloc((size_t)sn * sm * sizeof(double)), sn, sm};
+  native_to_double(img, el->brow_start, el->brow_stop, el->bcol_start,
+                   el->bcol_stop, cropped.data);
+  return cropped;
+}
+
+int prepare_reference(reference *ref, native_image refimg, int kernel_height,
+                      int kernel_width, int kernel_polydeg, int grid_ny,
+                      int grid_nx) {
+  /** Split the image in a grid_ny x grid_nx grid, as optimal_system with
+   * gridshape does in ois.py, and build and factor the matrix M of each
+   * grid element. M depends only on the reference, so it is reused for
+   * every science image. With OpenMP, elements run in parallel. An element
+   * whose M is singular is reported and left out of the differences (its
+   * pixels are NaN); only running out of memory is a failure. */
+  int n = refimg.n;
+  int m = refimg.m;
+  int k_spill_y = (kernel_height - 1) / 2;
+  int k_spill_x = (kernel_width - 1) / 2;
   int bkg_deg = -1;  // Don't fit background
   char *mask = NULL; // No masked pixels
-  int n = sciimg.n;
-  int m = sciimg.m;
-  // Create the linar matrix system to solve for kernel
-  lin_system result_sys =
-      build_matrix_system(n, m, sciimg.data, refimg.data, kernel_height,
-                          kernel_width, kernel_polydeg, bkg_deg, mask);
-
-  // Get kernel
-  // self.coeffs = np.linalg.solve(m, b)
-  solve_linear_system(result_sys.b_dim, result_sys.M, result_sys.b, kernel);
+  int total_dof =
+      system_dof(kernel_height, kernel_width, kernel_polydeg, bkg_deg);
+  ref->refimg = refimg;
+  ref->kernel_height = kernel_height;
+  ref->kernel_width = kernel_width;
+  ref->kernel_polydeg = kernel_polydeg;
+  ref->n_elements = grid_ny * grid_nx;
+  ref->elements = calloc(ref->n_elements, sizeof(grid_element));
+  if (ref->elements == NULL) {
+    printf("ERROR: Out of memory.\n");
+    ref->n_elements = 0;
+    return EXIT_FAILURE;
+  }
+  int failed = 0;
 
-  // Get opt_img by convolving ref_img with kernel
-  // opt_image = signal.convolve2d(self.refimage, self.get_kernel(),
-  // mode="same")
-  double *opt_data = (double *)malloc(n * m * sizeof(*opt_data));
-  convolve2d_adaptive(n, m, refimg.data, kernel_height, kernel_width,
-                      kernel_polydeg, kernel, opt_data);
+#pragma omp parallel for schedule(dynamic) reduction(| : failed)
+  for (int stamp = 0; stamp < ref->n_elements; stamp++) {
+    grid_element *el = ref->elements + stamp;
+    int i = stamp / grid_nx;
+    int j = stamp % grid_nx;
+    el->row_start = (int)((long)n * i / grid_ny);
+    el->row_stop = (int)((long)n * (i + 1) / grid_ny);
+    el->col_start = (int)((long)m * j / grid_nx);
+    el->col_stop = (int)((long)m * (j + 1) / grid_nx);
+    el->brow_start = el->row_start - k_spill_y > 0 ? el->row_start - k_spill_y
+                                                   : 0;
+    el->brow_stop = el->row_stop + k_spill_y < n ? el->row_stop + k_spill_y : n;
+    el->bcol_start = el->col_start - k_spill_x > 0 ? el->col_start - k_spill_x
+                                                   : 0;
+    el->bcol_stop = el->col_stop + k_spill_x < m ? el->col_stop + k_spill_x : m;
 
-  // subtract image - opt_image
-  for (int i = 0; i < n * m; ++i) {
-    diff_data[i] = sciimg.data[i] - opt_data[i];
+    // b is not needed, so the reference stands in for the science image
+    image ref_stamp = crop(refimg, el);
+    lin_system result_sys = build_matrix_system(
+        ref_stamp.n, ref_stamp.m, ref_stamp.data, ref_stamp.data,
+        kernel_height, kernel_width, kernel_polydeg, bkg_deg, mask,
+        conv_block_rows(total_dof, ref_stamp.m), 0, 0);
+    free(result_sys.b);
+    free(ref_stamp.data);
+    if (result_sys.M == NULL) {
+      printf("ERROR: Out of memory building grid element %d.\n", stamp);
+      failed = 1;
+      continue;
+    }
+    int info = normal_factor_init(&el->factor, total_dof, result_sys.M);
+    if (info < 0) {
+      printf("ERROR: Out of memory factoring grid element %d.\n", stamp);
+      failed = 1;
+    } else if (info > 0) {
+      printf("WARNING: The matrix system of grid element %d is singular "
+             "(pivot %d), its pixels are NaN in the differences.\n",
+             stamp, info);
+    }
+    if (info != 0)
+      normal_factor_free(&el->factor);
   }
+  return failed ? EXIT_FAILURE : EXIT_SUCCESS;
 }
 
-void solve_linear_system(int n, double *C, double *D, double *xcs) {
-  /** Solves the linear algebraic matrix system  */
-  int nsq = n * n;
-  double *Low = (double *)calloc(sizeof(double), nsq);
-  double *U = (double *)calloc(sizeof(double), nsq);
+int subtract_reference(reference *ref, char *scifile, double *diff_data) {
+  /** Fit the kernel of each grid element with the factored M and write the
+   * difference of the science image and the convolved reference to
+   * diff_data. The science image is read a grid element at a time. */
+  int bkg_deg = -1;
+  int kh = ref->kernel_height;
+  int kw = ref->kernel_width;
+  int kdeg = ref->kernel_polydeg;
+  int total_dof = system_dof(kh, kw, kdeg, bkg_deg);
+  int m = ref->refimg.m;
+  int failed = 0;
 
-  // Now we need to do the LU decomposition
-  for (int k = 0; k < n; k++) {
-    Low[k + k * n] = 1.0;
-    for (int i = k + 1; i < n; i++) {
-      Low[k + i * n] = C[k + i * n] / C[k + k * n];
-      for (int j = k + 1; j < n; j++) {
-        C[j + i * n] = C[j + i * n] - Low[k + i * n] * C[j + k * n];
+#pragma omp parallel for schedule(dynamic) reduction(| : failed)
+  for (int stamp = 0; stamp < ref->n_elements; stamp++) {
+    grid_element *el = ref->elements + stamp;
+    if (el->factor.F == NULL) {
+      for (int row = el->row_start; row < el->row_stop; row++) {
+        for (int col = el->col_start; col < el->col_stop; col++) {
+          diff_data[(size_t)row * m + col] = NAN;
+        }
       }
+      continue;
     }
-    for (int j = k; j < n; j++) {
-      U[j + k * n] = C[k + j * n];
+    image sci_stamp;
+    // cfitsio may not be built thread safe
+#pragma omp critical(fitsio)
+    sci_stamp = fits_get_region(scifile, el->brow_start, el->brow_stop,
+                                el->bcol_start, el->bcol_stop);
+    if (sci_stamp.data == NULL) {
+      failed = 1;
+      continue;
     }
-  }
+    image ref_stamp = crop(ref->refimg, el);
+    int sn = sci_stamp.n;
+    int sm = sci_stamp.m;
+    // The kernel coefficients
+    double *kernel = build_vector_b(
+        sn, sm, sci_stamp.data, ref_stamp.data, kh, kw, kdeg, bkg_deg, NULL,
+        conv_block_rows(total_dof, sm), 0, 0);
+    double *opt_data = malloc((size_t)sn * sm * sizeof(*opt_data));
+    if (kernel == NULL || opt_data == NULL) {
+      printf("ERROR: Out of memory subtracting grid element %d of %s.\n",
+             stamp, scifile);
+      free(opt_data);
+      free(kernel);
+      free(sci_stamp.data);
+      free(ref_stamp.data);
+      failed = 1;
+      continue;
+    }
+    normal_factor_solve(&el->factor, kernel);
 
-  // Now we will do Gaussian elimination
-  // Solve for xc
-  double *ycs = (double *)calloc(sizeof(double), n);
-  for (int i = 0; i < (n - 1); i++) {
-    for (int j = (i + 1); j < n; j++) {
-      double ratio = Low[j + i * n] / Low[i + i * n];
-      for (int count = i; count < n; count++) {
-        Low[count + j * n] -= ratio * Low[count + i * count];
+    convolve2d_adaptive(sn, sm, ref_stamp.data, kh, kw, kdeg, kernel,
+                        opt_data);
+    // Subtract without the border
+    for (int row = el->row_start; row < el->row_stop; row++) {
+      size_t stamp_row = (size_t)(row - el->brow_start) * sm;
+      for (int col = el->col_start; col < el->col_stop; col++) {
+        size_t stamp_index = stamp_row + (col - el->bcol_start);
+        diff_data[(size_t)row * m + col] =
+            sci_stamp.data[stamp_index] - opt_data[stamp_index];
       }
-      D[j] -= (ratio * D[i]);
     }
+    free(opt_data);
+    free(kernel);
+    free(sci_stamp.data);
+    free(ref_stamp.data);
   }
-  ycs[n - 1] = D[n - 1] / Low[(n - 1) + n * (n - 1)];
-  for (int i = (n - 2); i >= 0; i--) {
-    double temp = D[i];
-    for (int j = (i + 1); j < n; j++) {
-      temp -= (Low[j + i * n] * ycs[j]);
-    }
-    ycs[i] = temp / Low[i + i * n];
+  return failed ? EXIT_FAILURE : EXIT_SUCCESS;
+}
+
+int subtract_file(reference *ref, char *scifile, char *outputfile, int bitpix,
+                  int compress) {
+  /** Subtract the reference from the science FITS file and write the
+   * difference to outputfile with pixel type bitpix, Rice compressed if
+   * compress is not 0. */
+  int n, m, success;
+  // cfitsio may not be built thread safe
+#pragma omp critical(fitsio)
+  success = fits_get_shape(scifile, &n, &m);
+  if (success == EXIT_FAILURE)
+    return EXIT_FAILURE;
+
+  // Put a guard in case images are of different shape
+  if (ref->refimg.n != n || ref->refimg.m != m) {
+    printf("ERROR: Reference and Science images have different dimensions "
+           "(%s).\n",
+           scifile);
+    return EXIT_FAILURE;
   }
 
-  // Solve for xc
-  for (int i = 0; i < (n - 1); i++) {
-    for (int j = (i + 1); j < n; j++) {
-      double ratio = U[j + i * n] / U[i + i * n];
-      for (int count = i; count < n; count++) {
-        U[count + j * n] -= ratio * Low[count + i * count];
-      }
-      ycs[j] -= (ratio * ycs[i]);
-    }
+  double *diff_data = (double *)malloc(sizeof(double) * (size_t)n * m);
+  if (subtract_reference(ref, scifile, diff_data) == EXIT_FAILURE) {
+    free(diff_data);
+    return EXIT_FAILURE;
   }
-  xcs[n - 1] = ycs[n - 1] / U[(n - 1) + n * (n - 1)];
-  for (int i = (n - 2); i >= 0; i--) {
-    double temp = ycs[i];
-    for (int j = (i + 1); j < n; j++) {
-      temp -= U[j + i * n] * xcs[j];
-    }
-    xcs[i] = temp / U[i + i * n];
+
+  image diffimg = {diff_data, n, m};
+#pragma omp critical(fitsio)
+  success = fits_write_image(outputfile, diffimg, scifile, bitpix, compress);
+  free(diff_data);
+  if (success == EXIT_FAILURE) {
+    printf("Problem writing diff FITS file %s.\n", outputfile);
+    return EXIT_FAILURE;
   }
+  return EXIT_SUCCESS;
+}
 
-  // free everything//
-  free(ycs);
-  free(U);
-  free(Low);
+void free_reference(reference *ref) {
+  for (int i = 0; i < ref->n_elements; i++) {
+    normal_factor_free(&ref->elements[i].factor);
+  }
+  free(ref->elements);
+  free(ref->refimg.data);
 }
 
 void usage(char *exec_name) {
@@ -239,7 +462,8 @@ void usage(char *exec_name) {
   printf("------------------------\n\n");
   printf(
       "usage: %s -ks, --kernel-side <int> -kd, --kernel-poly-deg <int> -ref "
-      "<filename> -sci <filename> [-o <filename>] [-h, --help] [--version]\n\n",
+      "<filename> (-sci <filename> | -sci-list <filename>) [-grid NYxNX] "
+      "[-o <filename>] [-float32] [-rice] [-h, --help] [--version]\n\n",
       exec_basename);
   printf("Arguments:\n");
   printf("\t-ks, --kernel-side: the side in pixels of the kernel to calculate "
@@ -248,8 +472,20 @@ void usage(char *exec_name) {
          "the variable kernel.\n");
   printf("\t-ref: The reference image path.\n");
   printf("\t-sci: The science image path.\n");
-  printf("\t-o [optional]: The path to the subtraction fits file.\n");
+  printf("\t-sci-list: A text file with a science image path per line, "
+         "optionally followed by its output path (default "
+         "\"diff_<science file name>\"). The reference is processed once "
+         "for all of them.\n");
+  printf("\t-grid [optional]: Fit the kernel independently on each element "
+         "of a NY by NX grid, e.g. 4x4. Default is 1x1.\n");
+  printf("\t-o [optional]: The path to the subtraction fits file with "
+         "-sci. Not allowed with -sci-list, whose output paths are in the "
+         "list.\n");
   printf("\t\tDefault value is \"diff_img.fits\".\n");
+  printf("\t-float32 [optional]: Write the difference as 32 bit floats "
+         "instead of doubles.\n");
+  printf("\t-rice [optional]: Rice tile-compress the difference. Floats are "
+         "quantized by cfitsio to a fraction of the noise.\n");
   printf("\t-h, --help: Print this help and exit.\n");
   printf("\t--version: Print version information and exit.\n");
   printf("\n");
@@ -1,108 +1,561 @@
 #include "oistools.h"
-
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+#ifdef USE_LAPACK
+// Fortran LAPACK, for column-major matrices
+void dpotrf_(char *uplo, int *n, double *a, int *lda, int *info);
+void dpotrs_(char *uplo, int *n, int *nrhs, double *a, int *lda, double *b,
+             int *ldb, int *info);
+void dgetrf_(int *m, int *n, double *a, int *lda, int *ipiv, int *info);
+void dgetrs_(char *trans, int *n, int *nrhs, double *a, int *lda, int *ipiv,
+             double *b, int *ldb, int *info);
+#endif
+
+// Side of the diagonal blocks of the blocked Cholesky factorization
+#define CHOLESKY_BLOCK 64
+
+double *power_table(int deg, long start, long len);
 double multiply_and_sum(size_t nsize, double *C1, double *C2);
 double multiply_and_sum_mask(size_t nsize, double *C1, double *C2, char *mask);
+double multiply_and_sum_float(size_t nsize, float *C1, float *C2);
+double multiply_and_sum_mask_float(size_t nsize, float *C1, float *C2,
+                                   char *mask);
+int all_masked(size_t nsize, char *mask);
 void fill_c_matrices_for_kernel(int k_height, int k_width, int deg, int n,
-                                int m, double *refimage, double *Conv);
-void fill_c_matrices_for_background(int n, int m, int bkg_deg,
-                                    double *Conv_bkg);
+                                int m, int row_start, int n_rows,
+                                double *refimage, void *Conv, int single,
+                                int n_threads);
+void fill_c_matrices_for_background(int m, int row_start, int n_rows,
+                                    int bkg_deg, void *Conv, size_t start,
+                                    int single);
+
+int accumulate_system(int n, int m, double *image, double *refimage,
+                      int kernel_height, int kernel_width, int kernel_polydeg,
+                      int bkg_deg, char *mask, int block_rows, int n_threads,
+                      int single, double *M, double *b);
+
+// The basis images (Conv) are double, or float if single is set.
+static inline void set_conv(void *Conv, size_t index, double value,
+                            int single) {
+  if (single)
+    ((float *)Conv)[index] = (float)value;
+  else
+    ((double *)Conv)[index] = value;
+}
 
-lin_system build_matrix_system(int n, int m, double *image, double *refimage,
-                               int kernel_height, int kernel_width,
-                               int kernel_polydeg, int bkg_deg, char *mask) {
-  int kernel_size = kernel_height * kernel_width;
-  int img_size = n * m;
-  int kpdeg = kernel_polydeg;
-  int poly_degree = (kpdeg + 1) * (kpdeg + 2) / 2;
-  int bkg_dof;
+static inline void *conv_at(void *Conv, size_t index, int single) {
+  if (single)
+    return (float *)Conv + index;
+  return (double *)Conv + index;
+}
 
-  bkg_dof = (bkg_deg + 1) * (bkg_deg + 2) / 2;
+static double conv_dot(size_t nsize, void *C1, void *C2, char *mask,
+                       int single) {
+  // Products are always accumulated in double
+  if (single) {
+    if (mask == NULL)
+      return multiply_and_sum_float(nsize, C1, C2);
+    return multiply_and_sum_mask_float(nsize, C1, C2, mask);
+  }
+  if (mask == NULL)
+    return multiply_and_sum(nsize, C1, C2);
+  return multiply_and_sum_mask(nsize, C1, C2, mask);
+}
 
-  size_t conv_size = ((size_t)img_size) * (kernel_size * poly_degree + bkg_dof);
-  double *Conv = calloc(conv_size, sizeof(*Conv)); // TODO err on bad calloc
+int system_dof(int kernel_height, int kernel_width, int kernel_polydeg,
+               int bkg_deg) {
+  int poly_dof = (kernel_polydeg + 1) * (kernel_polydeg + 2) / 2;
+  int bkg_dof = (bkg_deg + 1) * (bkg_deg + 2) / 2;
+  return kernel_height * kernel_width * poly_dof + bkg_dof;
+}
 
-  fill_c_matrices_for_kernel(kernel_height, kernel_width, kernel_polydeg, n, m,
-                             refimage, Conv);
-  double *Conv_bkg;
-  if (bkg_deg != -1) {
-    Conv_bkg = Conv + img_size * kernel_size * poly_degree;
-    fill_c_matrices_for_background(n, m, bkg_deg, Conv_bkg);
-  }
+lin_system build_matrix_system(int n, int m, double *image, double *refimage,
+                               int kernel_height, int kernel_width,
+                               int kernel_polydeg, int bkg_deg, char *mask,
+                               int block_rows, int n_threads, int single) {
+  /** Return M and b of the system. If out of memory, M and b are NULL. */
+  int total_dof =
+      system_dof(kernel_height, kernel_width, kernel_polydeg, bkg_deg);
 
   // Create matrices M and vector b
-  int total_dof = kernel_size * poly_degree + bkg_dof;
-  size_t M_size = ((size_t)total_dof) * total_dof * sizeof(double);
-  size_t b_size = ((size_t)total_dof) * sizeof(double);
-  double *M = malloc(M_size);
-  double *b = malloc(b_size);
-  if (mask != NULL) {
-    for (size_t i = 0; i < total_dof; i++) {
-      double *C1 = Conv + i * img_size;
-      for (size_t j = i; j < total_dof; j++) {
-        double *C2 = Conv + j * img_size;
-        M[i * total_dof + j] = multiply_and_sum_mask(img_size, C1, C2, mask);
-        M[j * total_dof + i] = M[i * total_dof + j];
-      }
-      b[i] = multiply_and_sum_mask(img_size, image, C1, mask);
-    }
-  } else {
-    for (size_t i = 0; i < total_dof; i++) {
-      double *C1 = Conv + i * img_size;
-      for (size_t j = i; j < total_dof; j++) {
-        double *C2 = Conv + j * img_size;
-        M[i * total_dof + j] = multiply_and_sum(img_size, C1, C2);
-        M[j * total_dof + i] = M[i * total_dof + j];
-      }
-      b[i] = multiply_and_sum(img_size, image, C1);
+  size_t M_size = ((size_t)total_dof) * total_dof;
+  double *M = calloc(M_size, sizeof(*M));
+  double *b = calloc(total_dof, sizeof(*b));
+  if (M == NULL || b == NULL ||
+      accumulate_system(n, m, image, refimage, kernel_height, kernel_width,
+                        kernel_polydeg, bkg_deg, mask, block_rows, n_threads,
+                        single, M, b) != 0) {
+    free(M);
+    free(b);
+    lin_system no_system = {total_dof, NULL, NULL};
+    return no_system;
+  }
+
+  for (long i = 0; i < total_dof; i++) {
+    for (long j = i + 1; j < total_dof; j++) {
+      M[j * total_dof + i] = M[i * total_dof + j];
     }
   }
 
-  free(Conv);
   lin_system the_system = {total_dof, M, b};
 
   return the_system;
 }
 
+double *build_vector_b(int n, int m, double *image, double *refimage,
+                       int kernel_height, int kernel_width, int kernel_polydeg,
+                       int bkg_deg, char *mask, int block_rows, int n_threads,
+                       int single) {
+  /** Return b of the system, or NULL if out of memory. */
+  int total_dof =
+      system_dof(kernel_height, kernel_width, kernel_polydeg, bkg_deg);
+  double *b = calloc(total_dof, sizeof(*b));
+  if (b == NULL ||
+      accumulate_system(n, m, image, refimage, kernel_height, kernel_width,
+                        kernel_polydeg, bkg_deg, mask, block_rows, n_threads,
+                        single, NULL, b) != 0) {
+    free(b);
+    return NULL;
+  }
+  return b;
+}
+
+int accumulate_system(int n, int m, double *image, double *refimage,
+                      int kernel_height, int kernel_width, int kernel_polydeg,
+                      int bkg_deg, char *mask, int block_rows, int n_threads,
+                      int single, double *M, double *b) {
+  /** Add the upper triangle of M and the vector b of the system to the
+   * given arrays. If M is NULL, only b is computed. If single is set the
+   * basis images are kept in float, M and b are still summed in double.
+   * Return 0, or -1 if out of memory. */
+  int kernel_size = kernel_height * kernel_width;
+  int kpdeg = kernel_polydeg;
+  int poly_degree = (kpdeg + 1) * (kpdeg + 2) / 2;
+#ifdef _OPENMP
+  if (n_threads <= 0)
+    n_threads = omp_get_max_threads();
+#endif
+
+  int kernel_dof = kernel_size * poly_degree;
+  int total_dof =
+      system_dof(kernel_height, kernel_width, kernel_polydeg, bkg_deg);
+
+  // The basis images (Conv) are only built for a block of block_rows rows
+  // at a time and their products are accumulated into M and b. With one
+  // block the whole image is done at once.
+  if (block_rows <= 0 || block_rows > n)
+    block_rows = n;
+  size_t block_size = ((size_t)block_rows) * m;
+  size_t conv_size = block_size * total_dof;
+  size_t conv_elem = single ? sizeof(float) : sizeof(double);
+  void *Conv = malloc(conv_size * conv_elem);
+  // With single, the image block is copied to float like the basis images
+  float *image_float = single ? malloc(block_size * sizeof(float)) : NULL;
+  if (Conv == NULL || (single && image_float == NULL)) {
+    free(image_float);
+    free(Conv);
+    return -1;
+  }
+
+  for (int row_start = 0; row_start < n; row_start += block_rows) {
+    int n_rows = block_rows < n - row_start ? block_rows : n - row_start;
+    size_t n_pix = ((size_t)n_rows) * m;
+    size_t offset = ((size_t)row_start) * m;
+    // Blocks with no good pixels add nothing to the system
+    if (mask != NULL && all_masked(n_pix, mask + offset))
+      continue;
+
+    fill_c_matrices_for_kernel(kernel_height, kernel_width, kernel_polydeg, n,
+                               m, row_start, n_rows, refimage, Conv, single,
+                               n_threads);
+    if (bkg_deg != -1) {
+      fill_c_matrices_for_background(m, row_start, n_rows, bkg_deg, Conv,
+                                     kernel_dof * n_pix, single);
+    }
+    void *image_block = image + offset;
+    if (single) {
+      for (size_t i = 0; i < n_pix; i++)
+        image_float[i] = (float)image[offset + i];
+      image_block = image_float;
+    }
+    char *mask_block = mask == NULL ? NULL : mask + offset;
+
+    // Each row i of the upper triangle is independent. Rows get shorter as i
+    // grows, so they are handed out dynamically to balance the threads.
+#pragma omp parallel for schedule(dynamic) num_threads(n_threads)
+    for (long i = 0; i < total_dof; i++) {
+      void *C1 = conv_at(Conv, i * n_pix, single);
+      for (long j = i; j < total_dof && M != NULL; j++) {
+        void *C2 = conv_at(Conv, j * n_pix, single);
+        M[i * total_dof + j] += conv_dot(n_pix, C1, C2, mask_block, single);
+      }
+      b[i] += conv_dot(n_pix, image_block, C1, mask_block, single);
+    }
+  }
+  free(image_float);
+  free(Conv);
+  return 0;
+}
+
 void convolve2d_adaptive(int n, int m, double *image, int kernel_height,
                          int kernel_width, int kernel_polydeg, double *kernel,
                          double *Conv) {
   // int k_side = kernel_height;
   int k_poly_dof = (kernel_polydeg + 1) * (kernel_polydeg + 2) / 2;
+  int khs = kernel_height / 2; // kernel half side
+  int kws = kernel_width / 2;
+  double *x_pow = power_table(kernel_polydeg, 0, m);
+  double *y_pow = power_table(kernel_polydeg, 0, n);
+  double monomials[k_poly_dof];
 
   for (long conv_row = 0; conv_row < n; ++conv_row) {
+    // Kernel rows p that fall inside the image for this conv_row
+    int p_min = conv_row + khs - n + 1 > 0 ? conv_row + khs - n + 1 : 0;
+    int p_max = conv_row + khs < kernel_height - 1 ? conv_row + khs
+                                                   : kernel_height - 1;
     for (long conv_col = 0; conv_col < m; ++conv_col) {
-      int conv_index = conv_row * m + conv_col;
-
-      for (int p = 0; p < kernel_height; p++) {
-        for (int q = 0; q < kernel_width; q++) {
-          long img_row =
-              conv_row - (p - kernel_height / 2); // khs is kernel half side
-          long img_col = conv_col - (q - kernel_width / 2);
-          size_t img_index = img_row * m + img_col;
-
-          // do only if img_index is in bounds of image
-          if (img_row >= 0 && img_col >= 0 && img_row < n && img_col < m) {
-
-            // reconstruct the (p, q) pixel of kernel
-            double k_pixel = 0.0;
-            // advance k_coeffs pointer to the p, q part
-            double *k_coeffs_pq = kernel + (p * kernel_width + q) * k_poly_dof;
-            size_t exp_index = 0;
-            for (int exp_x = 0; exp_x <= kernel_polydeg; exp_x++) {
-              for (int exp_y = 0; exp_y <= kernel_polydeg - exp_x; exp_y++) {
-                k_pixel += k_coeffs_pq[exp_index] * pow(conv_row, exp_y) *
-                           pow(conv_col, exp_x);
-                exp_index++;
-              }
-            }
+      size_t conv_index = conv_row * m + conv_col;
+      int q_min = conv_col + kws - m + 1 > 0 ? conv_col + kws - m + 1 : 0;
+      int q_max =
+          conv_col + kws < kernel_width - 1 ? conv_col + kws : kernel_width - 1;
+
+      // x^exp_x * y^exp_y at this pixel, in the kernel coefficient order
+      size_t exp_index = 0;
+      for (int exp_x = 0; exp_x <= kernel_polydeg; exp_x++) {
+        for (int exp_y = 0; exp_y <= kernel_polydeg - exp_x; exp_y++) {
+          monomials[exp_index] = x_pow[exp_x * m + conv_col] *
+                                 y_pow[exp_y * n + conv_row];
+          exp_index++;
+        }
+      }
 
-            Conv[conv_index] += image[img_index] * k_pixel;
+      double conv_pixel = 0.0;
+      for (int p = p_min; p <= p_max; p++) {
+        long img_row = conv_row - (p - khs);
+        for (int q = q_min; q <= q_max; q++) {
+          long img_col = conv_col - (q - kws);
+          // reconstruct the (p, q) pixel of kernel
+          double *k_coeffs_pq = kernel + (p * kernel_width + q) * k_poly_dof;
+          double k_pixel = 0.0;
+          for (int d = 0; d < k_poly_dof; d++) {
+            k_pixel += k_coeffs_pq[d] * monomials[d];
           }
+          conv_pixel += image[img_row * m + img_col] * k_pixel;
         }
       }
+      Conv[conv_index] = conv_pixel;
 
     } // conv_col
   }   // conv_row
+  free(x_pow);
+  free(y_pow);
+}
+
+void eval_adaptive_kernel_grid(int n_pos, double *xs, double *ys,
+                               int kernel_height, int kernel_width,
+                               int kernel_polydeg, double *kernel,
+                               double *kernels) {
+  /** Evaluate the adaptive kernel at the n_pos positions (xs[i], ys[i]) =
+   * (col, row) and write them one after the other to kernels, which holds
+   * n_pos * kernel_height * kernel_width values. */
+  int k_poly_dof = (kernel_polydeg + 1) * (kernel_polydeg + 2) / 2;
+  int k_pix = kernel_height * kernel_width;
+
+#pragma omp parallel for
+  for (int i = 0; i < n_pos; i++) {
+    // x^exp_x * y^exp_y at this position, in the kernel coefficient order
+    double monomials[k_poly_dof];
+    size_t exp_index = 0;
+    double x_power = 1.0;
+    for (int exp_x = 0; exp_x <= kernel_polydeg; exp_x++) {
+      double y_power = 1.0;
+      for (int exp_y = 0; exp_y <= kernel_polydeg - exp_x; exp_y++) {
+        monomials[exp_index++] = x_power * y_power;
+        y_power *= ys[i];
+      }
+      x_power *= xs[i];
+    }
+    double *k_xy = kernels + (size_t)i * k_pix;
+    for (int pq = 0; pq < k_pix; pq++) {
+      double *k_coeffs_pq = kernel + (size_t)pq * k_poly_dof;
+      double k_pixel = 0.0;
+      for (int d = 0; d < k_poly_dof; d++) {
+        k_pixel += k_coeffs_pq[d] * monomials[d];
+      }
+      k_xy[pq] = k_pixel;
+    }
+  }
+}
+
+int cholesky_factor(int n, double *M) {
+  /** Overwrite the lower triangle of the symmetric positive definite n x n
+   * matrix M with its Cholesky factor L, M = L L^T. Only the lower triangle
+   * of M is read. Return 0, or the index (from 1) of the first leading minor
+   * of M that is not positive definite, as LAPACK does. Built with
+   * -DUSE_LAPACK, LAPACK dpotrf does the work. */
+#ifdef USE_LAPACK
+  // A row-major lower triangle is a column-major upper triangle
+  char uplo = 'U';
+  int info = 0;
+  dpotrf_(&uplo, &n, M, &n, &info);
+  return info;
+#else
+  // Right-looking blocked factorization. Every inner loop runs along rows,
+  // so the panel rows stay in cache while the trailing matrix is updated.
+  for (int kb = 0; kb < n; kb += CHOLESKY_BLOCK) {
+    int kend = kb + CHOLESKY_BLOCK < n ? kb + CHOLESKY_BLOCK : n;
+    // Factor the diagonal block
+    for (int j = kb; j < kend; j++) {
+      double *row_j = M + (size_t)j * n;
+      double diag = row_j[j];
+      for (int p = kb; p < j; p++) {
+        diag -= row_j[p] * row_j[p];
+      }
+      if (!(diag > 0.0))
+        return j + 1;
+      row_j[j] = sqrt(diag);
+      for (int i = j + 1; i < kend; i++) {
+        double *row_i = M + (size_t)i * n;
+        double sum = row_i[j];
+        for (int p = kb; p < j; p++) {
+          sum -= row_i[p] * row_j[p];
+        }
+        row_i[j] = sum / row_j[j];
+      }
+    }
+    // Solve for the panel below it
+#pragma omp parallel for schedule(static)
+    for (int i = kend; i < n; i++) {
+      double *row_i = M + (size_t)i * n;
+      for (int j = kb; j < kend; j++) {
+        double *row_j = M + (size_t)j * n;
+        double sum = row_i[j];
+        for (int p = kb; p < j; p++) {
+          sum -= row_i[p] * row_j[p];
+        }
+        row_i[j] = sum / row_j[j];
+      }
+    }
+    // Update the lower triangle of the trailing matrix
+#pragma omp parallel for schedule(dynamic, 16)
+    for (int i = kend; i < n; i++) {
+      double *row_i = M + (size_t)i * n;
+      for (int j = kend; j <= i; j++) {
+        double *row_j = M + (size_t)j * n;
+        double sum = 0.0;
+        for (int p = kb; p < kend; p++) {
+          sum += row_i[p] * row_j[p];
+        }
+        row_i[j] -= sum;
+      }
+    }
+  }
+  return 0;
+#endif
+}
+
+void cholesky_solve(int n, double *L, double *b) {
+  /** Overwrite b with the solution x of L L^T x = b, with L the factor made
+   * by cholesky_factor. L is not changed, so it can be reused. */
+#ifdef USE_LAPACK
+  char uplo = 'U';
+  int nrhs = 1;
+  int info = 0;
+  dpotrs_(&uplo, &n, &nrhs, L, &n, b, &n, &info);
+#else
+  // Forward substitution, L y = b
+  for (int i = 0; i < n; i++) {
+    double *row_i = L + (size_t)i * n;
+    double sum = b[i];
+    for (int p = 0; p < i; p++) {
+      sum -= row_i[p] * b[p];
+    }
+    b[i] = sum / row_i[i];
+  }
+  // Back substitution, L^T x = y, subtracting each solved x along a row of L
+  for (int i = n - 1; i >= 0; i--) {
+    double *row_i = L + (size_t)i * n;
+    b[i] /= row_i[i];
+    for (int p = 0; p < i; p++) {
+      b[p] -= row_i[p] * b[i];
+    }
+  }
+#endif
+}
+
+int solve_cholesky(int n, double *M, double *b) {
+  /** Solve M x = b for a symmetric positive definite M. M is overwritten
+   * with its Cholesky factor and b with x. Return as cholesky_factor. */
+  int info = cholesky_factor(n, M);
+  if (info == 0)
+    cholesky_solve(n, M, b);
+  return info;
+}
+
+static int lu_factor(int n, double *A, int *pivots) {
+  // Overwrite the n x n matrix A with its LU factors with partial pivoting,
+  // P A = L U, L with a unit diagonal. Return 0, or the index (from 1) of
+  // the first exactly zero pivot, as LAPACK dgetrf does.
+#ifdef USE_LAPACK
+  // The transpose of a symmetric A is A, so the column-major factors are
+  // those of A too
+  int info = 0;
+  dgetrf_(&n, &n, A, &n, pivots, &info);
+  return info;
+#else
+  for (int k = 0; k < n; k++) {
+    int p = k;
+    for (int i = k + 1; i < n; i++) {
+      if (fabs(A[(size_t)i * n + k]) > fabs(A[(size_t)p * n + k]))
+        p = i;
+    }
+    pivots[k] = p;
+    if (A[(size_t)p * n + k] == 0.0)
+      return k + 1;
+    if (p != k) {
+      double *row_k = A + (size_t)k * n;
+      double *row_p = A + (size_t)p * n;
+      for (int j = 0; j < n; j++) {
+        double tmp = row_k[j];
+        row_k[j] = row_p[j];
+        row_p[j] = tmp;
+      }
+    }
+    double *row_k = A + (size_t)k * n;
+#pragma omp parallel for schedule(static)
+    for (int i = k + 1; i < n; i++) {
+      double *row_i = A + (size_t)i * n;
+      double l = row_i[k] / row_k[k];
+      row_i[k] = l;
+      for (int j = k + 1; j < n; j++) {
+        row_i[j] -= l * row_k[j];
+      }
+    }
+  }
+  return 0;
+#endif
+}
+
+static void lu_solve(int n, double *LU, int *pivots, double *b) {
+  // Overwrite b with the solution x of A x = b, with LU and pivots made by
+  // lu_factor
+#ifdef USE_LAPACK
+  char trans = 'N';
+  int nrhs = 1;
+  int info = 0;
+  dgetrs_(&trans, &n, &nrhs, LU, &n, pivots, b, &n, &info);
+#else
+  for (int i = 0; i < n; i++) {
+    double tmp = b[i];
+    b[i] = b[pivots[i]];
+    b[pivots[i]] = tmp;
+  }
+  // Forward substitution, L y = P b
+  for (int i = 0; i < n; i++) {
+    double *row_i = LU + (size_t)i * n;
+    double sum = b[i];
+    for (int p = 0; p < i; p++) {
+      sum -= row_i[p] * b[p];
+    }
+    b[i] = sum;
+  }
+  // Back substitution, U x = y
+  for (int i = n - 1; i >= 0; i--) {
+    double *row_i = LU + (size_t)i * n;
+    double sum = b[i];
+    for (int p = i + 1; p < n; p++) {
+      sum -= row_i[p] * b[p];
+    }
+    b[i] = sum / row_i[i];
+  }
+#endif
+}
+
+int normal_factor_init(normal_factor *f, int n, double *M) {
+  /** Factor the symmetric matrix M of a normal system, taking ownership of
+   * it. M is scaled to a unit diagonal first (Jacobi scaling, as
+   * _NormalSolver in ois.py), since the kernel and background columns of M
+   * differ by many orders of magnitude. If the scaled M is not positive
+   * definite, as it is when it is singular to rounding, it is factored with
+   * partial pivoting LU instead, as solver="lu" in ois.py. Return 0, -1 if
+   * out of memory, or the index (from 1) of an exactly zero LU pivot. */
+  f->n = n;
+  f->F = M;
+  f->scale = malloc(n * sizeof(double));
+  f->pivots = NULL;
+  double *diag = malloc(n * sizeof(double));
+  if (f->scale == NULL || diag == NULL) {
+    free(diag);
+    return -1;
+  }
+  for (int i = 0; i < n; i++) {
+    double d = M[(size_t)i * n + i];
+    f->scale[i] = d > 0.0 ? 1.0 / sqrt(d) : 1.0;
+  }
+#pragma omp parallel for schedule(static)
+  for (int i = 0; i < n; i++) {
+    double *row_i = M + (size_t)i * n;
+    for (int j = 0; j < n; j++) {
+      row_i[j] *= f->scale[i] * f->scale[j];
+    }
+    diag[i] = row_i[i];
+  }
+  int info = cholesky_factor(n, M);
+  if (info != 0) {
+    // Only the lower triangle was overwritten, restore it from the upper
+    for (int i = 0; i < n; i++) {
+      double *row_i = M + (size_t)i * n;
+      for (int j = 0; j < i; j++) {
+        row_i[j] = M[(size_t)j * n + i];
+      }
+      row_i[i] = diag[i];
+    }
+    f->pivots = malloc(n * sizeof(int));
+    info = f->pivots == NULL ? -1 : lu_factor(n, M, f->pivots);
+  }
+  free(diag);
+  return info;
+}
+
+void normal_factor_solve(normal_factor *f, double *b) {
+  /** Overwrite b with the solution x of M x = b, with f made by
+   * normal_factor_init. f is not changed, so it can be reused. */
+  int n = f->n;
+  for (int i = 0; i < n; i++) {
+    b[i] *= f->scale[i];
+  }
+  if (f->pivots == NULL)
+    cholesky_solve(n, f->F, b);
+  else
+    lu_solve(n, f->F, f->pivots, b);
+  for (int i = 0; i < n; i++) {
+    b[i] *= f->scale[i];
+  }
+}
+
+void normal_factor_free(normal_factor *f) {
+  free(f->F);
+  free(f->scale);
+  free(f->pivots);
+  f->F = NULL;
+  f->scale = NULL;
+  f->pivots = NULL;
+}
+
+double *power_table(int deg, long start, long len) {
+  /** Return a (deg + 1) x len table with table[e * len + i] = (start + i)^e */
+  double *table = malloc((deg + 1) * len * sizeof(*table));
+  for (long i = 0; i < len; i++) {
+    table[i] = 1.0;
+  }
+  for (int e = 1; e <= deg; e++) {
+    for (long i = 0; i < len; i++) {
+      table[e * len + i] = table[(e - 1) * len + i] * (start + i);
+    }
+  }
+  return table;
 }
 
 double multiply_and_sum(size_t nsize, double *C1, double *C2) {
@@ -122,34 +575,71 @@ double multiply_and_sum_mask(size_t nsize, double *C1, double *C2, char *mask) {
   return result;
 }
 
+double multiply_and_sum_float(size_t nsize, float *C1, float *C2) {
+  double result = 0.0;
+  for (size_t i = 0; i < nsize; i++) {
+    result += (double)C1[i] * C2[i];
+  }
+  return result;
+}
+
+double multiply_and_sum_mask_float(size_t nsize, float *C1, float *C2,
+                                   char *mask) {
+  double result = 0.0;
+  for (size_t i = 0; i < nsize; i++) {
+    if (mask[i] == 0)
+      result += (double)C1[i] * C2[i];
+  }
+  return result;
+}
+
+int all_masked(size_t nsize, char *mask) {
+  for (size_t i = 0; i < nsize; i++) {
+    if (!mask[i])
+      return 0;
+  }
+  return 1;
+}
+
 void fill_c_matrices_for_kernel(int k_height, int k_width, int deg, int n,
-                                int m, double *refimage, double *Conv) {
+                                int m, int row_start, int n_rows,
+                                double *refimage, void *Conv, int single,
+                                int n_threads) {
 
-  size_t img_size = n * m;
+  // Conv holds the basis images for rows [row_start, row_start + n_rows)
+  size_t img_size = ((size_t)n_rows) * m;
   int poly_degree = (deg + 1) * (deg + 2) / 2;
 
-  for (size_t p = 0; p < k_height; p++) {
-    for (size_t q = 0; q < k_width; q++) {
-      double *Conv_pq = Conv + (p * k_width + q) * poly_degree * img_size;
+  double *x_pow = power_table(deg, 0, m);
+  double *y_pow = power_table(deg, row_start, n_rows);
+
+  // Every kernel pixel (p, q) fills its own slices of Conv
+#pragma omp parallel for collapse(2) num_threads(n_threads)
+  for (long p = 0; p < k_height; p++) {
+    for (long q = 0; q < k_width; q++) {
+      size_t pq_start = (p * k_width + q) * poly_degree * img_size;
 
       size_t exp_index = 0;
       for (int exp_x = 0; exp_x <= deg; exp_x++) {
         for (int exp_y = 0; exp_y <= deg - exp_x; exp_y++) {
-          double *Conv_pqkl = Conv_pq + exp_index * img_size;
+          size_t pqkl_start = pq_start + exp_index * img_size;
+          double *x_pow_e = x_pow + exp_x * m;
 
-          for (long conv_row = 0; conv_row < n; ++conv_row) {
+          for (long conv_row = row_start; conv_row < row_start + n_rows;
+               ++conv_row) {
+            double y_pow_e = y_pow[exp_y * n_rows + conv_row - row_start];
             for (long conv_col = 0; conv_col < m; ++conv_col) {
-              size_t conv_index = conv_row * m + conv_col;
+              size_t conv_index = (conv_row - row_start) * m + conv_col;
               long img_row =
                   conv_row - (p - k_height / 2); // khs is kernel half side
               long img_col = conv_col - (q - k_width / 2);
               size_t img_index = img_row * m + img_col;
-              double x_pow = pow(conv_col, exp_x);
-              double y_pow = pow(conv_row, exp_y);
               // make sure img_index is in bounds of refimage
+              double value = 0.0;
               if (img_row >= 0 && img_col >= 0 && img_row < n && img_col < m) {
-                Conv_pqkl[conv_index] = refimage[img_index] * x_pow * y_pow;
+                value = refimage[img_index] * x_pow_e[conv_col] * y_pow_e;
               }
+              set_conv(Conv, pqkl_start + conv_index, value, single);
             } // conv_col
           }   // conv_row
 
@@ -160,31 +650,39 @@ void fill_c_matrices_for_kernel(int k_height, int k_width, int deg, int n,
     } // q
   }   // p
 
+  free(x_pow);
+  free(y_pow);
   return;
 }
 
-void fill_c_matrices_for_background(int n, int m, int bkg_deg,
-                                    double *Conv_bkg) {
+void fill_c_matrices_for_background(int m, int row_start, int n_rows,
+                                    int bkg_deg, void *Conv, size_t start,
+                                    int single) {
+  // The background basis images go in Conv from element start onwards
 
+  size_t img_size = ((size_t)n_rows) * m;
+  double *x_pow = power_table(bkg_deg, 0, m);
+  double *y_pow = power_table(bkg_deg, row_start, n_rows);
   int exp_index = 0;
-  for (size_t exp_x = 0; exp_x <= bkg_deg; exp_x++) {
-    for (size_t exp_y = 0; exp_y <= bkg_deg - exp_x; exp_y++) {
+  for (int exp_x = 0; exp_x <= bkg_deg; exp_x++) {
+    for (int exp_y = 0; exp_y <= bkg_deg - exp_x; exp_y++) {
 
-      double *Conv_xy = Conv_bkg + exp_index * n * m;
+      size_t xy_start = start + exp_index * img_size;
 
-      for (long conv_row = 0; conv_row < n; ++conv_row) {
+      for (long row = 0; row < n_rows; ++row) {
+        double y_pow_e = y_pow[exp_y * n_rows + row];
         for (long conv_col = 0; conv_col < m; ++conv_col) {
-          size_t conv_index = conv_row * m + conv_col;
-          double x_pow = pow(conv_col, exp_x);
-          double y_pow = pow(conv_row, exp_y);
-
-          Conv_xy[conv_index] = x_pow * y_pow;
+          size_t conv_index = row * m + conv_col;
+          set_conv(Conv, xy_start + conv_index,
+                   x_pow[exp_x * m + conv_col] * y_pow_e, single);
         } // conv_col
-      }   // conv_row
+      }   // row
 
       exp_index++;
     } // exp_y
   }   // exp_x
 
+  free(x_pow);
+  free(y_pow);
   return;
 }
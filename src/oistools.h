@@ -7,10 +7,46 @@ typedef struct {
   double *b;
 } lin_system;
 
+// A factored normal matrix M, Jacobi scaled. F is the Cholesky factor of the
+// scaled M, or its LU factors with row interchanges pivots if it is not
+// positive definite (pivots is NULL for Cholesky).
+typedef struct {
+  int n;
+  double *F;
+  double *scale;
+  int *pivots;
+} normal_factor;
+
+int system_dof(int kernel_height, int kernel_width, int kernel_polydeg,
+               int bkg_deg);
+
 lin_system build_matrix_system(int n, int m, double *image, double *refimage,
                                int kernel_height, int kernel_width,
-                               int kernel_polydeg, int bkg_deg, char *mask);
+                               int kernel_polydeg, int bkg_deg, char *mask,
+                               int block_rows, int n_threads, int single);
+
+double *build_vector_b(int n, int m, double *image, double *refimage,
+                       int kernel_height, int kernel_width, int kernel_polydeg,
+                       int bkg_deg, char *mask, int block_rows, int n_threads,
+                       int single);
 
 void convolve2d_adaptive(int n, int m, double *image, int kernel_height,
                          int kernel_width, int kernel_polydeg, double *kernel,
                          double *convolution);
+
+void eval_adaptive_kernel_grid(int n_pos, double *xs, double *ys,
+                               int kernel_height, int kernel_width,
+                               int kernel_polydeg, double *kernel,
+                               double *kernels);
+
+int cholesky_factor(int n, double *M);
+
+void cholesky_solve(int n, double *L, double *b);
+
+int solve_cholesky(int n, double *M, double *b);
+
+int normal_factor_init(normal_factor *f, int n, double *M);
+
+void normal_factor_solve(normal_factor *f, double *b);
+
+void normal_factor_free(normal_factor *f);
@@ -9,6 +9,18 @@ int main(int argc, const char * argv[]) {
     printf("Running simple_build_matrix_system_run test...");
     simple_build_matrix_system_run();
     printf("ok\n");
+    printf("Running solve_cholesky_run test...");
+    if (solve_cholesky_run() != EXIT_SUCCESS) {
+        printf("FAILED\n");
+        return EXIT_FAILURE;
+    }
+    printf("ok\n");
+    printf("Running normal_factor_run test...");
+    if (normal_factor_run() != EXIT_SUCCESS) {
+        printf("FAILED\n");
+        return EXIT_FAILURE;
+    }
+    printf("ok\n");
     printf("Finished\n");
     
     return EXIT_SUCCESS;
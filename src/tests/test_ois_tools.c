@@ -26,6 +26,88 @@ int simple_build_matrix_system_run() {
     int bkg_deg = 2;
     
     build_matrix_system(n, m, image, refimage, kernel_height, kernel_width,
-                                         kernel_polydeg, bkg_deg, NULL);
+                                         kernel_polydeg, bkg_deg, NULL, 0, 0, 0);
     return EXIT_SUCCESS;
 }
+
+int solve_cholesky_run() {
+    // A symmetric positive definite system larger than one block
+    int n = 150;
+    double* A = (double *)malloc(n * n * sizeof(double));
+    double* M = (double *)malloc(n * n * sizeof(double));
+    double* b = (double *)malloc(n * sizeof(double));
+    double* x = (double *)malloc(n * sizeof(double));
+    for (int i = 0; i < n; i++) {
+        for (int j = 0; j <= i; j++) {
+            A[i * n + j] = A[j * n + i] = 1.0 / (1.0 + i + j) + (i == j) * n;
+        }
+        b[i] = x[i] = i % 7 - 3.0;
+    }
+    for (int i = 0; i < n * n; i++) M[i] = A[i];
+    if (solve_cholesky(n, M, x) != 0) return EXIT_FAILURE;
+    for (int i = 0; i < n; i++) {
+        double Ax = 0.0;
+        for (int j = 0; j < n; j++) Ax += A[i * n + j] * x[j];
+        if (fabs(Ax - b[i]) > 1e-10) return EXIT_FAILURE;
+    }
+    // Not positive definite
+    for (int i = 0; i < n * n; i++) M[i] = A[i];
+    M[5 * n + 5] = -1.0;
+    if (solve_cholesky(n, M, x) != 6) return EXIT_FAILURE;
+    free(A);
+    free(M);
+    free(b);
+    free(x);
+    return EXIT_SUCCESS;
+}
+
+int normal_factor_run() {
+    // The normal matrix M = A^T A of a fit with columns of very different
+    // scales, two of them proportional, so M is singular and Cholesky fails
+    int rows = 200, n = 100;
+    double* A = (double *)malloc(rows * n * sizeof(double));
+    double* M = (double *)malloc(n * n * sizeof(double));
+    double* y = (double *)malloc(rows * sizeof(double));
+    double* x = (double *)malloc(n * sizeof(double));
+    for (int r = 0; r < rows; r++) {
+        for (int j = 0; j < n - 1; j++) {
+            double colscale = pow(10.0, (j % 7) - 3.0);
+            int k = (r * r * 31 + j * 17 + r * j) % 101 - 50;
+            A[r * n + j] = colscale * k;
+        }
+        A[r * n + n - 1] = 10.0 * A[r * n];
+    }
+    for (int i = 0; i < n; i++) {
+        for (int j = 0; j < n; j++) {
+            double sum = 0.0;
+            for (int r = 0; r < rows; r++) sum += A[r * n + i] * A[r * n + j];
+            M[i * n + j] = sum;
+        }
+    }
+    // Data with an exact fit, y = A (1, 2, ..., n), and b = A^T y
+    for (int r = 0; r < rows; r++) {
+        y[r] = 0.0;
+        for (int j = 0; j < n; j++) y[r] += A[r * n + j] * (j + 1);
+    }
+    for (int i = 0; i < n; i++) {
+        x[i] = 0.0;
+        for (int r = 0; r < rows; r++) x[i] += A[r * n + i] * y[r];
+    }
+    normal_factor f;
+    int info = normal_factor_init(&f, n, M);
+    if (info != 0 || f.pivots == NULL) return EXIT_FAILURE;
+    normal_factor_solve(&f, x);
+    normal_factor_free(&f);
+    // The solution is not unique, but its fit must be exact
+    double res = 0.0, norm = 0.0;
+    for (int r = 0; r < rows; r++) {
+        double Ax = 0.0;
+        for (int j = 0; j < n; j++) Ax += A[r * n + j] * x[j];
+        res += (Ax - y[r]) * (Ax - y[r]);
+        norm += y[r] * y[r];
+    }
+    free(A);
+    free(y);
+    free(x);
+    return sqrt(res / norm) < 1e-8 ? EXIT_SUCCESS : EXIT_FAILURE;
+}
@@ -3,3 +3,5 @@
 
 int simple_convolve2d_adaptive_run(void);
 int simple_build_matrix_system_run(void);
+int solve_cholesky_run(void);
+int normal_factor_run(void);
@@ -8,15 +8,21 @@
 #define PY3
 #endif
 
-static PyObject *varconv_gen_matrix_system(PyObject *self, PyObject *args) {
+static PyObject *gen_system(PyObject *args, int vector_only) {
+  /** Shared by gen_matrix_system and gen_vector_b, which take the same
+   * arguments. If vector_only is set only b is computed and returned. */
   PyObject *py_sciimage, *py_refimage, *py_mask;
   int k_side;
   int kernel_polydeg; // The degree of the varying polynomial for the kernel
   int bkg_deg;        // The degree of the varying polynomial for the background
   unsigned char hasmask;
+  int n_threads = 0;  // Number of OpenMP threads, 0 uses the OpenMP default
+  int block_rows = 0; // Rows of basis images built at a time, 0 for all
+  int single = 0;     // Keep the basis images in float instead of double
 
-  if (!PyArg_ParseTuple(args, "OObOiii", &py_sciimage, &py_refimage, &hasmask,
-                        &py_mask, &k_side, &kernel_polydeg, &bkg_deg)) {
+  if (!PyArg_ParseTuple(args, "OObOiii|iii", &py_sciimage, &py_refimage,
+                        &hasmask, &py_mask, &k_side, &kernel_polydeg, &bkg_deg,
+                        &n_threads, &block_rows, &single)) {
     return NULL;
   }
   PyArrayObject *np_sciimage = (PyArrayObject *)PyArray_FROM_OTF(
@@ -52,25 +58,53 @@ static PyObject *varconv_gen_matrix_system(PyObject *self, PyObject *args) {
     mask = (char *)PyArray_DATA(np_mask);
   }
 
-  lin_system result_sys = build_matrix_system(
-      n, m, sciimage, refimage, k_side, k_side, kernel_polydeg, bkg_deg, mask);
+  lin_system result_sys = {0, NULL, NULL};
+  Py_BEGIN_ALLOW_THREADS
+  if (vector_only) {
+    result_sys.b_dim = system_dof(k_side, k_side, kernel_polydeg, bkg_deg);
+    result_sys.b =
+        build_vector_b(n, m, sciimage, refimage, k_side, k_side,
+                       kernel_polydeg, bkg_deg, mask, block_rows, n_threads,
+                       single);
+  } else {
+    result_sys =
+        build_matrix_system(n, m, sciimage, refimage, k_side, k_side,
+                            kernel_polydeg, bkg_deg, mask, block_rows,
+                            n_threads, single);
+  }
+  Py_END_ALLOW_THREADS
 
   Py_DECREF(np_sciimage);
   Py_DECREF(np_refimage);
+  Py_XDECREF(np_mask);
+  if (result_sys.b == NULL)
+    return PyErr_NoMemory();
 
   int total_dof = result_sys.b_dim;
-  npy_intp Mdims[2] = {total_dof, total_dof};
   npy_intp bdims = total_dof;
-  PyArrayObject *pyM = (PyArrayObject *)PyArray_SimpleNewFromData(
-      2, Mdims, NPY_DOUBLE, result_sys.M);
-  PyArray_ENABLEFLAGS(pyM, NPY_ARRAY_OWNDATA);
   PyArrayObject *pyb = (PyArrayObject *)PyArray_SimpleNewFromData(
       1, &bdims, NPY_DOUBLE, result_sys.b);
   PyArray_ENABLEFLAGS(pyb, NPY_ARRAY_OWNDATA);
+  if (vector_only) {
+    return Py_BuildValue("N", pyb);
+  }
+
+  npy_intp Mdims[2] = {total_dof, total_dof};
+  PyArrayObject *pyM = (PyArrayObject *)PyArray_SimpleNewFromData(
+      2, Mdims, NPY_DOUBLE, result_sys.M);
+  PyArray_ENABLEFLAGS(pyM, NPY_ARRAY_OWNDATA);
 
   return Py_BuildValue("NN", pyM, pyb);
 }
 
+static PyObject *varconv_gen_matrix_system(PyObject *self, PyObject *args) {
+  return gen_system(args, 0);
+}
+
+static PyObject *varconv_gen_vector_b(PyObject *self, PyObject *args) {
+  return gen_system(args, 1);
+}
+
 static PyObject *varconv_convolve2d_adaptive(PyObject *self, PyObject *args) {
   PyObject *py_image, *py_kernelcoeffs;
   int k_polydeg; // The degree of the varying polynomial
@@ -99,9 +133,13 @@ static PyObject *varconv_convolve2d_adaptive(PyObject *self, PyObject *args) {
   double *image = (double *)PyArray_DATA(np_image);
   double *k_coeffs = (double *)PyArray_DATA(np_kernelcoeffs);
 
-  double *Conv = (double *)calloc(n * m, sizeof(*Conv));
+  double *Conv;
+  // Other Python threads can run while this one convolves
+  Py_BEGIN_ALLOW_THREADS
+  Conv = (double *)calloc((size_t)n * m, sizeof(*Conv));
   convolve2d_adaptive(n, m, image, k_height, k_width, k_polydeg, k_coeffs,
                       Conv);
+  Py_END_ALLOW_THREADS
 
   Py_XDECREF(np_image);
   Py_XDECREF(np_kernelcoeffs);
@@ -114,11 +152,88 @@ static PyObject *varconv_convolve2d_adaptive(PyObject *self, PyObject *args) {
   return Py_BuildValue("N", pyConv);
 }
 
+static PyObject *varconv_eval_adaptive_kernel_grid(PyObject *self,
+                                                   PyObject *args) {
+  PyObject *py_kernelcoeffs, *py_xs, *py_ys;
+  int k_polydeg; // The degree of the varying polynomial
+
+  if (!PyArg_ParseTuple(args, "OOOi", &py_kernelcoeffs, &py_xs, &py_ys,
+                        &k_polydeg))
+    return NULL;
+  PyArrayObject *np_kernelcoeffs = (PyArrayObject *)PyArray_FROM_OTF(
+      py_kernelcoeffs, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+  PyArrayObject *np_xs =
+      (PyArrayObject *)PyArray_FROM_OTF(py_xs, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+  PyArrayObject *np_ys =
+      (PyArrayObject *)PyArray_FROM_OTF(py_ys, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+  if (np_kernelcoeffs == NULL || np_xs == NULL || np_ys == NULL) {
+    Py_XDECREF(np_kernelcoeffs);
+    Py_XDECREF(np_xs);
+    Py_XDECREF(np_ys);
+    return NULL;
+  }
+  int k_poly_dof = (k_polydeg + 1) * (k_polydeg + 2) / 2;
+  if (PyArray_NDIM(np_kernelcoeffs) != 3 ||
+      PyArray_DIM(np_kernelcoeffs, 2) != k_poly_dof ||
+      PyArray_SIZE(np_xs) != PyArray_SIZE(np_ys)) {
+    PyErr_SetString(PyExc_ValueError,
+                    "kernel must be (kh, kw, dof) for kernel_polydeg and "
+                    "xs and ys must have the same size");
+    Py_XDECREF(np_kernelcoeffs);
+    Py_XDECREF(np_xs);
+    Py_XDECREF(np_ys);
+    return NULL;
+  }
+
+  int n_pos = (int)PyArray_SIZE(np_xs);
+  int k_height = (int)PyArray_DIM(np_kernelcoeffs, 0);
+  int k_width = (int)PyArray_DIM(np_kernelcoeffs, 1);
+  npy_intp kernels_dims[3] = {n_pos, k_height, k_width};
+  PyArrayObject *np_kernels =
+      (PyArrayObject *)PyArray_SimpleNew(3, kernels_dims, NPY_DOUBLE);
+  if (np_kernels != NULL) {
+    double *k_coeffs = (double *)PyArray_DATA(np_kernelcoeffs);
+    double *xs = (double *)PyArray_DATA(np_xs);
+    double *ys = (double *)PyArray_DATA(np_ys);
+    double *kernels = (double *)PyArray_DATA(np_kernels);
+    Py_BEGIN_ALLOW_THREADS
+    eval_adaptive_kernel_grid(n_pos, xs, ys, k_height, k_width, k_polydeg,
+                              k_coeffs, kernels);
+    Py_END_ALLOW_THREADS
+  }
+
+  Py_XDECREF(np_kernelcoeffs);
+  Py_XDECREF(np_xs);
+  Py_XDECREF(np_ys);
+  return (PyObject *)np_kernels;
+}
+
 static PyMethodDef VarConvMethods[] = {
     {"gen_matrix_system", varconv_gen_matrix_system, METH_VARARGS,
-     "Generate the matrix system to find best convolution parameters."},
+     "Generate the matrix system to find best convolution parameters.\n\n"
+     "gen_matrix_system(image, refimage, hasmask, mask, k_side, "
+     "kernel_polydeg, bkg_deg[, n_threads[, block_rows[, single]]])\n\n"
+     "n_threads sets the number of OpenMP threads (0 for the OpenMP "
+     "default). It has no effect if varconv was built without OpenMP.\n"
+     "block_rows > 0 accumulates the system over blocks of that many image "
+     "rows, so only the basis images of one block are kept in memory.\n"
+     "single = 1 keeps the basis images in float32, halving their memory. "
+     "M and b are still accumulated in double.\n"
+     "The GIL is released while the system is built."},
+    {"gen_vector_b", varconv_gen_vector_b, METH_VARARGS,
+     "Generate only the vector b of the matrix system.\n\n"
+     "Takes the same arguments as gen_matrix_system. M depends only on the "
+     "reference image, so it can be reused for many science images."},
     {"convolve2d_adaptive", varconv_convolve2d_adaptive, METH_VARARGS,
-     "Convolves image with a variable kernel."},
+     "Convolves image with a variable kernel.\n\n"
+     "The GIL is released while convolving, so several images can be "
+     "convolved at once from Python threads."},
+    {"eval_adaptive_kernel_grid", varconv_eval_adaptive_kernel_grid,
+     METH_VARARGS,
+     "Evaluate an adaptive kernel at many positions.\n\n"
+     "eval_adaptive_kernel_grid(kernel, xs, ys, kernel_polydeg)\n\n"
+     "Return the (N, kh, kw) kernels at the positions (xs[i], ys[i]) = "
+     "(col, row)."},
     {NULL, NULL, 0, NULL} /* Sentinel */
 };
 
@@ -5,6 +5,18 @@ import os
 import varconv
 
 
+def background_basis(strategy):
+    "Return the full image background basis images, x^i y^j, of strategy."
+    h, w = strategy.refimage.shape
+    y, x = np.mgrid[:h, :w]
+    deg = strategy.bkgdegree
+    return [
+        pow(x, i) * pow(y, j)
+        for i in range(deg + 1)
+        for j in range(deg + 1 - i)
+    ]
+
+
 class TestPSFCorrect(unittest.TestCase):
     def setUp(self):
         h, w = img_shape = (32, 32)
@@ -383,6 +395,229 @@ class TestGrid(unittest.TestCase):
         # Assert it does the same on grid or not
         self.assertLess(norm_diff, 1e-10)
 
+    def test_parallel_n_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        class RecordingExecutor(ThreadPoolExecutor):
+            def submit(self, fn, *args):
+                submitted.append(args[-1])
+                return super(RecordingExecutor, self).submit(fn, *args)
+
+        for method, kwargs, n_threads in (
+            ("AdaptiveBramich", {"poly_degree": 0}, 1),
+            ("AdaptiveBramich", {"poly_degree": 0, "n_threads": 2}, 2),
+            ("Bramich", {}, None),
+        ):
+            submitted = []
+            with RecordingExecutor(2) as pool:
+                ois.optimal_system(
+                    self.img,
+                    self.ref,
+                    method=method,
+                    gridshape=(2, 2),
+                    kernelshape=(3, 3),
+                    executor=pool,
+                    **kwargs
+                )
+            self.assertEqual(len(submitted), 4)
+            for st_kwargs in submitted:
+                self.assertEqual(st_kwargs.get("n_threads"), n_threads)
+
+    def test_parallel_grid(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        serial = ois.optimal_system(
+            self.img, self.ref, gridshape=(2, 3), kernelshape=(5, 5)
+        )
+        with ThreadPoolExecutor(2) as pool:
+            pooled = ois.optimal_system(
+                self.img,
+                self.ref,
+                gridshape=(2, 3),
+                kernelshape=(5, 5),
+                executor=pool,
+            )
+        threaded = ois.optimal_system(
+            self.img, self.ref, gridshape=(2, 3), kernelshape=(5, 5), n_jobs=2
+        )
+        for result in (pooled, threaded):
+            for ser, par in zip(
+                serial[:2] + serial[3:], result[:2] + result[3:]
+            ):
+                self.assertLess(np.abs(ser - par).max(), 1e-10)
+            for k_ser, k_par in zip(serial[2], result[2]):
+                self.assertLess(np.abs(k_ser - k_par).max(), 1e-10)
+
+    def test_memmap_grid(self):
+        import shutil
+        import tempfile
+
+        in_memory = ois.optimal_system(
+            self.img, self.ref, gridshape=(2, 3), kernelshape=(5, 5)
+        )
+        tmpdir = tempfile.mkdtemp()
+        try:
+
+            def memmap(name, data=None):
+                mm = np.memmap(
+                    os.path.join(tmpdir, name),
+                    dtype="float64",
+                    mode="w+",
+                    shape=self.img.shape,
+                )
+                if data is not None:
+                    mm[:] = data
+                return mm
+
+            outs = [memmap(name) for name in ("diff", "opt", "bkg")]
+            for n_jobs in (None, 2):
+                diff, opt, krn, bkg = ois.optimal_system(
+                    memmap("img", self.img),
+                    memmap("ref", self.ref),
+                    gridshape=(2, 3),
+                    kernelshape=(5, 5),
+                    n_jobs=n_jobs,
+                    out_difference=outs[0],
+                    out_optimal=outs[1],
+                    out_background=outs[2],
+                )
+                self.assertIs(diff, outs[0])
+                self.assertIs(bkg, outs[2])
+                for ser, out in zip(
+                    in_memory[:2] + in_memory[3:], (diff, opt, bkg)
+                ):
+                    self.assertLess(np.abs(ser - out).max(), 1e-10)
+            del outs, diff, opt, bkg
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_out_arrays(self):
+        out_diff = np.zeros(self.img.shape)
+        diff, opt, krn, bkg = ois.optimal_system(
+            self.img, self.ref, kernelshape=(5, 5), out_difference=out_diff
+        )
+        self.assertIs(diff, out_diff)
+        self.assertLess(np.abs(diff - (self.img - opt)).max(), 1e-10)
+        self.assertRaises(
+            ValueError,
+            ois.optimal_system,
+            self.img,
+            self.ref,
+            kernelshape=(5, 5),
+            out_optimal=np.zeros((3, 3)),
+        )
+
+    def test_iter_grid(self):
+        diff, opt, krn, bkg = ois.optimal_system(
+            self.img, self.ref, gridshape=(2, 3), kernelshape=(5, 5)
+        )
+        for n_jobs in (None, 2):
+            seen = set()
+            for ind, (sly, slx), di, opti, ki, bgi in ois.iter_optimal_system(
+                self.img,
+                self.ref,
+                gridshape=(2, 3),
+                kernelshape=(5, 5),
+                n_jobs=n_jobs,
+            ):
+                seen.add(ind)
+                self.assertEqual(di.shape, diff[sly, slx].shape)
+                self.assertLess(np.abs(di - diff[sly, slx]).max(), 1e-10)
+                self.assertLess(np.abs(opti - opt[sly, slx]).max(), 1e-10)
+                self.assertLess(np.abs(bgi - bkg[sly, slx]).max(), 1e-10)
+                self.assertLess(np.abs(ki - krn[ind]).max(), 1e-10)
+                # Tiles don't keep the whole grid element alive
+                for tile in (di, opti, bgi):
+                    self.assertIsNone(tile.base)
+            self.assertEqual(seen, set(range(6)))
+
+    def test_iter_early_stop(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(1) as pool:
+            tiles = ois.iter_optimal_system(
+                self.img,
+                self.ref,
+                gridshape=(4, 4),
+                kernelshape=(3, 3),
+                executor=pool,
+            )
+            first = next(tiles)
+            tiles.close()
+        self.assertEqual(len(first), 6)
+
+        # No grid gives the whole image as a single tile
+        tiles = list(
+            ois.iter_optimal_system(self.img, self.ref, kernelshape=(5, 5))
+        )
+        self.assertEqual(len(tiles), 1)
+        self.assertEqual(tiles[0][2].shape, self.img.shape)
+
+    def test_interpolate_kernel(self):
+        s_tuned = np.sqrt(1.4**2 - 0.8**2)
+        for method, kwargs in (
+            ("Bramich", {}),
+            ("Alard-Lupton", {"gausslist": [{"sx": s_tuned, "sy": s_tuned}]}),
+        ):
+            grid_diff = ois.optimal_system(
+                self.img,
+                self.ref,
+                kernelshape=(11, 11),
+                method=method,
+                gridshape=(2, 2),
+                **kwargs
+            )[0]
+            diff, opt, krn, bkg = ois.optimal_system(
+                self.img,
+                self.ref,
+                kernelshape=(11, 11),
+                method=method,
+                gridshape=(2, 2),
+                interpolate_kernel=True,
+                **kwargs
+            )
+            self.assertEqual(len(krn), 4)
+            self.assertEqual(krn[0].shape, (11, 11))
+            # The PSF is the same everywhere, so the subtraction is as good
+            self.assertLess(
+                np.linalg.norm(diff), 1.05 * np.linalg.norm(grid_diff)
+            )
+            np.testing.assert_allclose(diff, self.img - opt, atol=1e-12)
+
+        # Adaptive kernels are evaluated at the center of the element, in
+        # the coordinates of the element with its border
+        kernel = np.random.random((5, 5, 3))
+        center = ois._center_kernels(
+            [kernel],
+            [(slice(4, 10), slice(6, 12))],
+            [(slice(2, 12), slice(4, 14))],
+        )
+        np.testing.assert_allclose(
+            center[0], ois.eval_adpative_kernel(kernel, 4.5, 4.5)
+        )
+
+        # With the same kernel at every center, the field is that kernel
+        kernel = np.random.random((5, 5))
+        conv = ois._interpolated_convolution(
+            self.ref, np.array([kernel] * 6), (2, 3), np.zeros((32, 32))
+        )
+        np.testing.assert_allclose(
+            conv, ois._convolve2d(self.ref, kernel), atol=1e-12
+        )
+
+        # Masks are kept
+        img = np.ma.array(self.img, mask=np.zeros((32, 32), dtype="bool"))
+        img.mask[3, 4] = True
+        diff, opt, krn, bkg = ois.optimal_system(
+            img,
+            self.ref,
+            kernelshape=(5, 5),
+            gridshape=(2, 2),
+            interpolate_kernel=True,
+        )
+        self.assertTrue(diff.mask[3, 4])
+        self.assertFalse(diff.mask[20, 20])
+
     def test_AlardLupton_grid(self):
         # Assuming s_img > s_ref, the ideal convolution kernel for an image
         # that has a Gaussian seeing PSF s_img and a reference with s_ref is
@@ -451,6 +686,64 @@ class TestVarConv(unittest.TestCase):
         best_kernel[kc, kc] = 1.0
         self.assertLess(np.linalg.norm(result_kernel - best_kernel), 1e-10)
 
+    def test_gen_matrix_system_threads(self):
+        image = np.random.random((30, 20))
+        refimage = np.random.random((30, 20))
+        mask = np.zeros(image.shape, dtype="bool")
+        mask[3:5, 3:5] = True
+        for hasmask in (0, 1):
+            mm1, b1 = varconv.gen_matrix_system(
+                image, refimage, hasmask, mask, 3, 2, 1, 1
+            )
+            mm4, b4 = varconv.gen_matrix_system(
+                image, refimage, hasmask, mask, 3, 2, 1, 4
+            )
+            self.assertLess(np.abs(mm1 - mm4).max(), 1e-10)
+            self.assertLess(np.abs(b1 - b4).max(), 1e-10)
+
+    def test_gen_matrix_system_blocks(self):
+        image = np.random.random((30, 20))
+        refimage = np.random.random((30, 20))
+        mask = np.zeros(image.shape, dtype="bool")
+        mask[3:5, 3:5] = True
+        for hasmask in (0, 1):
+            mm, b = varconv.gen_matrix_system(
+                image, refimage, hasmask, mask, 3, 2, 1
+            )
+            for block_rows in (1, 7, 30):
+                mm_bl, b_bl = varconv.gen_matrix_system(
+                    image, refimage, hasmask, mask, 3, 2, 1, 0, block_rows
+                )
+                self.assertLess(
+                    np.abs(mm - mm_bl).max() / np.abs(mm).max(), 1e-12
+                )
+                self.assertLess(
+                    np.abs(b - b_bl).max() / np.abs(b).max(), 1e-12
+                )
+
+    def test_low_memory_adaptive_bramich(self):
+        image = np.random.random((30, 20))
+        refimage = np.random.random((30, 20))
+        diff = ois.optimal_system(
+            image, refimage, (3, 3), 1, method="AdaptiveBramich", poly_degree=1
+        )[0]
+        block_size = ois._LOW_MEMORY_BLOCK_SIZE
+        try:
+            # Make blocks of a few rows for this small image
+            ois._LOW_MEMORY_BLOCK_SIZE = 2000
+            diff_lowmem = ois.optimal_system(
+                image,
+                refimage,
+                (3, 3),
+                1,
+                method="AdaptiveBramich",
+                poly_degree=1,
+                low_memory=True,
+            )[0]
+        finally:
+            ois._LOW_MEMORY_BLOCK_SIZE = block_size
+        self.assertLess(np.abs(diff - diff_lowmem).max(), 1e-8)
+
     def test_convolve2d_adaptive_idkernel(self):
         kernel = np.zeros((3, 3, 1), dtype="float64")
         kernel[1, 1, 0] = 1.0
@@ -460,6 +753,38 @@ class TestVarConv(unittest.TestCase):
         self.assertEqual(conv.shape, image.shape)
         self.assertLess(np.linalg.norm(image - conv), 1e-10)
 
+    def test_convolve2d_adaptive_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        kernel = np.random.random((5, 5, 6))
+        images = [np.random.random((60, 50)) for i in range(8)]
+        serial = [varconv.convolve2d_adaptive(im, kernel, 2) for im in images]
+        with ThreadPoolExecutor(4) as pool:
+            threaded = list(
+                pool.map(
+                    lambda im: varconv.convolve2d_adaptive(im, kernel, 2),
+                    images,
+                )
+            )
+        for conv_ser, conv_thr in zip(serial, threaded):
+            self.assertLess(np.abs(conv_ser - conv_thr).max(), 1e-12)
+
+    def test_threaded_adaptive_bramich_grid(self):
+        image = np.random.random((60, 60))
+        refimage = np.random.random((60, 60))
+        kwargs = dict(
+            kernelshape=(3, 3),
+            method="AdaptiveBramich",
+            poly_degree=1,
+            gridshape=(3, 3),
+            n_threads=1,
+        )
+        serial = ois.optimal_system(image, refimage, **kwargs)
+        threaded = ois.optimal_system(image, refimage, n_jobs=4, **kwargs)
+        self.assertLess(np.abs(serial[0] - threaded[0]).max(), 1e-10)
+        for k_ser, k_thr in zip(serial[2], threaded[2]):
+            self.assertLess(np.abs(k_ser - k_thr).max(), 1e-10)
+
     def test_convolve2d_adaptive_undoing(self):
         deg = 2
         k_side = 3
@@ -608,6 +933,39 @@ class TestVarConv(unittest.TestCase):
             1e-10,
         )
 
+    def test_eval_adaptive_kernel_grid(self):
+        kernel = np.random.random((5, 3, 6))
+        xs = np.random.random(20) * 100
+        ys = np.random.random(20) * 100
+        kernels = ois.eval_adaptive_kernel_grid(kernel, xs, ys)
+        self.assertEqual(kernels.shape, (20, 5, 3))
+        for k_xy, x, y in zip(kernels, xs, ys):
+            # The original loop over polynomial terms
+            expected = np.zeros((5, 3))
+            d = 0
+            for powx in range(3):
+                for powy in range(3 - powx):
+                    expected += kernel[:, :, d] * x**powx * y**powy
+                    d += 1
+            np.testing.assert_allclose(k_xy, expected, rtol=1e-10)
+            np.testing.assert_allclose(
+                ois.eval_adpative_kernel(kernel, x, y), expected, rtol=1e-10
+            )
+        np.testing.assert_allclose(
+            varconv.eval_adaptive_kernel_grid(kernel, xs, ys, 2),
+            kernels,
+            rtol=1e-10,
+        )
+
+        constant = np.random.random((5, 3))
+        kernels = ois.eval_adaptive_kernel_grid(constant, xs, ys)
+        self.assertEqual(kernels.shape, (20, 5, 3))
+        np.testing.assert_array_equal(kernels[7], constant)
+        with self.assertRaises(ValueError):
+            ois.eval_adaptive_kernel_grid(kernel, xs, ys[:3])
+        with self.assertRaises(ValueError):
+            varconv.eval_adaptive_kernel_grid(kernel, xs, ys, 1)
+
     def test_convolve2d_adaptive_dtype_check(self):
         kernel = np.random.random((3, 3, 1))
         ois.convolve2d_adaptive(
@@ -620,6 +978,673 @@ class TestVarConv(unittest.TestCase):
         )
 
 
+class TestNormalEquations(unittest.TestCase):
+    def setUp(self):
+        self.img = np.random.random((40, 50))
+        self.ref = np.random.random((40, 50))
+
+    def dot_system(self, strategy):
+        c = strategy.get_cmatrices()
+        if strategy.bkgdegree is not None:
+            c.extend(background_basis(strategy))
+        c = np.array([ci.flatten() for ci in c])
+        return c.dot(c.T), c.dot(strategy.image.flatten())
+
+    def test_bramich_correlation_system(self):
+        for k_shape, bkgdegree in (((5, 7), None), ((11, 11), 2)):
+            strategy = ois.BramichStrategy(
+                self.img, self.ref, k_shape, bkgdegree
+            )
+            m, b = strategy.get_correlation_system()
+            m_dot, b_dot = self.dot_system(strategy)
+            self.assertLess(
+                np.abs(m - m_dot).max() / np.abs(m_dot).max(), 1e-12
+            )
+            self.assertLess(
+                np.abs(b - b_dot).max() / np.abs(b_dot).max(), 1e-12
+            )
+
+    def test_masked_matrix_system(self):
+        mask = np.zeros(self.img.shape, dtype="bool")
+        mask[10:14, 20:25] = True
+        img = np.ma.array(self.img, mask=mask)
+        for strategy in (
+            ois.BramichStrategy(img, self.ref, (5, 5), 1),
+            ois.AlardLuptonStrategy(img, self.ref, (5, 5), 1, None),
+        ):
+            m, b = strategy.get_matrix_system()
+            c = strategy.get_cmatrices()
+            c.extend(background_basis(strategy))
+            c = np.array([ci[~mask] for ci in c])
+            m_dot = c.dot(c.T)
+            b_dot = c.dot(self.img[~mask])
+            self.assertLess(
+                np.abs(m - m_dot).max() / np.abs(m_dot).max(), 1e-12
+            )
+            self.assertLess(
+                np.abs(b - b_dot).max() / np.abs(b_dot).max(), 1e-12
+            )
+
+    def test_coeffstobackground(self):
+        strategy = ois.SubtractionStrategy(self.img, self.ref, (3, 3), 3)
+        coeffs = np.random.random(10)
+        bkg = sum(
+            ci * bi for ci, bi in zip(coeffs, background_basis(strategy))
+        )
+        self.assertLess(
+            np.abs(strategy.coeffstobackground(coeffs) - bkg).max(), 1e-8
+        )
+
+    def test_correlation_lags_fft(self):
+        direct = ois._correlation_lags(self.img, self.ref, 3, 4)
+        n_lags_fft = ois._FFT_LAGS_PER_LOG2
+        try:
+            ois._FFT_LAGS_PER_LOG2 = 0
+            fft = ois._correlation_lags(self.img, self.ref, 3, 4)
+        finally:
+            ois._FFT_LAGS_PER_LOG2 = n_lags_fft
+        self.assertLess(np.abs(direct - fft).max(), 1e-10)
+
+
+class TestReferenceContext(unittest.TestCase):
+    def setUp(self):
+        self.ref = np.random.random((40, 50))
+        self.imgs = [np.random.random((40, 50)) for i in range(3)]
+
+    def assert_same_results(self, context_results, results):
+        for context_ret, ret in zip(context_results, results):
+            self.assertLess(np.abs(context_ret - ret).max(), 1e-8)
+
+    def test_context_matches_optimal_system(self):
+        for method, bkgdegree, kwargs in (
+            ("Bramich", None, {}),
+            ("Bramich", 1, {}),
+            ("Alard-Lupton", 1, {"gausslist": [{"sx": 1.5, "sy": 1.5}]}),
+            ("AdaptiveBramich", 0, {"poly_degree": 1}),
+        ):
+            context = ois.ReferenceContext(
+                self.ref, (5, 5), bkgdegree, method, **kwargs
+            )
+            self.assertIn("solver", context.refcache)
+            for img in self.imgs:
+                self.assert_same_results(
+                    context.subtract(img),
+                    ois.optimal_system(
+                        img, self.ref, (5, 5), bkgdegree, method, **kwargs
+                    ),
+                )
+
+    def test_context_reuses_matrix(self):
+        context = ois.ReferenceContext(
+            self.ref, (5, 5), 1, "Alard-Lupton", gausslist=None
+        )
+        strategy = context.strategy(self.imgs[0])
+        self.assertIs(strategy.get_normal_matrix(), context.refcache["m"])
+
+    def test_optimal_system_batch(self):
+        mask = np.zeros(self.ref.shape, dtype="bool")
+        mask[10:14, 20:25] = True
+        masked_img = np.ma.array(self.imgs[0], mask=mask)
+        for method, bkgdegree, kwargs in (
+            ("Bramich", 1, {}),
+            ("AdaptiveBramich", None, {"poly_degree": 1}),
+        ):
+            diffs, opts, kernels, bkgs = ois.optimal_system_batch(
+                np.array(self.imgs),
+                self.ref,
+                (5, 5),
+                bkgdegree,
+                method,
+                **kwargs
+            )
+            self.assertEqual(diffs.shape, (3,) + self.ref.shape)
+            for i, img in enumerate(self.imgs):
+                self.assert_same_results(
+                    (diffs[i], opts[i], kernels[i], bkgs[i]),
+                    ois.optimal_system(
+                        img, self.ref, (5, 5), bkgdegree, method, **kwargs
+                    ),
+                )
+        # Iterators and images with their own mask are accepted too
+        images = iter([masked_img, self.imgs[1]])
+        diffs, opts, kernels, bkgs = ois.optimal_system_batch(
+            images, self.ref, (5, 5)
+        )
+        self.assertTrue(diffs.mask[0, 12, 22])
+        self.assertFalse(diffs.mask[1].any())
+        self.assert_same_results(
+            (diffs[0], kernels[0]),
+            ois.optimal_system(masked_img, self.ref, (5, 5))[::2],
+        )
+        with self.assertRaises(ValueError):
+            ois.optimal_system_batch(
+                self.imgs, self.ref, (5, 5), gridshape=(2, 2)
+            )
+
+    def test_context_masked_image(self):
+        # A science image mask changes M, so it must not use the cached one
+        mask = np.zeros(self.ref.shape, dtype="bool")
+        mask[10:14, 20:25] = True
+        img = np.ma.array(self.imgs[0], mask=mask)
+        context = ois.ReferenceContext(self.ref, (5, 5))
+        strategy = context.strategy(img)
+        self.assertIsNot(strategy.refcache, context.refcache)
+        self.assert_same_results(
+            context.subtract(img), ois.optimal_system(img, self.ref, (5, 5))
+        )
+
+
+class TestSolvers(unittest.TestCase):
+    def setUp(self):
+        self.img = np.random.random((40, 50))
+        self.ref = np.random.random((40, 50))
+
+    def test_solvers_agree(self):
+        kernels = []
+        for solver in ("cholesky", "lu", "lstsq", "ridge"):
+            strategy = ois.BramichStrategy(
+                self.img, self.ref, (5, 5), 1, solver=solver
+            )
+            kernels.append(strategy.get_kernel())
+            cond = strategy.get_condition_number()
+            self.assertTrue(1.0 < cond < 1e12)
+        for kernel in kernels[1:]:
+            self.assertLess(np.abs(kernel - kernels[0]).max(), 1e-4)
+
+    def test_singular_fallback(self):
+        # A constant reference makes every shifted copy nearly the same
+        ref = np.ones((20, 20))
+        import warnings
+        from scipy.linalg import LinAlgWarning
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            diff, opt, krn, bkg = ois.optimal_system(
+                self.img[:20, :20], ref, (3, 3), 0
+            )
+        self.assertTrue(np.all(np.isfinite(krn)))
+        self.assertTrue(
+            any(issubclass(w.category, LinAlgWarning) for w in caught)
+        )
+
+    def test_default_no_warning(self):
+        import warnings
+        from scipy.linalg import LinAlgWarning
+        from scipy.ndimage import gaussian_filter
+
+        stars = np.zeros((32, 32))
+        stars[[9, 9, 24, 24], [9, 24, 9, 24]] = [200, 300, 400, 500]
+        img = gaussian_filter(stars, 1.4, mode="constant")
+        ref = gaussian_filter(stars, 0.8, mode="constant")
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", LinAlgWarning)
+            for method in ("Bramich", "AdaptiveBramich"):
+                diff = ois.optimal_system(img, ref, method=method)[0]
+                self.assertLess(np.linalg.norm(diff), 1e-3)
+
+    def test_jacobi_scaling(self):
+        # Terms of very different size, as raw pixel coordinate powers
+        rng = np.random.RandomState(0)
+        a = rng.random_sample((8, 8))
+        a = a.dot(a.T) + 8 * np.identity(8)
+        d = np.logspace(-3, 3, 8)
+        m = d[:, None] * a * d
+        x = rng.random_sample(8)
+        for solver in ("cholesky", "lu"):
+            normal_solver = ois._NormalSolver(m, solver)
+            self.assertEqual(normal_solver.method, solver)
+            self.assertLess(normal_solver.condition_number, 100)
+            np.testing.assert_allclose(
+                normal_solver.solve(m.dot(x)), x, rtol=1e-8
+            )
+            np.testing.assert_allclose(
+                normal_solver.solve(np.array([m.dot(x), m.dot(x)]).T)[:, 1],
+                x,
+                rtol=1e-8,
+            )
+
+    def test_wrong_solver(self):
+        self.assertRaises(
+            ValueError,
+            ois.optimal_system,
+            self.img,
+            self.ref,
+            solver="qr",
+        )
+
+
+class TestStamps(unittest.TestCase):
+    def setUp(self):
+        from scipy.ndimage import gaussian_filter
+
+        h, w = 120, 140
+        rng = np.random.RandomState(3)
+        self.rows = rng.randint(12, h - 12, 20)
+        self.cols = rng.randint(12, w - 12, 20)
+        self.ref = np.zeros((h, w))
+        self.ref[self.rows, self.cols] = rng.uniform(100, 1000, 20)
+        self.ref = gaussian_filter(self.ref, 1.0, mode="constant")
+        y, x = np.mgrid[:5, :5]
+        self.kernel = np.exp(-((x - 2.2) ** 2 + (y - 1.8) ** 2) / 2.0)
+        self.kernel /= self.kernel.sum()
+        self.img = ois._convolve2d(self.ref, self.kernel, "direct")
+
+    def test_find_stamps(self):
+        stamps = ois.find_stamps(self.ref, 5, (11, 11))
+        self.assertEqual(len(stamps), 5)
+        planted = set(zip(self.rows, self.cols))
+        for row, col in stamps:
+            self.assertIn((row, col), planted)
+        bright = [self.ref[row, col] for row, col in stamps]
+        self.assertEqual(bright, sorted(bright, reverse=True))
+        saturated = ois.find_stamps(self.ref, 50, (11, 11), bright[0])
+        self.assertNotIn(stamps[0], saturated)
+
+    def test_stamps_kernel(self):
+        for method, kwargs in (
+            ("Bramich", {}),
+            (
+                "Alard-Lupton",
+                {"gausslist": [{"center": (1.8, 2.2), "sx": 1.0, "sy": 1.0}]},
+            ),
+            ("AdaptiveBramich", {"poly_degree": 0}),
+        ):
+            strategy = ois._get_strategy(method, (5, 5))(
+                self.img, self.ref, (5, 5), 0, stamps=8, **kwargs
+            )
+            n_fit = len(strategy.get_fit_pixels()[0])
+            self.assertLessEqual(n_fit, 8 * 11 * 11)
+            full = ois._get_strategy(method, (5, 5))(
+                self.img, self.ref, (5, 5), 0, **kwargs
+            )
+            kernel = strategy.get_kernel().reshape((5, 5))
+            self.assertLess(
+                np.abs(kernel - full.get_kernel().reshape((5, 5))).max(),
+                1e-6,
+            )
+            self.assertLess(np.abs(strategy.get_difference()).max(), 1e-6)
+
+    def test_stamps_basis_matrix(self):
+        # The basis made on stamp cutouts is the full basis on those pixels
+        stamps = [(0, 0), (30, 40), (33, 45), (119, 100)]
+        strategy = ois.AlardLuptonStrategy(
+            self.img, self.ref, (5, 5), 1, None, stamps=stamps
+        )
+        rows, cols = strategy.get_fit_pixels()
+        c_full = np.array([ci[rows, cols] for ci in strategy.get_cmatrices()])
+        self.assertLess(
+            np.abs(strategy.get_basis_matrix() - c_full).max(), 1e-10
+        )
+        c_full = np.concatenate(
+            (
+                c_full,
+                [ci[rows, cols] for ci in background_basis(strategy)],
+            )
+        )
+        m, b = strategy.get_matrix_system()
+        m_dot = c_full.dot(c_full.T)
+        b_dot = c_full.dot(self.img[rows, cols])
+        self.assertLess(np.abs(m - m_dot).max() / np.abs(m_dot).max(), 1e-12)
+        self.assertLess(np.abs(b - b_dot).max() / np.abs(b_dot).max(), 1e-12)
+
+    def test_grid_stamps(self):
+        stamps = list(zip(self.rows, self.cols))
+        diff, opt, krn, bkg = ois.optimal_system(
+            self.img, self.ref, (5, 5), gridshape=(2, 2), stamps=stamps
+        )
+        self.assertLess(np.abs(diff).max(), 1e-6)
+
+    def test_no_stamps(self):
+        # Stamps only in the top left grid element: the others fit it all
+        stamps = [(r, c) for r, c in zip(self.rows, self.cols) if r < 40]
+        stamps = [(r, c) for r, c in stamps if c < 50]
+        self.assertGreater(len(stamps), 0)
+        for method, kwargs in (
+            ("Bramich", {}),
+            (
+                "Alard-Lupton",
+                {"gausslist": [{"center": (1.8, 2.2), "sx": 1.0, "sy": 1.0}]},
+            ),
+            ("AdaptiveBramich", {"poly_degree": 0}),
+        ):
+            with self.assertWarns(RuntimeWarning):
+                diff = ois.optimal_system(
+                    self.img,
+                    self.ref,
+                    (5, 5),
+                    0,
+                    method=method,
+                    gridshape=(2, 2),
+                    stamps=stamps,
+                    **kwargs
+                )[0]
+            whole = ois.optimal_system(
+                self.img,
+                self.ref,
+                (5, 5),
+                0,
+                method=method,
+                gridshape=(2, 2),
+                **kwargs
+            )[0]
+            self.assertLess(np.abs(diff[:60, :70]).max(), 1e-6)
+            self.assertLess(np.abs(diff[60:] - whole[60:]).max(), 1e-8)
+            self.assertLess(np.abs(diff[:, 70:] - whole[:, 70:]).max(), 1e-8)
+        for stamps in (0, []):
+            with self.assertWarns(RuntimeWarning):
+                strategy = ois.BramichStrategy(
+                    self.img, self.ref, (5, 5), None, stamps=stamps
+                )
+            self.assertIsNone(strategy.stamp_slices)
+            self.assertLess(np.abs(strategy.get_difference()).max(), 1e-6)
+
+
+class TestFloat32(unittest.TestCase):
+    def setUp(self):
+        from scipy.ndimage import gaussian_filter
+
+        rng = np.random.RandomState(1)
+        # Like 16-bit CCD data, with a large level and a small signal on it
+        self.ref = gaussian_filter(
+            rng.poisson(1000, (60, 70)).astype("float"), 1.0
+        )
+        self.img = gaussian_filter(self.ref, 1.2) + rng.normal(
+            0, 1, self.ref.shape
+        )
+        mask = np.zeros(self.ref.shape, dtype="bool")
+        mask[10:15, 20:30] = True
+        self.masked_img = np.ma.array(self.img, mask=mask)
+
+    def test_float32_accuracy(self):
+        for method, img, kwargs in (
+            ("Bramich", self.img, {}),
+            ("Bramich", self.masked_img, {}),
+            ("Alard-Lupton", self.img, {"gausslist": None}),
+            ("AdaptiveBramich", self.img, {"poly_degree": 1}),
+        ):
+            diff64, opt64, k64, bkg64 = ois.optimal_system(
+                img, self.ref, (5, 5), 1, method, **kwargs
+            )
+            diff32, opt32, k32, bkg32 = ois.optimal_system(
+                img, self.ref, (5, 5), 1, method, dtype="float32", **kwargs
+            )
+            self.assertLess(np.abs(k32 - k64).max() / np.abs(k64).max(), 1e-4)
+            self.assertLess(
+                np.abs(diff32 - diff64).max() / np.abs(self.img).max(), 1e-5
+            )
+
+    def test_float32_basis(self):
+        for strategy in (
+            ois.BramichStrategy(
+                self.masked_img, self.ref, (5, 5), 1, dtype="float32"
+            ),
+            ois.AlardLuptonStrategy(
+                self.img, self.ref, (5, 5), 1, None, dtype="float32"
+            ),
+        ):
+            self.assertEqual(strategy.get_basis_matrix().dtype, np.float32)
+            m, b = strategy.get_matrix_system()
+            self.assertEqual(m.dtype, np.float64)
+            self.assertEqual(strategy.get_optimal_image().dtype, np.float32)
+
+    def test_gen_matrix_system_single(self):
+        m, b = varconv.gen_matrix_system(
+            self.img, self.ref, False, None, 3, 1, 1
+        )
+        m32, b32 = varconv.gen_matrix_system(
+            self.img, self.ref, False, None, 3, 1, 1, 0, 0, 1
+        )
+        self.assertLess(np.abs(m32 - m).max() / np.abs(m).max(), 1e-6)
+        self.assertLess(np.abs(b32 - b).max() / np.abs(b).max(), 1e-6)
+
+    def test_wrong_dtype(self):
+        self.assertRaises(
+            ValueError,
+            ois.optimal_system,
+            self.img,
+            self.ref,
+            dtype="float16",
+        )
+
+
+class TestConvolution(unittest.TestCase):
+    def setUp(self):
+        self.img = np.random.random((40, 50))
+        self.ref = np.random.random((40, 50))
+
+    def test_convolve2d_methods(self):
+        from scipy import signal
+
+        kernel = np.random.random((7, 5))
+        separable_kernel = np.outer(np.random.random(7), np.random.random(5))
+        for k in (kernel, separable_kernel):
+            direct = signal.convolve2d(self.ref, k, mode="same")
+            for method in ("direct", "separable", "fft", "auto"):
+                conv = ois._convolve2d(self.ref, k, method)
+                self.assertEqual(conv.shape, self.ref.shape)
+                self.assertLess(np.abs(conv - direct).max(), 1e-10)
+
+    def test_alard_lupton_conv_methods(self):
+        gausslist = [
+            {"sx": 1.5, "sy": 2.5},
+            {"center": (3, 4), "modPolyDeg": 1},
+        ]
+        results = [
+            ois.optimal_system(
+                self.img,
+                self.ref,
+                (9, 9),
+                method="Alard-Lupton",
+                gausslist=gausslist,
+                conv_method=method,
+            )
+            for method in ("direct", "separable", "fft", "auto")
+        ]
+        for diff, opt, krn, bkg in results[1:]:
+            self.assertLess(np.abs(diff - results[0][0]).max(), 1e-8)
+            self.assertLess(np.abs(krn - results[0][2]).max(), 1e-8)
+
+    def test_wrong_conv_method(self):
+        with self.assertRaises(ValueError):
+            ois.optimal_system(self.img, self.ref, conv_method="WrongName")
+
+
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        self.img = np.random.random((40, 50))
+        self.ref = np.random.random((40, 50))
+        import asyncio
+
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_phases(self):
+        for method, kwargs in (
+            ("Bramich", {}),
+            ("Bramich", {"stamps": 2}),
+            ("AdaptiveBramich", {"poly_degree": 1}),
+        ):
+            phases = []
+            ois.optimal_system(
+                self.img,
+                self.ref,
+                (3, 3),
+                method=method,
+                observer=phases.append,
+                **kwargs
+            )
+            self.assertEqual(phases[-3:], ["solve", "convolve", "done"])
+            self.assertIn("matrix", phases)
+
+    def test_observer_cancels(self):
+        def observer(phase):
+            if phase == "solve":
+                raise ois.SubtractionCancelled()
+
+        with self.assertRaises(ois.SubtractionCancelled):
+            ois.optimal_system(self.img, self.ref, (3, 3), observer=observer)
+
+    def test_aoptimal_system(self):
+        diff = ois.optimal_system(
+            self.img, self.ref, (3, 3), gridshape=(2, 2)
+        )[0]
+        progress = []
+        futures = [
+            ois.aoptimal_system(
+                self.img,
+                self.ref,
+                (3, 3),
+                gridshape=(2, 2),
+                progress=lambda *args: progress.append(args),
+                loop=self.loop,
+            )
+            for i in range(2)
+        ]
+        import asyncio
+
+        results = self.loop.run_until_complete(asyncio.gather(*futures))
+        for adiff, aopt, akrn, abkg in results:
+            self.assertLess(np.abs(adiff - diff).max(), 1e-10)
+        self.assertIn(("done", 4, 4), progress)
+
+    def test_aoptimal_system_cancel(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        started = []
+        pool = ThreadPoolExecutor(1)
+        future = ois.aoptimal_system(
+            self.img,
+            self.ref,
+            (3, 3),
+            gridshape=(4, 4),
+            executor=pool,
+            progress=lambda *args: future.cancel(),
+            observer=started.append,
+            loop=self.loop,
+        )
+        import asyncio
+
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(future)
+        pool.shutdown()
+        self.assertLess(started.count("done"), 16)
+
+    def test_aoptimal_system_process_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(1) as pool:
+            with self.assertRaises(TypeError):
+                ois.aoptimal_system(
+                    self.img, self.ref, (3, 3), executor=pool, loop=self.loop
+                )
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        self.img = np.random.random((40, 50))
+        self.ref = np.random.random((40, 50))
+
+    def test_profile_phases(self):
+        for method, kwargs, dof in (
+            ("Bramich", {}, 9),
+            ("Bramich", {"stamps": 2}, 9),
+            ("AdaptiveBramich", {"poly_degree": 1}, 27),
+        ):
+            report = ois.ProfileReport()
+            ois.optimal_system(
+                self.img,
+                self.ref,
+                (3, 3),
+                method=method,
+                profile=report,
+                **kwargs
+            )
+            phases = [record["phase"] for record in report.records]
+            self.assertEqual(phases[-2:], ["solve", "convolve"])
+            matrix = report.records[phases.index("matrix")]
+            self.assertEqual(matrix["shape"], (dof, dof))
+            self.assertEqual(matrix["nbytes"], dof * dof * 8)
+            for record in report.records:
+                self.assertIsNone(record["stamp"])
+                self.assertGreaterEqual(record["seconds"], 0.0)
+            self.assertEqual(report.records[-1]["shape"], self.img.shape)
+            self.assertIn("convolve", str(report))
+            solve = report.records[phases.index("solve")]
+            self.assertGreaterEqual(solve["condition_number"], 1.0)
+            self.assertNotIn("condition_number", matrix)
+
+    def test_profile_not_report(self):
+        for gridshape in (None, (2, 2)):
+            with self.assertRaises(TypeError):
+                ois.optimal_system(
+                    self.img,
+                    self.ref,
+                    (3, 3),
+                    gridshape=gridshape,
+                    profile=True,
+                )
+
+    def test_profile_grid(self):
+        report = ois.ProfileReport()
+        ois.optimal_system(
+            self.img,
+            self.ref,
+            (3, 3),
+            gridshape=(2, 2),
+            n_jobs=2,
+            profile=report,
+        )
+        stamps = [rec["stamp"] for rec in report.records]
+        self.assertEqual(sorted(set(stamps)), [0, 1, 2, 3])
+        totals = report.totals()
+        self.assertEqual(totals["solve"]["nbytes"], 4 * 9 * 8)
+        conds = [
+            rec["condition_number"]
+            for rec in report.records
+            if rec["phase"] == "solve"
+        ]
+        self.assertEqual(len(conds), 4)
+
+    def test_profile_process_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        report = ois.ProfileReport()
+        with ProcessPoolExecutor(2) as pool:
+            ois.optimal_system(
+                self.img,
+                self.ref,
+                (3, 3),
+                gridshape=(2, 2),
+                executor=pool,
+                profile=report,
+            )
+        stamps = [rec["stamp"] for rec in report.records]
+        self.assertEqual(sorted(set(stamps)), [0, 1, 2, 3])
+        serial = ois.ProfileReport()
+        ois.optimal_system(
+            self.img, self.ref, (3, 3), gridshape=(2, 2), profile=serial
+        )
+        self.assertEqual(len(report.records), len(serial.records))
+
+    def test_profile_logging(self):
+        import logging
+
+        records = []
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(record.ois_profile)
+
+        logger = logging.getLogger("ois.test_profile")
+        logger.addHandler(ListHandler())
+        logger.setLevel(logging.INFO)
+        report = ois.ProfileReport(logger=logger, level=logging.INFO)
+        ois.optimal_system(self.img, self.ref, (3, 3), profile=report)
+        self.assertEqual(records, report.records)
+
+
 class TestExceptions(unittest.TestCase):
     def setUp(self):
         self.img = np.random.random((100, 100))